@@ -1,26 +1,61 @@
 # -*- coding: utf-8 -*-
 
+# 起動の各段階の時間を計測する（準備が終わると STARTUP: として表示する）
+from speech.asr.startup import StartupTimer, Prewarmer
+startup = StartupTimer()
+
+import sys
+import atexit
 import ConfigParser
-from speech.inputter import SpeechInputter
+from speech.inputter import create_speech_inputter, dispatch_result
+from speech.asr.metrics import create_metrics_server
 from Queue import Queue
-from send import send
+startup.mark('imports')
 
 # load config
 conf_file_path =  './speech/conf.ini'
 conf = ConfigParser.SafeConfigParser()
 conf.read(conf_file_path)
+startup.mark('config')
 
-si = SpeechInputter(conf)
+# [pyaudio] devices に複数のマイクを列挙すると1プロセスで全てを扱う．
+# 認識エンジンのクライアントは最初に使うときか warm_up() で作られるので，先に入力を始める
+si = create_speech_inputter(conf)
 q = Queue()
 si.set_q(q)
-
 si.start()
+startup.mark('audio')
+
+# 状態の送信はバックグラウンドで行い，認識結果の受け取りを止めない
+from send import StateDispatcher
+from state_scheduler import create_scheduler
+dispatcher = StateDispatcher()
+# cui.py --minute / --hour の時限更新を同じ接続で送る
+scheduler = create_scheduler(conf, dispatcher)
+if scheduler is not None:
+    scheduler.start()
+startup.mark('dispatcher')
+
+# 実行中の数値を [metrics] の host:port で公開する
+metrics_server = create_metrics_server(conf)
+
+
+def print_codec_summary():
+    u"""終了時に送った音声の符号化の統計を表示する（何も送っていなければ表示しない）"""
+    if si.backend.codec_stats is not None:
+        summary = si.backend.codec_stats.format_summary()
+        if summary is not None:
+            print >> sys.stderr, summary
+atexit.register(print_codec_summary)
+
+# 認識エンジンと状態の送信の接続をバックグラウンドで準備し，発話の無い間も保つ
+if conf.getboolean('system', 'prewarm'):
+    prewarmer = Prewarmer(startup, [('recognizer', si.backend), ('http', dispatcher)],
+                          interval_sec=conf.getfloat('system', 'keepalive_sec'))
+    prewarmer.start()
+else:
+    startup.report()
+
+
 while True:
-    result = q.get()
-    if 'recog_result' in result:
-        utt = result['recog_result']
-
-        if u'暇' in utt:
-            send('free')
-        elif u'忙' in utt:
-            send('busy')
+    dispatch_result(q.get(), dispatcher, si.tracer)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+u"""
+asr.py のイベントループ版．
+全てのマイクの発話待ちと認識結果の受け取りを1つのイベントループで行い，
+スレッドは認識中のセッション（最大 [pyaudio] max_sessions 個）と送信にだけ使う．
+"""
+
+import ConfigParser
+from concurrent.futures import ThreadPoolExecutor
+
+import trollius as asyncio
+from trollius import From
+
+from speech.aio import AsyncSpeechInputter
+from speech.inputter import create_pyaudio_stream, create_result_watcher, create_tracer, \
+    create_intent_matcher, dispatch_result
+from speech.asr import recognizer
+from speech.asr.prosody import create_prosody_extractor
+from speech.asr.archive import create_archive
+from speech.asr.watchdog import create_watchdog
+from speech.asr.metrics import create_metrics_server
+from send import StateDispatcher
+from state_scheduler import create_scheduler
+
+# load config
+conf_file_path =  './speech/conf.ini'
+conf = ConfigParser.SafeConfigParser()
+conf.read(conf_file_path)
+
+loop = asyncio.get_event_loop()
+events = asyncio.Queue(loop=loop)
+executor = ThreadPoolExecutor(conf.getint('pyaudio', 'max_sessions'))
+backend = recognizer.create_backend(conf)
+result_watcher = create_result_watcher(conf)
+tracer = create_tracer(conf)
+stall_watchdog = create_watchdog(conf)
+# F0 と RMS の計算のプールと発話のアーカイブは全てのマイクで共有する
+prosody_extractor = create_prosody_extractor(conf)
+utterance_archive = create_archive(conf)
+intent_matcher = create_intent_matcher(conf)
+
+devices = [d.strip() for d in conf.get('pyaudio', 'devices').split(',') if d.strip()]
+audio_streams = []
+if devices:
+    import pyaudio
+    audio_interface = pyaudio.PyAudio()
+    for device in devices:
+        audio_streams.append(create_pyaudio_stream(conf, tracer=tracer,
+                                                   audio_interface=audio_interface,
+                                                   device=device))
+else:
+    audio_streams.append(create_pyaudio_stream(conf, tracer=tracer))
+
+inputters = [AsyncSpeechInputter(conf, audio_stream=audio_stream, backend=backend,
+                                 result_watcher=result_watcher, tracer=tracer,
+                                 events=events, loop=loop, executor=executor,
+                                 stall_watchdog=stall_watchdog,
+                                 prosody_extractor=prosody_extractor,
+                                 utterance_archive=utterance_archive,
+                                 intent_matcher=intent_matcher)
+             for audio_stream in audio_streams]
+# 状態の送信はバックグラウンドで行い，認識結果の受け取りを止めない
+dispatcher = StateDispatcher()
+# cui.py --minute / --hour の時限更新を同じ接続で送る
+scheduler = create_scheduler(conf, dispatcher)
+if scheduler is not None:
+    scheduler.start()
+# 実行中の数値を [metrics] の host:port で公開する
+metrics_server = create_metrics_server(conf)
+
+
+@asyncio.coroutine
+def main():
+    for inputter in inputters:
+        loop.create_task(inputter.run())
+    while True:
+        result = yield From(events.get())
+        dispatch_result(result, dispatcher, tracer)
+
+
+loop.run_until_complete(main())
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+u"""
+多数のクライアント（マイクを持つ端末）から TCP で音声を受け取って認識するサーバーモード．
+1台で複数の席の音声を認識し，認識結果と抽出した状態を JSON の行として各クライアントに返す
+（プロトコルは speech/asr/network.py，設定は conf.ini の [server]）．
+状態の送信はクライアント側で行う．
+
+    python asr_server.py
+    python -m speech.asr.network 127.0.0.1:9200 sample.wav    # ループバックで確かめる
+"""
+
+import sys
+import ConfigParser
+
+from speech.server import IngestServer
+from speech.asr.metrics import create_metrics_server
+
+# load config
+conf_file_path =  './speech/conf.ini'
+conf = ConfigParser.SafeConfigParser()
+conf.read(conf_file_path)
+
+server = IngestServer(conf)
+# 実行中の数値を [metrics] の host:port で公開する
+metrics_server = create_metrics_server(conf)
+print >> sys.stderr, "LISTENING: %s:%d" % server.address
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    server.close()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+u"""
+録音済み音声ファイルをまとめて認識するバッチ認識モード
+
+    python batch_asr.py DIR_OR_MANIFEST [--workers N] [--output FILE] [--speed X]
+
+DIR_OR_MANIFEST にはディレクトリ（中の .wav/.raw をファイル名順に処理する）か，
+1行に1ファイルのパスを書いたマニフェストファイルを与える．
+発話のアーカイブ（[archive]）のディレクトリを与えた場合は，保存されている発話を古い順に処理する．
+Audio ID はファイルの並び順（1始まり）になる．
+--speed を与えると，各ファイルを録音時の X 倍の速さで認識エンジンに流す（0 は待たない）．
+"""
+
+import os
+import sys
+import argparse
+import ConfigParser
+import threading
+from Queue import Queue, Empty
+
+from speech.inputter import SpeechInputter, create_intent_matcher
+from speech.asr.audio_stream import FileAudioStream
+from speech.asr.result_watcher import StdoutResultWatcherForAnalysis
+from speech.asr.recognizer import CachingRecognizerBackend, create_backend
+from speech.asr.prosody import create_prosody_extractor
+from speech.asr.archive import INDEX_FILE, read_index, create_archive
+
+AUDIO_EXTENSIONS = ('.wav', '.raw')
+
+
+def load_file_list(dir_or_manifest):
+    u"""ディレクトリかマニフェストファイルから，認識するファイルのリストを作る"""
+    if os.path.isfile(os.path.join(dir_or_manifest, INDEX_FILE)):
+        return read_index(dir_or_manifest)
+    if os.path.isdir(dir_or_manifest):
+        return [os.path.join(dir_or_manifest, name)
+                for name in sorted(os.listdir(dir_or_manifest))
+                if os.path.splitext(name)[1] in AUDIO_EXTENSIONS]
+    base_dir = os.path.dirname(dir_or_manifest)
+    file_list = []
+    with open(dir_or_manifest) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                file_list.append(os.path.join(base_dir, line))
+    return file_list
+
+
+class BatchWorker(threading.Thread):
+    u"""タスクキューが空になるまでファイルを1つずつ取り出して認識する"""
+
+    def __init__(self, conf, tasks, result_watcher, backend, speed=0.0, prosody_extractor=None,
+                 utterance_archive=None, intent_matcher=None):
+        super(BatchWorker, self).__init__()
+        self.daemon = True
+        self.conf = conf
+        self.tasks = tasks
+        self.result_watcher = result_watcher
+        self.backend = backend
+        self.speed = speed
+        self.prosody_extractor = prosody_extractor
+        self.utterance_archive = utterance_archive
+        self.intent_matcher = intent_matcher
+
+    def run(self):
+        while True:
+            try:
+                audio_id, filename = self.tasks.get_nowait()
+            except Empty:
+                return
+            # Audio ID がファイルの並び順になるようにする
+            audio_stream = FileAudioStream(filename, audio_id_offset=audio_id - 1,
+                                           speed=self.speed)
+            inputter = SpeechInputter(self.conf, audio_stream=audio_stream,
+                                      result_watcher=self.result_watcher,
+                                      backend=self.backend,
+                                      prosody_extractor=self.prosody_extractor,
+                                      utterance_archive=self.utterance_archive,
+                                      intent_matcher=self.intent_matcher)
+            try:
+                inputter.run()
+            except Exception as e:
+                print >> sys.stderr, "FAILED: %s (AUDIO ID=%d): %s" % (filename, audio_id, e)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', help='directory or manifest file')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--output', help='output file (default: stdout)')
+    parser.add_argument('--speed', type=float,
+                        help='replay speed factor (0: as fast as possible)')
+    parser.add_argument('--conf', default='./speech/conf.ini')
+    args = parser.parse_args()
+
+    conf = ConfigParser.SafeConfigParser()
+    conf.read(args.conf)
+    workers = args.workers or conf.getint('batch', 'workers')
+    speed = args.speed if args.speed is not None else conf.getfloat('batch', 'speed')
+
+    tasks = Queue()
+    for i, filename in enumerate(load_file_list(args.input)):
+        tasks.put((i + 1, filename))
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    result_watcher = StdoutResultWatcherForAnalysis(out)
+    # F0 と RMS の計算は全ワーカーで1つのプールを使う
+    prosody_extractor = create_prosody_extractor(conf)
+    utterance_archive = create_archive(conf)
+    # 認識エンジンも全ワーカーで共有する（キャッシュの索引と削除を1か所で行うため）
+    backend = create_backend(conf)
+    # キーワード表はファイルごとに読み直さない
+    intent_matcher = create_intent_matcher(conf)
+    threads = [BatchWorker(conf, tasks, result_watcher, backend, speed, prosody_extractor,
+                           utterance_archive, intent_matcher)
+               for _ in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if backend.codec_stats is not None:
+        summary = backend.codec_stats.format_summary()
+        if summary is not None:
+            print >> sys.stderr, summary
+    if isinstance(backend, CachingRecognizerBackend):
+        print >> sys.stderr, backend.format_stats()
+    if prosody_extractor is not None:
+        # 残りの結果が出力されるのを待つ
+        prosody_extractor.shutdown()
+    if utterance_archive is not None:
+        utterance_archive.close()
+    if out is not sys.stdout:
+        out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+u"""
+音声入力のホットパスのベンチマーク
+
+仮想入力デバイス（fake_pyaudio）からコーパスの音声を PyAudioStream.read_callback に流し，
+以下を計測して JSON で出力する．
+
+    vad_accuracy  合成発話に対する VAD の発話開始・終了検知の誤差
+    capture       コールバックの処理時間（実時間・CPU時間），バッファの深さ，
+                  read() が待ちから起こされるまでの時間
+    end_to_end    SpeechInputter（ローカル認識エンジン）を通した1秒あたりの発話数
+
+    python benchmarks/bench_audio_stream.py [--corpus DIR] [--speed 4] [--jitter-ms 1]
+                                            [--duration 10] [--output result.json]
+"""
+
+import os
+import sys
+import argparse
+import bisect
+import ConfigParser
+import json
+from Queue import Queue, Empty
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from fake_pyaudio import FakePyAudio, install_pyaudio_module, load_wav, synthesize
+# PyAudio が無い環境でも動くよう，speech.asr.audio_stream を import する前に登録する
+install_pyaudio_module()
+
+from speech.inputter import SpeechInputter
+from speech.asr.audio_stream import PyAudioStream
+from speech.asr.clock import monotonic
+from speech.asr.recognizer import LocalRecognizerBackend
+from speech.asr.result_watcher import CombinedResultWatcher
+import speech.asr.vad as vad
+
+
+def describe(values, scale=1.0):
+    u"""平均・p50・p95・p99・最大を返す"""
+    if len(values) == 0:
+        return None
+    values = np.asarray(values, dtype=np.float64) * scale
+    return {'count': len(values),
+            'mean': float(np.mean(values)),
+            'p50': float(np.percentile(values, 50)),
+            'p95': float(np.percentile(values, 95)),
+            'p99': float(np.percentile(values, 99)),
+            'max': float(np.max(values))}
+
+
+def bench_vad_accuracy(conf, corpus, rate, chunk_size):
+    u"""ラベル付きの発話に対して，VADが発話開始・終了を検知した時刻の誤差（ミリ秒）を計測する"""
+    labeled = [u for u in corpus if u.onset_sec is not None]
+    chunk_sec = chunk_size / float(rate)
+    results = {}
+    for name in ('fixed', 'adaptive'):
+        conf.set('pyaudio', 'vad', name)
+        engine = vad.create_vad(conf, rate, chunk_size)
+        onset_errors, offset_errors, missed, false_onsets = [], [], 0, 0
+        for utterance in labeled:
+            engine.reset()
+            onset_time = offset_time = None
+            data = utterance.samples.tostring()
+            for i in range(len(utterance.samples) // chunk_size):
+                state = engine.process(data[(i * chunk_size * 2):((i + 1) * chunk_size * 2)])
+                now = (i + 1) * chunk_sec
+                if state == vad.ONSET:
+                    onset_time = now
+                elif state == vad.OFFSET:
+                    offset_time = now
+                    break
+            if onset_time is None:
+                missed += 1
+                continue
+            if onset_time < utterance.onset_sec:
+                false_onsets += 1
+            onset_errors.append(onset_time - utterance.onset_sec)
+            if offset_time is not None:
+                offset_errors.append(offset_time - utterance.offset_sec)
+        results[name] = {'utterances': len(labeled),
+                         'missed': missed,
+                         'false_onsets': false_onsets,
+                         'onset_error_ms': describe(onset_errors, 1000.0),
+                         'offset_error_ms': describe(offset_errors, 1000.0)}
+    return results
+
+
+def create_stream(conf, corpus, rate, chunk_size, speed, jitter_sec):
+    fake = FakePyAudio(corpus, speed=speed, jitter_sec=jitter_sec)
+    stream = PyAudioStream(rate,
+                           chunk_size=chunk_size,
+                           logpower_thresh=conf.getfloat('pyaudio', 'logpower_thresh'),
+                           vad=vad.create_vad(conf, rate, chunk_size),
+                           buffer_sec=conf.getfloat('pyaudio', 'buffer_sec'),
+                           audio_interface=fake)
+    return fake, stream
+
+
+def bench_capture(conf, corpus, rate, chunk_size, read_size, speed, jitter_sec, duration):
+    u"""認識エンジンの代わりに read() を呼び続け，キャプチャ経路のコストを計測する"""
+    fake, stream = create_stream(conf, corpus, rate, chunk_size, speed, jitter_sec)
+    device = None
+    wakeup_latencies = []
+    buffer_depths = []
+    utterances = 0
+    end_time = monotonic() + duration
+    while monotonic() < end_time:
+        stream.start()
+        device = fake.streams[-1]
+        with stream.cond:
+            while not stream.vad_started and monotonic() < end_time:
+                stream.cond.wait(0.1)
+        if not stream.vad_started:
+            break
+        while True:
+            if monotonic() >= end_time and not stream.vad_finished:
+                # 発話終了を検知しない VAD でも時間内に終える（認識側の打ち切りと同じ）
+                stream.finish_vad()
+            # 待ちに入る前に届いていたコールバックより後に届いたもので起こされた場合のみ数える
+            called = monotonic()
+            data = stream.read(read_size)
+            returned = monotonic()
+            if data is None:
+                break
+            ends = device.callback_end_times
+            index = bisect.bisect_right(ends, returned) - 1
+            if index >= 0 and ends[index] > called:
+                wakeup_latencies.append(returned - ends[index])
+            buffer_depths.append(stream.buffer_depth)
+        stream.stop()
+        utterances += 1
+    stream.close()
+    audio_sec = sum(s.position_sec for s in fake.streams)
+    return {'utterances': utterances,
+            'audio_sec': audio_sec,
+            'callback_wall_us': describe(sum([s.callback_durations for s in fake.streams], []), 1e6),
+            'callback_cpu_us': describe(sum([s.callback_cpu_times for s in fake.streams], []), 1e6),
+            'buffer_depth_bytes': describe(buffer_depths),
+            'read_wakeup_latency_us': describe(wakeup_latencies, 1e6)}
+
+
+def bench_end_to_end(conf, corpus, rate, chunk_size, read_size, speed, jitter_sec, duration):
+    u"""ローカル認識エンジンを使って SpeechInputter を通した発話のスループットを計測する"""
+    fake, stream = create_stream(conf, corpus, rate, chunk_size, speed, jitter_sec)
+    backend = LocalRecognizerBackend([u'ベンチマーク'], chunk_size=read_size,
+                                     interim_interval_sec=0.1)
+    inputter = SpeechInputter(conf, audio_stream=stream,
+                              result_watcher=CombinedResultWatcher(), backend=backend)
+    inputter.daemon = True
+    q = Queue()
+    inputter.set_q(q)
+
+    latencies = []
+    utterances = 0
+    started = {}
+    begin = monotonic()
+    inputter.start()
+    while True:
+        remaining = begin + duration - monotonic()
+        if remaining <= 0:
+            break
+        try:
+            result = q.get(timeout=remaining)
+        except Empty:
+            break
+        if result['type'] == 'recog_start':
+            started[result['audio_id']] = monotonic()
+        elif result['type'] in ('recog_result', 'recog_end') and result['audio_id'] in started:
+            latencies.append(monotonic() - started.pop(result['audio_id']))
+            utterances += 1
+    elapsed = monotonic() - begin
+    # 認識スレッドは待ちのまま残るので，入力デバイスだけ止める
+    fake.terminate()
+    audio_sec = sum(s.position_sec for s in fake.streams)
+    return {'utterances': utterances,
+            'elapsed_sec': elapsed,
+            'utterances_per_sec': utterances / elapsed,
+            'audio_sec_per_sec': audio_sec / elapsed,
+            'utterance_wall_ms': describe(latencies, 1000.0)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--corpus', help='directory of 16bit mono WAV files '
+                                         '(default: synthesized utterances)')
+    parser.add_argument('--synthetic', type=int, default=20,
+                        help='number of synthesized utterances')
+    parser.add_argument('--speed', type=float, default=4.0,
+                        help='replay speed factor (0: as fast as possible)')
+    parser.add_argument('--jitter-ms', type=float, default=1.0)
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds per capture / end-to-end run')
+    parser.add_argument('--output', help='output JSON file (default: stdout)')
+    parser.add_argument('--conf', default='./speech/conf.ini')
+    args = parser.parse_args()
+
+    conf = ConfigParser.SafeConfigParser()
+    conf.read(args.conf)
+    rate = conf.getint('pyaudio', 'sample_rate')
+    chunk_size = conf.getint('pyaudio', 'chunk_size')
+    read_size = conf.getint('local_backend', 'chunk_size')
+    jitter_sec = args.jitter_ms / 1000.0
+
+    corpus = synthesize(rate, args.synthetic)
+    if args.corpus:
+        recorded = [load_wav(os.path.join(args.corpus, name))
+                    for name in sorted(os.listdir(args.corpus)) if name.endswith('.wav')]
+        for utterance in recorded:
+            if utterance.rate != rate:
+                raise ValueError('%s: sample rate %d does not match %d'
+                                 % (utterance.name, utterance.rate, rate))
+        corpus = recorded + corpus
+
+    vad_mode = conf.get('pyaudio', 'vad')
+    result = {
+        'config': {'rate': rate, 'chunk_size': chunk_size, 'read_size': read_size,
+                   'vad': vad_mode, 'speed': args.speed, 'jitter_ms': args.jitter_ms,
+                   'duration_sec': args.duration, 'corpus_utterances': len(corpus)},
+        'vad_accuracy': bench_vad_accuracy(conf, corpus, rate, chunk_size),
+    }
+    conf.set('pyaudio', 'vad', vad_mode)
+    result['capture'] = bench_capture(conf, corpus, rate, chunk_size, read_size,
+                                      args.speed, jitter_sec, args.duration)
+    result['end_to_end'] = bench_end_to_end(conf, corpus, rate, chunk_size, read_size,
+                                            args.speed, jitter_sec, args.duration)
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(result, out, indent=2, sort_keys=True)
+    out.write('\n')
+    if out is not sys.stdout:
+        out.close()
+
+
+if __name__ == '__main__':
+    main()
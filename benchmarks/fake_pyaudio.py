@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+u"""
+ベンチマーク用の仮想 PyAudio 入力デバイス
+
+PyAudioStream(audio_interface=FakePyAudio(corpus, ...)) のように与えると，
+マイクの代わりにコーパスの音声を stream_callback に流し込む．
+PyAudio が入っていない環境（CI など）では，speech.asr.audio_stream を import する前に
+install_pyaudio_module() を呼ぶ．
+"""
+
+import random
+import sys
+import threading
+import time
+import types
+import wave
+
+import numpy as np
+
+from speech.asr.clock import monotonic
+
+
+class Utterance(object):
+    u"""
+    コーパスの1発話分の音声．
+    onset_sec / offset_sec が分かっている場合（合成音声）は VAD の精度評価に使う．
+    """
+
+    def __init__(self, samples, rate, onset_sec=None, offset_sec=None, name=None):
+        self.samples = samples
+        self.rate = rate
+        self.onset_sec = onset_sec
+        self.offset_sec = offset_sec
+        self.name = name
+
+
+def load_wav(filename):
+    u"""16bit モノラルの WAV を読み込む"""
+    handle = wave.open(filename, 'r')
+    try:
+        rate = handle.getframerate()
+        samples = np.frombuffer(handle.readframes(handle.getnframes()), dtype=np.int16)
+    finally:
+        handle.close()
+    return Utterance(samples, rate, name=filename)
+
+
+def synthesize(rate, n, silence_sec=1.0, speech_sec=1.5, noise_level=30.0,
+               speech_level=3000.0, seed=0):
+    u"""
+    雑音 + 調波音 + 雑音からなる合成発話を n 個作る．
+    発話区間（onset_sec, offset_sec）が正確に分かっているので VAD の精度評価に使える．
+    """
+    rng = np.random.RandomState(seed)
+    corpus = []
+    for i in range(n):
+        lead = silence_sec * rng.uniform(0.5, 1.5)
+        length = speech_sec * rng.uniform(0.5, 1.5)
+        total = int((lead + length + silence_sec) * rate)
+        samples = rng.normal(0.0, noise_level, total)
+        begin, end = int(lead * rate), int((lead + length) * rate)
+        t = np.arange(end - begin) / float(rate)
+        f0 = rng.uniform(100.0, 250.0)
+        voiced = sum(np.sin(2 * np.pi * f0 * k * t) / k for k in range(1, 6))
+        # 立ち上がり・立ち下がりを滑らかにする
+        envelope = np.minimum(1.0, np.minimum(t, t[-1] - t) / 0.05)
+        samples[begin:end] += speech_level * envelope * voiced
+        corpus.append(Utterance(np.clip(samples, -32768, 32767).astype(np.int16),
+                                rate, lead, lead + length, name='synth-%d' % i))
+    return corpus
+
+
+class FakeInputStream(object):
+    u"""
+    コーパスの音声を frames_per_buffer サンプルずつ stream_callback に渡す仮想入力ストリーム．
+    speed 倍速で流し（0 の場合は待たずに流す），各コールバックの時刻には標準偏差 jitter_sec の
+    揺らぎを加える．コーパスは最後まで流したら先頭に戻る．
+    """
+
+    def __init__(self, corpus, rate, frames_per_buffer, stream_callback,
+                 speed=1.0, jitter_sec=0.0, seed=0):
+        self.__data = np.concatenate([u.samples for u in corpus]).astype(np.int16).tostring()
+        self.__rate = rate
+        self.__frames_per_buffer = frames_per_buffer
+        self.__callback = stream_callback
+        self.__speed = speed
+        self.__jitter_sec = jitter_sec
+        self.__random = random.Random(seed)
+        self.__position = 0
+        self.__active = False
+        self.__thread = None
+        # 計測結果
+        self.callback_durations = []
+        self.callback_cpu_times = []
+        self.callback_end_times = []
+
+    @property
+    def position_sec(self):
+        u"""これまでに流した音声の長さ（秒）"""
+        return self.__position / 2 / float(self.__rate)
+
+    def is_active(self):
+        return self.__active
+
+    def start_stream(self):
+        if self.__active:
+            return
+        self.__active = True
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop_stream(self):
+        self.__active = False
+        if self.__thread is not None and self.__thread is not threading.current_thread():
+            self.__thread.join()
+        self.__thread = None
+
+    def close(self):
+        self.stop_stream()
+
+    def __run(self):
+        chunk_bytes = self.__frames_per_buffer * 2
+        period = self.__frames_per_buffer / float(self.__rate)
+        deadline = monotonic()
+        while self.__active:
+            if self.__speed > 0:
+                deadline += period / self.__speed
+                delay = deadline - monotonic()
+                if self.__jitter_sec > 0:
+                    delay += self.__random.gauss(0.0, self.__jitter_sec)
+                if delay > 0:
+                    time.sleep(delay)
+            if self.__position + chunk_bytes > len(self.__data):
+                self.__position = 0
+            in_data = self.__data[self.__position:(self.__position + chunk_bytes)]
+            self.__position += chunk_bytes
+
+            cpu_start = time.clock()
+            start = monotonic()
+            self.__callback(in_data, self.__frames_per_buffer, {}, 0)
+            end = monotonic()
+            self.callback_cpu_times.append(time.clock() - cpu_start)
+            self.callback_durations.append(end - start)
+            self.callback_end_times.append(end)
+
+
+class FakePyAudio(object):
+    u"""pyaudio.PyAudio の代わりに PyAudioStream に与える仮想オーディオインタフェース"""
+
+    def __init__(self, corpus, speed=1.0, jitter_sec=0.0, seed=0):
+        self.__corpus = corpus
+        self.__speed = speed
+        self.__jitter_sec = jitter_sec
+        self.__seed = seed
+        self.streams = []
+
+    def open(self, format, channels, rate, input=True, frames_per_buffer=1024,
+             start=True, stream_callback=None, **kwargs):
+        stream = FakeInputStream(self.__corpus, rate, frames_per_buffer, stream_callback,
+                                 speed=self.__speed, jitter_sec=self.__jitter_sec,
+                                 seed=self.__seed)
+        self.streams.append(stream)
+        if start:
+            stream.start_stream()
+        return stream
+
+    def terminate(self):
+        for stream in self.streams:
+            stream.close()
+
+
+def install_pyaudio_module():
+    u"""
+    pyaudio が import できない場合は，PyAudioStream が使う定数（値は PortAudio のもの）だけを
+    持つ pyaudio モジュールを sys.modules に登録する．PyAudio() は無いので，
+    PyAudioStream には必ず audio_interface（FakePyAudio）を与える
+    """
+    try:
+        import pyaudio
+    except ImportError:
+        module = types.ModuleType('pyaudio')
+        module.paInt16 = 0x00000008
+        module.paContinue = 0
+        module.paInputOverflow = 0x00000002
+        sys.modules['pyaudio'] = module
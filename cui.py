@@ -1,16 +1,42 @@
 # -*- coding: utf-8 -*-
 
+import os
+import sys
+import time
 import argparse
-import requests
-from send import send
-
-url = 'https://cm-hackathon-s-rmomo63.c9users.io/test'
+import ConfigParser
 
 parser = argparse.ArgumentParser()
 
 parser.add_argument('state', choices=['free', 'busy'])
+# 指定した時間が過ぎたら反対の状態に戻す（asr.py か state_scheduler.py が送る）
 parser.add_argument('--minute', type=int)
 parser.add_argument('--hour' , type=int)
 args = parser.parse_args()
 
-send(args.state)
\ No newline at end of file
+# requests の import は引数が正しい場合のみ行う
+from send import StateDispatcher
+from state_scheduler import create_journal, opposite_state
+
+# どのディレクトリから実行しても同じ設定とジャーナルを使う
+conf_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'speech', 'conf.ini')
+conf = ConfigParser.SafeConfigParser()
+conf.read(conf_file_path)
+
+# 以前の時限更新は取り消し，時間の指定があれば期限に戻す遷移を書く．
+# ジャーナルを使えなくても，状態は今すぐ送る
+duration = (args.minute or 0) * 60 + (args.hour or 0) * 3600
+if duration > 0 or conf.has_section('schedule'):
+    try:
+        journal = create_journal(conf)
+        if duration > 0:
+            journal.add(opposite_state(args.state), time.time() + duration)
+        else:
+            journal.cancel()
+    except (ConfigParser.Error, IOError, OSError) as e:
+        print >> sys.stderr, "SCHEDULE ERROR:", e
+
+dispatcher = StateDispatcher()
+dispatcher.submit(args.state)
+# 送信し終えてから終了する
+dispatcher.close()
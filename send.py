@@ -1,15 +1,245 @@
-# -*- coding: utf-8 -*- 
+# -*- coding: utf-8 -*-
+
+import sys
+import threading
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from speech.asr import metrics
+from speech.asr.clock import monotonic
+
+URL = 'https://cm-hackathon-s-rmomo63.c9users.io/test'
+STATES = ('free', 'busy')
+
+SEND_SECONDS = metrics.histogram('state_send_seconds', u'状態の送信1回（再送を含まない）にかかった時間')
+SEND_RETRIES = metrics.counter('state_send_retries_total', u'状態の送信を再送した回数')
+SEND_FAILURES = metrics.counter('state_send_failures_total', u'再送しても状態を送信できなかった回数')
+
+
+class StateDispatcher(object):
+    u"""
+    状態の更新をバックグラウンドスレッドで送信する．
+
+    submit() はすぐに返る．送信待ちの状態は常に最新の1つだけを保持し（古いものは捨てる），
+    送信中の状態や，直近 dedup_sec 秒以内に送信できた状態と同じ状態は送信しない
+    （早期確定と最終結果で同じ状態が続けて来る場合など）．それより前に送った状態とは比べない
+    （cui.py など別のプロセスがサーバーの状態を変えているかもしれないため）．
+    HTTP 接続は Session で使い回し，失敗した場合はタイムアウト付きで
+    backoff 秒から倍々に（最大 max_backoff 秒）待ちながら max_retries 回まで再送する．
+    再送を待っている間に新しい状態が来た場合は，そちらを送る．
+    warm_up() で，最初の送信の前に接続（TLS を含む）を済ませておける．
+    warm_up() の HEAD リクエストも送信と同じ Session を使うので，送信とは同時に行わない．
+    """
+
+    def __init__(self, url=URL, timeout=3.0, max_retries=3, backoff=0.5, max_backoff=8.0,
+                 dedup_sec=3.0):
+        self.url = url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.dedup_sec = dedup_sec
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.__cond = threading.Condition()
+        # 送信待ちの状態と，その送信が終わったときに呼ぶコールバックのリスト
+        self.__pending = None
+        self.__callbacks = []
+        self.__busy = False
+        # 送信中の状態と，同じ状態の submit() でその送信に相乗りしたコールバックのリスト
+        self.__in_flight = None
+        self.__in_flight_callbacks = []
+        # warm_up() の HEAD リクエスト中か（その間は送信を始めない）
+        self.__warming = False
+        self.__closed = False
+        # 最後に送信できた状態とその時刻（clock.monotonic）
+        self.__last_sent = None
+        self.__last_sent_at = None
+        self.stats = {'submitted': 0, 'sent': 0, 'coalesced': 0,
+                      'skipped': 0, 'retries': 0, 'failures': 0}
+
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def submit(self, state, on_done=None, force=False):
+        u"""
+        状態の送信を予約する．
+        on_done(state, ok) は，この状態（またはこれを置き換えた新しい状態）の送信が
+        終わったときに送信スレッドから呼ばれる．同じ状態の送信中に submit() した場合は
+        その送信の結果で，直近に送信済みで送らなかった場合はすぐに ok=True で呼ばれる．
+        送信中の状態と同じ状態を submit() した場合は，送信待ちの状態があってもそれを捨てる
+        （free の送信中に busy，free と来た場合に free を2回送らない）．
+        force が True の場合は，同じ状態でも submit() の後に必ず送信する
+        （時限更新など，他のプロセスが状態を変えたかもしれない場合）．
+        """
+        with self.__cond:
+            if self.__closed:
+                raise RuntimeError('dispatcher already closed')
+            self.stats['submitted'] += 1
+            skipped = False
+            if force:
+                duplicate = None
+            elif self.__busy and state == self.__in_flight:
+                duplicate = 'in_flight'
+            elif self.__pending is not None or self.__busy:
+                duplicate = None
+            elif state == self.__last_sent and \
+                    monotonic() - self.__last_sent_at < self.dedup_sec:
+                duplicate = 'recent'
+            else:
+                duplicate = None
+            if duplicate is not None:
+                # 同じ状態を続けて送る必要はない
+                self.stats['skipped'] += 1
+                if duplicate == 'in_flight':
+                    if self.__pending is not None:
+                        # 送信中の状態に戻ったので，送信待ちの状態は送らずにその送信の結果を返す
+                        self.stats['coalesced'] += 1
+                        self.__pending = None
+                        self.__in_flight_callbacks += self.__callbacks
+                        self.__callbacks = []
+                        self.__cond.notifyAll()
+                    if on_done is not None:
+                        self.__in_flight_callbacks.append(on_done)
+                else:
+                    skipped = True
+            else:
+                if self.__pending is not None:
+                    self.stats['coalesced'] += 1
+                self.__pending = state
+                if on_done is not None:
+                    self.__callbacks.append(on_done)
+                self.__cond.notifyAll()
+        if skipped and on_done is not None:
+            on_done(state, True)
+
+    def warm_up(self):
+        u"""
+        url に HEAD リクエストを送り，Session の HTTP 接続を開いておく．
+        切れていれば requests が開き直す（startup.Prewarmer から繰り返し呼ばれる）．
+        送信中か送信待ちの状態がある場合は，その送信で接続されるので何もしない．
+        HEAD の間に submit() された状態は，HEAD が終わってから送信する
+        """
+        with self.__cond:
+            if self.__busy or self.__pending is not None or self.__warming or self.__closed:
+                return
+            self.__warming = True
+        try:
+            self.session.head(self.url, timeout=self.timeout)
+        finally:
+            with self.__cond:
+                self.__warming = False
+                self.__cond.notifyAll()
+
+    def flush(self, timeout=None):
+        u"""送信待ちの状態が無くなるまで待つ．送信し終えたら True を返す"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.__cond:
+            while self.__pending is not None or self.__busy:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.__cond.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        u"""送信待ちの状態を送り終えてから停止する"""
+        self.flush(timeout)
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notifyAll()
+        self.__thread.join(timeout)
+        self.session.close()
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                while (self.__pending is None or self.__warming) and not self.__closed:
+                    self.__cond.wait()
+                if self.__pending is None:
+                    return
+                state = self.__pending
+                callbacks = self.__callbacks
+                self.__pending = None
+                self.__callbacks = []
+                self.__busy = True
+                self.__in_flight = state
+
+            ok = self.__send_with_retry(state)
+
+            with self.__cond:
+                self.__busy = False
+                self.__in_flight = None
+                callbacks += self.__in_flight_callbacks
+                self.__in_flight_callbacks = []
+                self.__cond.notifyAll()
+                if ok is None:
+                    # 新しい状態に置き換えられたので，コールバックはそちらの送信後に呼ぶ
+                    self.__callbacks[:0] = callbacks
+                    continue
+                if ok:
+                    self.__last_sent = state
+                    self.__last_sent_at = monotonic()
+            for callback in callbacks:
+                callback(state, ok)
+
+    def __send_with_retry(self, state):
+        u"""送信できたら True，諦めたら False，新しい状態に置き換えられたら None を返す"""
+        payload = {}
+        if state in STATES:
+            payload['state'] = state
+        wait = self.backoff
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                SEND_RETRIES.inc()
+                with self.__cond:
+                    self.stats['retries'] += 1
+                    # 待っている間に新しい状態が来たら，古い状態の再送はやめる
+                    self.__cond.wait(wait)
+                    if self.__pending is not None:
+                        return None
+                wait = min(wait * 2, self.max_backoff)
+            started = monotonic()
+            try:
+                r = self.session.get(url=self.url, params=payload, timeout=self.timeout)
+                SEND_SECONDS.observe(monotonic() - started)
+                if r.ok:
+                    with self.__cond:
+                        self.stats['sent'] += 1
+                    return True
+                if r.status_code < 500:
+                    # クライアント側の誤りなので再送しない
+                    break
+            except requests.RequestException as e:
+                print >> sys.stderr, "SEND ERROR:", e
+        SEND_FAILURES.inc()
+        with self.__cond:
+            self.stats['failures'] += 1
+        return False
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    u"""プロセス内で共有する StateDispatcher を返す"""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = StateDispatcher()
+        return _dispatcher
+
 
 def send(state):
-    payload = {}
-    url = 'https://cm-hackathon-s-rmomo63.c9users.io/test'
-    
-    if state == 'free':
-        payload['state'] = 'free'
-    elif state == 'busy':
-        payload['state'] = 'busy'
-    
-    r = requests.get(url=url, params=payload)
-    
+    u"""状態を送信し，送信し終えるまで待つ"""
+    dispatcher = get_dispatcher()
+    dispatcher.submit(state)
+    dispatcher.flush()
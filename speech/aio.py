@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+u"""
+イベントループ上で動く音声入力パイプライン（asr_async.py で使う）
+
+SpeechInputter はストリームごとにスレッドを1つ持ち，VADの開始（発話）を
+threading.Condition で待つ．ここではその待ちをイベントループ上のコルーチンに置き換え，
+1つのループで多数のストリームと結果の受け取りを扱えるようにする．
+
+Python 2 で動かすため，asyncio のバックポートである trollius を使う．
+認識エンジン（gRPC）と HTTP クライアントは同期 API しか無いので，認識中のセッションだけは
+executor のスレッドで動かす（発話の音声もそのスレッドで読む）．発話を待っている間は
+スレッドを使わない．
+
+    loop = asyncio.get_event_loop()
+    inputter = AsyncSpeechInputter(conf, loop=loop)
+    loop.create_task(inputter.run())
+    while True:
+        event = yield From(inputter.next_event())
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import trollius as asyncio
+from trollius import From, Return
+
+from inputter import SpeechInputter
+
+
+class AsyncAudioStream(object):
+    u"""
+    AudioStream をイベントループから待てるようにするラッパー．
+    書き込み側のスレッドからの通知を call_soon_threadsafe でループに渡す．
+    """
+
+    def __init__(self, audio_stream, loop=None):
+        self.audio_stream = audio_stream
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.__event = asyncio.Event(loop=self.loop)
+        audio_stream.add_listener(self.__on_notify)
+
+    def __on_notify(self):
+        self.loop.call_soon_threadsafe(self.__event.set)
+
+    @asyncio.coroutine
+    def wait_vad_started(self):
+        u"""VADが開始するまで待つ"""
+        while True:
+            self.__event.clear()
+            if self.audio_stream.vad_started:
+                return
+            yield From(self.__event.wait())
+
+    def close(self):
+        self.audio_stream.remove_listener(self.__on_notify)
+
+
+class _LoopQueue(object):
+    u"""SpeechInputter の q として渡し，認識スレッドからのイベントをループのキューに移す"""
+
+    def __init__(self, queue, loop):
+        self.__queue = queue
+        self.__loop = loop
+
+    def put(self, event):
+        self.__loop.call_soon_threadsafe(self.__queue.put_nowait, event)
+
+    def qsize(self):
+        return self.__queue.qsize()
+
+
+class AsyncSpeechInputter(object):
+    u"""
+    SpeechInputter のイベントループ版．
+    run() を1つのタスクとして動かし，next_event() で認識結果のイベント
+    （SpeechInputter がキューに入れるものと同じ辞書）を順に受け取る．
+    events（asyncio.Queue）を与えると，複数の入力器のイベントを1つのキューにまとめられる．
+    発話の認識は executor（省略時は max_sessions 個のスレッドのプール）で実行する．
+    複数の入力器を動かす場合は，prosody_extractor と utterance_archive を1つ作って全てに与える
+    （アーカイブは1つのディレクトリに1つしか開けない）．
+    """
+
+    def __init__(self, conf, audio_stream=None, backend=None, result_watcher=None,
+                 tracer=None, events=None, loop=None, executor=None, stall_watchdog=None,
+                 prosody_extractor=None, utterance_archive=None, intent_matcher=None):
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        if executor is None:
+            executor = ThreadPoolExecutor(conf.getint('pyaudio', 'max_sessions'))
+        self.executor = executor
+        if events is None:
+            events = asyncio.Queue(loop=self.loop)
+        self.__events = events
+        # 認識処理そのものは SpeechInputter のものを使う（スレッドとしては起動しない）
+        self.inputter = SpeechInputter(conf, audio_stream=audio_stream,
+                                       result_watcher=result_watcher, backend=backend,
+                                       tracer=tracer, stall_watchdog=stall_watchdog,
+                                       prosody_extractor=prosody_extractor,
+                                       utterance_archive=utterance_archive,
+                                       intent_matcher=intent_matcher)
+        self.inputter.set_q(_LoopQueue(self.__events, self.loop))
+        self.audio_stream = AsyncAudioStream(self.inputter.audio_stream, self.loop)
+
+    @property
+    def tracer(self):
+        return self.inputter.tracer
+
+    @asyncio.coroutine
+    def next_event(self):
+        u"""次のイベントを待って返す"""
+        event = yield From(self.__events.get())
+        raise Return(event)
+
+    @asyncio.coroutine
+    def listen(self):
+        u"""1発話分の認識を行う"""
+        audio_stream = self.audio_stream.audio_stream
+        audio_stream.start()
+        yield From(self.audio_stream.wait_vad_started())
+        yield From(self.loop.run_in_executor(
+            self.executor, self.inputter.recognize,
+            self.inputter.backend, audio_stream, self.inputter.result_watcher))
+
+    @asyncio.coroutine
+    def run(self):
+        while not self.audio_stream.audio_stream.closed:
+            try:
+                yield From(self.listen())
+            except RuntimeError as e:
+                print "NON FATAL ERROR:", e.message
@@ -0,0 +1,245 @@
+# encoding: utf-8
+u"""
+認識した発話の音声を保存するアーカイブ
+
+発話ごとにファイルを作る代わりに，あらかじめ確保した大きなセグメントファイル
+（seg-NNNNNN.pcm）に音声（16bit モノラルの raw）を追記し，index.dat に
+Audio ID・デバイス・時刻・セグメント・位置・長さ・認識結果を記録する．
+書き込みは専用のスレッドで行い，合計サイズが max_bytes を超えたら古いセグメントから消す．
+
+保存した発話は entries() で取り出せ，そのまま FileAudioStream に与えて再生できる．
+
+    archive = UtteranceArchive('./archive')
+    audio_stream = FileAudioStream(archive.entries())
+
+    python -m speech.asr.archive DIR    保存されている発話の一覧を表示する
+"""
+
+import os
+import sys
+import struct
+import threading
+import time
+from Queue import Queue, Full
+
+from pcm_file import PcmFile
+
+# 索引の1件: Audio ID, 時刻, セグメント番号, 位置, 長さ, サンプリングレート,
+# デバイス名の長さ, 認識結果の長さ（この後にデバイス名と認識結果が utf-8 で続く）
+INDEX_RECORD = struct.Struct('<IdIQIIHH')
+INDEX_FILE = 'index.dat'
+
+
+def segment_filename(directory, segment):
+    return os.path.join(directory, 'seg-%06d.pcm' % segment)
+
+
+class ArchiveEntry(object):
+    u"""保存された1発話．open() で音声を PcmFile として開ける"""
+
+    def __init__(self, directory, audio_id, timestamp, segment, offset, length,
+                 sample_rate, device, transcript):
+        self.directory = directory
+        self.audio_id = audio_id
+        self.timestamp = timestamp
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+        self.sample_rate = sample_rate
+        self.device = device
+        self.transcript = transcript
+
+    def open(self):
+        return PcmFile(segment_filename(self.directory, self.segment),
+                       raw_sample_rate=self.sample_rate, offset=self.offset,
+                       length=self.length)
+
+    def encode(self):
+        device = (self.device or u'').encode('utf-8')
+        transcript = (self.transcript or u'').encode('utf-8')
+        return INDEX_RECORD.pack(self.audio_id, self.timestamp, self.segment, self.offset,
+                                 self.length, self.sample_rate,
+                                 len(device), len(transcript)) + device + transcript
+
+    def __repr__(self):
+        return 'ArchiveEntry(%d, seg=%d, offset=%d, length=%d)' % (
+            self.audio_id, self.segment, self.offset, self.length)
+
+
+def read_index(directory):
+    u"""index.dat を読む．書き込み途中で切れた末尾の記録は無視する"""
+    entries = []
+    filename = os.path.join(directory, INDEX_FILE)
+    if not os.path.exists(filename):
+        return entries
+    with open(filename, 'rb') as f:
+        data = f.read()
+    pos = 0
+    while pos + INDEX_RECORD.size <= len(data):
+        audio_id, timestamp, segment, offset, length, sample_rate, device_len, text_len = \
+            INDEX_RECORD.unpack_from(data, pos)
+        pos += INDEX_RECORD.size
+        if pos + device_len + text_len > len(data):
+            break
+        device = data[pos:(pos + device_len)].decode('utf-8') or None
+        pos += device_len
+        transcript = data[pos:(pos + text_len)].decode('utf-8')
+        pos += text_len
+        entries.append(ArchiveEntry(directory, audio_id, timestamp, segment, offset, length,
+                                    sample_rate, device, transcript))
+    return entries
+
+
+class UtteranceArchive(object):
+    u"""
+    発話の音声の追記専用アーカイブ．
+    put() はキューに入れるだけで，書き込みは専用のスレッドで行う．
+    キューが一杯の場合は捨てて dropped を数える．
+    """
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024,
+                 max_bytes=1024 * 1024 * 1024, max_pending=64):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.__segment_bytes = segment_bytes
+        self.__max_bytes = max_bytes
+        self.__lock = threading.Lock()
+        self.__entries = read_index(directory)
+        # 既存のセグメントとその大きさ
+        self.__segments = {}
+        for name in os.listdir(directory):
+            if name.startswith('seg-') and name.endswith('.pcm'):
+                segment = int(name[4:-4])
+                self.__segments[segment] = os.path.getsize(os.path.join(directory, name))
+        # 書き込み中のセグメントと次に書く位置．再起動時は最も新しいセグメントの，
+        # 索引に記録された最後の発話の後から続ける（索引に無い末尾は書き込み途中のもの）
+        self.__segment = max(self.__segments.keys() or [0])
+        self.__write_offset = max([e.offset + e.length for e in self.__entries
+                                   if e.segment == self.__segment] or [0])
+        self.__index = open(os.path.join(directory, INDEX_FILE), 'ab')
+        self.dropped = 0
+        self.__queue = Queue(max_pending)
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def put(self, audio_id, data, transcript=u'', device=None, sample_rate=16000,
+            timestamp=None):
+        u"""発話の音声を保存する．data はここでコピーするので，呼び出し後に書き換えてよい"""
+        if timestamp is None:
+            timestamp = time.time()
+        try:
+            self.__queue.put_nowait((audio_id, bytes(data), transcript, device, sample_rate,
+                                     timestamp))
+        except Full:
+            with self.__lock:
+                self.dropped += 1
+
+    def entries(self, device=None):
+        u"""保存されている発話（古い順）．device を与えた場合はそのデバイスのもののみ"""
+        with self.__lock:
+            entries = list(self.__entries)
+        if device is not None:
+            entries = [e for e in entries if e.device == device]
+        return entries
+
+    def find(self, audio_id, device=None):
+        u"""Audio ID の発話のうち最も新しいもの．無ければ None"""
+        for entry in reversed(self.entries(device)):
+            if entry.audio_id == audio_id:
+                return entry
+        return None
+
+    @property
+    def total_bytes(self):
+        with self.__lock:
+            return sum(self.__segments.values())
+
+    def __new_segment(self, size):
+        self.__segment += 1
+        # セグメントは最初に大きさを確保しておき，以降は中に書き込むだけにする
+        with open(segment_filename(self.directory, self.__segment), 'wb') as f:
+            f.truncate(size)
+        with self.__lock:
+            self.__segments[self.__segment] = size
+        self.__write_offset = 0
+        self.__evict()
+
+    def __evict(self):
+        u"""合計サイズが max_bytes を超えていたら，書き込み中のもの以外の古いセグメントを消す"""
+        while True:
+            with self.__lock:
+                if sum(self.__segments.values()) <= self.__max_bytes or \
+                   len(self.__segments) <= 1:
+                    return
+                oldest = min(self.__segments)
+                del self.__segments[oldest]
+                self.__entries = [e for e in self.__entries if e.segment != oldest]
+                entries = list(self.__entries)
+            os.remove(segment_filename(self.directory, oldest))
+            # 索引も書き直す（発話数に比例する小さなファイル）
+            self.__index.close()
+            filename = os.path.join(self.directory, INDEX_FILE)
+            with open(filename + '.tmp', 'wb') as f:
+                f.write(b''.join(e.encode() for e in entries))
+            os.rename(filename + '.tmp', filename)
+            self.__index = open(filename, 'ab')
+
+    def __write(self, audio_id, data, transcript, device, sample_rate, timestamp):
+        length = len(data)
+        if self.__segment == 0 or \
+           self.__write_offset + length > self.__segments.get(self.__segment, 0):
+            self.__new_segment(max(self.__segment_bytes, length))
+        with open(segment_filename(self.directory, self.__segment), 'r+b') as f:
+            f.seek(self.__write_offset)
+            f.write(data)
+        # 音声を書いてから索引に記録する
+        entry = ArchiveEntry(self.directory, audio_id, timestamp, self.__segment,
+                             self.__write_offset, length, sample_rate, device, transcript)
+        self.__index.write(entry.encode())
+        self.__index.flush()
+        self.__write_offset += length
+        with self.__lock:
+            self.__entries.append(entry)
+
+    def __run(self):
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                return
+            try:
+                self.__write(*item)
+            except (IOError, OSError) as e:
+                print >> sys.stderr, "ARCHIVE ERROR:", e
+
+    def close(self, timeout=None):
+        u"""キューに残っている発話を書き込んでから終了する"""
+        self.__queue.put(None)
+        self.__thread.join(timeout)
+        self.__index.close()
+
+
+def create_archive(conf):
+    u"""conf.ini の [archive] が有効なら UtteranceArchive を作成する"""
+    if not conf.has_section('archive') or not conf.getboolean('archive', 'enabled'):
+        return None
+    return UtteranceArchive(conf.get('archive', 'directory'),
+                            segment_bytes=int(conf.getfloat('archive', 'segment_mb') * 1024 * 1024),
+                            max_bytes=int(conf.getfloat('archive', 'max_mb') * 1024 * 1024))
+
+
+def main():
+    if len(sys.argv) != 2:
+        print >> sys.stderr, "usage: python -m speech.asr.archive DIR"
+        sys.exit(1)
+    for entry in read_index(sys.argv[1]):
+        line = u'%d\t%s\t%s\t%.2f\t%s' % (
+            entry.audio_id, entry.device or u'-',
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry.timestamp)),
+            entry.length / 2.0 / entry.sample_rate, entry.transcript)
+        print line.encode('utf-8')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,74 @@
 # encoding: utf-8
 from abc import ABCMeta, abstractmethod
 import threading
-import struct
+import weakref
 
 import pyaudio
 import numpy as np
-import time
-import wave
-from os import path
+
+from vad import LogPowerVad, SILENCE, ONSET, SPEECH, OFFSET
+from ring_buffer import RingBuffer
+from tracing import trace_key
+from pcm_file import PcmFile
+from clock import ReplayClock, monotonic
+import metrics
+
+# コールバックの処理時間のバケット（秒）．10ms ごとに呼ばれるので細かく分ける
+CALLBACK_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+
+
+class CaptureMetrics(object):
+    u"""
+    入力デバイスごとのコールバック・VAD・バッファのメトリクス．
+    ストリームを閉じたら close() で系列を消す（接続ごとのストリームの系列を残さない）
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.callback_sec = metrics.histogram(
+            'audio_callback_seconds', u'音声入力のコールバックの処理時間',
+            buckets=CALLBACK_BUCKETS, device=device)
+        self.overflows = metrics.counter(
+            'audio_input_overflows_total', u'PortAudio が入力のオーバーフローを報告した回数',
+            device=device)
+        self.vad_onsets = metrics.counter(
+            'vad_onsets_total', u'VADが発話の開始を検知した回数', device=device)
+        self.vad_offsets = metrics.counter(
+            'vad_offsets_total', u'VADが発話の終了を検知した回数', device=device)
+        self.buffer_full = metrics.counter(
+            'capture_buffer_full_total', u'バッファが一杯になり発話を打ち切った回数', device=device)
+        self.buffer_bytes = metrics.gauge(
+            'capture_buffer_bytes', u'バッファに溜まっていてまだ読まれていないバイト数',
+            device=device)
+        self.__series = [('audio_callback_seconds', self.callback_sec),
+                         ('audio_input_overflows_total', self.overflows),
+                         ('vad_onsets_total', self.vad_onsets),
+                         ('vad_offsets_total', self.vad_offsets),
+                         ('capture_buffer_full_total', self.buffer_full),
+                         ('capture_buffer_bytes', self.buffer_bytes)]
+
+    def watch_buffer(self, stream):
+        u"""
+        capture_buffer_bytes に stream.buffer_depth を公開する．
+        registry がストリームを生かし続けないよう，弱参照で持つ
+        """
+        ref = weakref.ref(stream)
+
+        def buffer_depth():
+            stream = ref()
+            return stream.buffer_depth if stream is not None else 0
+        self.buffer_bytes.set_function(buffer_depth)
+
+    def add(self, name, metric):
+        u"""close() で一緒に消す系列を加える"""
+        self.__series.append((name, metric))
+        return metric
+
+    def close(self):
+        u"""このデバイスの系列を消す．同じデバイス名で作り直された系列は消さない"""
+        for name, metric in self.__series:
+            metrics.remove(name, metric, device=self.device)
+
 
 class AudioStream(object):
     u"""
@@ -20,7 +81,8 @@ class AudioStream(object):
     (2) audio_stream.vad_started が True になるまで待つ．
     (3) client.sample(stream=audio_stream, ...) が呼ばれ，認識が開始される．
     (4) 結果を待つ．audio_stream.read() が None を返すとループを break する．
-    (5) audio_stream.ping() が呼ばれる．
+    (5) audio_stream.ping() が呼ばれる（結果が届いたことの通知．ストールの監視は
+        watchdog.StallWatchdog が行うので，ストリームは何もしなくてよい）．
     (6) audio_stream.single_utterance_required が True の場合は，is_final が True の認識結果が
         得られたら audio_stream.finish_vad() が呼ばれる．
     (7) (4)に戻る．
@@ -37,10 +99,11 @@ class AudioStream(object):
          以降の read() メソッドで None を返す機能．
     C. stop() メソッドで一旦全てを中断し，VAD開始からVAD終了までの音声データを get_data() 
        メソッドで返す機能．
-    D. （オプション）ping() メソッドがある閾値以上の間呼ばれなかった場合に，自身の
-       finish_vad()メソッドを呼び，認識をキャンセルする機能．
-       本機能は，stream_recognizeにおいて，開始から一定時間（4秒前後?）認識結果が出ないまま
-       放置するとその後の処理がストールすることがある（Google側のバグ?）ための応急処置である．
+    D. finish_vad() が他のスレッド（watchdog.StallWatchdog）から呼ばれても，待っている
+       read() を起こして None を返す機能．
+       stream_recognizeにおいて，開始から一定時間（4秒前後?）認識結果が出ないまま
+       放置するとその後の処理がストールすることがある（Google側のバグ?）ため，
+       StallWatchdog が結果の届かない発話を finish_vad() で打ち切る．
 
     sync_recognizeによる認識の場合は以下のように実行される．
 
@@ -59,6 +122,7 @@ class AudioStream(object):
         self.__cond = threading.Condition()
         self.__vad_started  = False
         self.__vad_finished = False
+        self.__listeners = []
         
     @property
     def single_utterance_required(self):
@@ -75,6 +139,14 @@ class AudioStream(object):
         """
         return True
 
+    @property
+    def content_available(self):
+        u"""
+        start() した時点で発話全体の音声が get_data() で取得できるかどうか
+        （録音済みのファイルなど．認識結果のキャッシュに使う）
+        """
+        return False
+
     @property
     def closed(self):
         u"""
@@ -90,6 +162,19 @@ class AudioStream(object):
         """
         return self._audio_id
 
+    @property
+    def device(self):
+        u"""
+        入力デバイスの名前．複数のデバイスを使う場合に，結果やAudio IDを区別するために使う．
+        デバイスを区別しない場合は None．
+        """
+        return None
+
+    @property
+    def trace_id(self):
+        u"""レイテンシ計測で発話を区別するためのID（デバイスごとに名前空間が分かれる）"""
+        return trace_key(self.device, self.audio_id)
+
     @property
     def cond(self):
         u"""
@@ -140,6 +225,29 @@ class AudioStream(object):
         u"""過去に読み込んだデータを取得する"""
         pass
 
+    def read_view(self, size):
+        u"""
+        read() と同じだが，コピーを避けられる場合は memoryview を返す．
+        返された値は次の read() / read_view() 呼び出しまで有効．
+        """
+        return self.read(size)
+
+    def add_listener(self, listener):
+        u"""
+        状態変化やデータの書き込みを cond で通知する時に，あわせて呼ばれる関数を登録する．
+        書き込み側のスレッドから cond を保持したまま呼ばれるので，すぐに返すこと．
+        """
+        self.__listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.__listeners.remove(listener)
+
+    def _notify(self):
+        u"""cond を保持した状態で呼ぶ．cond で待っているスレッドとリスナーに通知する"""
+        self.__cond.notifyAll()
+        for listener in self.__listeners:
+            listener()
+
     def ping(self):
         u"""認識中に結果が届いたことを通知する"""
         return
@@ -154,51 +262,90 @@ class AudioStream(object):
 
 
 class PyAudioStream(AudioStream):
-    def __init__(self, rate, chunk_size, logpower_thresh, timeout_in_sec):
+    def __init__(self, rate, chunk_size, logpower_thresh, vad=None,
+                 buffer_sec=30.0, tracer=None, audio_interface=None,
+                 input_device_index=None, device=None):
+        u"""
+        audio_interface には pyaudio.PyAudio と同じ open() を持つオブジェクトを与えられる
+        （複数のデバイスで共有する場合や，ベンチマークで仮想デバイスを使う場合）．
+        省略時は pyaudio.PyAudio() を作成し，close() で終了させる．
+        input_device_index を省略した場合はデフォルトの入力デバイスを使う．
+        device は結果を区別するためのデバイス名．
+        """
         AudioStream.__init__(self)
 
-        self.__audio_interface = pyaudio.PyAudio()
+        self.__owns_audio_interface = audio_interface is None
+        if audio_interface is None:
+            audio_interface = pyaudio.PyAudio()
+        self.__audio_interface = audio_interface
+        self.__device = device
         self.__audio_stream = self.__audio_interface.open(
             format=pyaudio.paInt16,
             channels=1, rate=rate,
             input=True, frames_per_buffer=chunk_size,
+            input_device_index=input_device_index,
             start=False,
             stream_callback=self.read_callback
         )
-        self.__logpower_thresh = logpower_thresh
-        self.__timeout_in_sec = timeout_in_sec
+        # VADエンジンが与えられない場合は固定閾値で開始のみを検知する
+        if vad is None:
+            vad = LogPowerVad(logpower_thresh)
+        self.__vad = vad
+        # 発話ごとのレイテンシ計測（None の場合は計測しない）
+        self.__tracer = tracer
+        self.__first_read = True
         self.__stopped = True
-        self.__buff = bytearray()
-        self.__read_point = 0
-        self.__last_ping_time = time.time()
+        # 1発話分のバッファ．容量を超えた場合は発話を打ち切る
+        self.__ring = RingBuffer(int(buffer_sec * rate) * 2)
+        # read() が待っているバイト数（0 のときは待っていない）
+        self.__wanted = 0
         self.__closed = False
+        self.__metrics = CaptureMetrics(device)
+        self.__callback_sec = self.__metrics.callback_sec
+        self.__metrics.watch_buffer(self)
 
     def read_callback(self, in_data, frame_count, time_info, status):
         u"""PyAudioでオーディオフレームが読み込まれたら呼ばれるコールバック関数"""
+        started = monotonic()
+        self.__process(in_data)
+        if status & pyaudio.paInputOverflow:
+            self.__metrics.overflows.inc()
+        self.__callback_sec.observe(monotonic() - started)
+        return None, pyaudio.paContinue
+
+    def __process(self, in_data):
+        if self.__stopped or self.vad_finished:
+            # 処理が開始されて無い，またはVAD終了状態だったら何もしない
+            return
+        # VADの計算はロックの外で行う
+        state = self.__vad.process(in_data)
+        if state == SILENCE:
+            # 発話が始まっていない場合は何もせずに終了する
+            return
         with self.cond:
-            # print "", self.__stopped, self.vad_finished
             if self.__stopped or self.vad_finished:
-                # 処理が開始されて無い，またはVAD終了状態だったら何もしない
-                return None, pyaudio.paContinue
-            if not self.vad_started:
-                # VADが開始していない場合は，パワーを計算する
-                values = struct.unpack('h' * (len(in_data) / 2), in_data)
-                mean_log_power = np.log10(np.sqrt(np.mean(np.square(values))))
-                # print "\r%10.5f" % mean_log_power
-                if  mean_log_power < self.__logpower_thresh:
-                    # パワーが閾値に到達していない場合は何もせずに終了する
-                    return None, pyaudio.paContinue
+                return
+            if state == ONSET:
+                # VAD開始を宣言し，開始直前のデータも含めてバッファに入れる
+                self.vad_started = True
+                self.__metrics.vad_onsets.inc()
+                if self.__tracer is not None:
+                    self.__tracer.mark(self.trace_id, 'vad_onset')
+                written = self.__ring.write(self.__vad.pop_pre_roll())
+            else:
+                written = self.__ring.write(in_data)
+            if state == OFFSET or not written:
+                # VADエンジンが発話終了を検知した，またはバッファが一杯になった
+                self.vad_finished = True
+                if state == OFFSET:
+                    self.__metrics.vad_offsets.inc()
                 else:
-                    # そうでなければVAD開始を宣言する（通知はデータ送信で行われるので，
-                    # 敢えてする必要はない）
-                    self.vad_started = True
-                    # 最終動作確認時間を現在の時刻にする
-                    self.__last_ping_time = time.time()
-            # VADが開始されている場合の処理
-            # バッファにデータを入れて通知して終了する
-            self.__buff.extend(in_data)
-            self.cond.notifyAll() 
-        return None, pyaudio.paContinue
+                    self.__metrics.buffer_full.inc()
+                if self.__tracer is not None:
+                    self.__tracer.mark(self.trace_id, 'finish_vad')
+            if state != SPEECH or (0 < self.__wanted <= self.__ring.readable()):
+                # 状態が変わったか，read() が必要とする量が溜まった場合のみ起こす
+                self._notify()
 
     @property
     def single_utterance_required(self):
@@ -212,18 +359,28 @@ class PyAudioStream(AudioStream):
     def closed(self):
         return self.__closed
 
+    @property
+    def device(self):
+        return self.__device
+
+    @property
+    def buffer_depth(self):
+        u"""バッファに溜まっていて，まだ読まれていないバイト数"""
+        return self.__ring.readable()
+
     def start(self):
         with self.cond:
             if not self.__stopped:
                 return
-            self.__buff = bytearray()
-            self.__read_point = 0
+            self.__ring.reset()
+            self.__vad.reset()
+            self.__first_read = True
             self.__audio_stream.start_stream()
             self.__stopped = False
             self._audio_id += 1
             self.vad_started = False
             self.vad_finished = False
-            self.cond.notifyAll()
+            self._notify()
 
     def stop(self):
         with self.cond:
@@ -232,67 +389,403 @@ class PyAudioStream(AudioStream):
         self.__audio_stream.stop_stream()
         with self.cond:
             self.__stopped = True
-            self.cond.notifyAll() 
+            self._notify() 
+        if self.__tracer is not None:
+            self.__tracer.mark(self.trace_id, 'stop')
 
     def close(self):
         self.stop()
-        self.__audio_interface.terminate()
+        self.__audio_stream.close()
+        if self.__owns_audio_interface:
+            self.__audio_interface.terminate()
         self.__closed = True
+        self.__metrics.close()
 
     def read(self, size):
-        # VADの終了宣言がなく，ping()が一定時間きていない場合は finish_vad を呼ぶ
-        if not self.vad_finished and time.time() - self.__last_ping_time > self.__timeout_in_sec:
-            self.finish_vad()
-        # print "CHECK-1"
+        data = self.read_view(size)
+        if data is None:
+            return None
+        return data.tobytes()
+
+    def read_view(self, size):
         with self.cond:
+            # 前回返した領域はもう使われない
+            self.__ring.release()
             # 読み込みに必要なサイズに到達しないうちは到達するまで待つ
-            while len(self.__buff) - self.__read_point < size:
+            while self.__ring.readable() < size:
                 # ただし，読み込み終了（またはVAD終了）の場合は終了する．
                 if self.__stopped or self.vad_finished:
+                    self.__wanted = 0
                     return None
-                # print "CHECK-2"
+                self.__wanted = size
                 self.cond.wait()
-                # print "CHECK-3"
+            self.__wanted = 0
+            if self.__first_read and self.__tracer is not None:
+                self.__tracer.mark(self.trace_id, 'first_read')
+            self.__first_read = False
             # 読み込みに十分なサイズがあるはず
-            data = bytes(self.__buff[self.__read_point:(self.__read_point + size)])
-            self.__read_point += size
-        # print len(self.__buff)
-        return data
+            return self.__ring.read(size)
 
     def get_data(self):
-        return bytes(self.__buff)
+        with self.cond:
+            return self.__ring.get_data()
 
-    def ping(self):
-        self.__last_ping_time = time.time()
-        
     def start_vad(self):
         u"""外部からVAD開始を宣言する（このオブジェクトでは呼ばれない）"""
         with self.cond:
             self.vad_started = True
-            self.cond.notifyAll()
+            self._notify()
             
     def finish_vad(self):
         with self.cond:
             self.vad_finished = True
-            self.cond.notifyAll()
+            self._notify()
+        if self.__tracer is not None:
+            self.__tracer.mark(self.trace_id, 'finish_vad')
+
+class UtteranceStream(AudioStream):
+    u"""
+    ContinuousPyAudioStream が発話ごとに作るストリーム．
+    VAD開始の時点で作られ，録音は ContinuousPyAudioStream が続けるので，
+    start() / stop() は入力デバイスを操作しない．
+    """
+
+    def __init__(self, capture, ring, audio_id, tracer=None):
+        AudioStream.__init__(self)
+        self.__capture = capture
+        self.__ring = ring
+        self._audio_id = audio_id
+        self.__tracer = tracer
+        self.__first_read = True
+        self.__stopped = False
+        self.__closed = False
+        self.__wanted = 0
+        self.vad_started = True
+
+    def _write(self, data, finished=False):
+        u"""ContinuousPyAudioStream のコールバックから呼ばれる．書き込めなかった場合は False を返す"""
+        with self.cond:
+            if self.__stopped or self.vad_finished:
+                return False
+            written = self.__ring.write(data)
+            if finished or not written:
+                # 発話終了，またはバッファが一杯になった
+                self.vad_finished = True
+                if self.__tracer is not None:
+                    self.__tracer.mark(self.trace_id, 'finish_vad')
+                self._notify()
+            elif 0 < self.__wanted <= self.__ring.readable():
+                self._notify()
+            return written
+
+    @property
+    def single_utterance_required(self):
+        return True
+
+    @property
+    def sync_mode_enabled(self):
+        return False
+
+    @property
+    def closed(self):
+        return self.__closed
+
+    @property
+    def device(self):
+        return self.__capture.device
+
+    @property
+    def buffer_depth(self):
+        return self.__ring.readable()
+
+    def start(self):
+        return
+
+    def stop(self):
+        with self.cond:
+            if self.__stopped:
+                return
+            self.__stopped = True
+            self._notify()
+        if self.__tracer is not None:
+            self.__tracer.mark(self.trace_id, 'stop')
+
+    def close(self):
+        u"""バッファを ContinuousPyAudioStream に返す．以降 get_data() は使えない"""
+        self.stop()
+        with self.cond:
+            if self.__closed:
+                return
+            self.__closed = True
+            ring, self.__ring = self.__ring, None
+        self.__capture._release_buffer(ring)
+
+    def read(self, size):
+        data = self.read_view(size)
+        if data is None:
+            return None
+        return data.tobytes()
+
+    def read_view(self, size):
+        with self.cond:
+            self.__ring.release()
+            while self.__ring.readable() < size:
+                if self.__stopped or self.vad_finished:
+                    self.__wanted = 0
+                    return None
+                self.__wanted = size
+                self.cond.wait()
+            self.__wanted = 0
+            if self.__first_read and self.__tracer is not None:
+                self.__tracer.mark(self.trace_id, 'first_read')
+            self.__first_read = False
+            return self.__ring.read(size)
+
+    def get_data(self):
+        with self.cond:
+            return self.__ring.get_data()
+
+    def finish_vad(self):
+        with self.cond:
+            if self.vad_finished:
+                return
+            self.vad_finished = True
+            self._notify()
+        if self.__tracer is not None:
+            self.__tracer.mark(self.trace_id, 'finish_vad')
+
+
+class ContinuousPyAudioStream(object):
+    u"""
+    入力デバイスを止めずに録音し続け，VADで発話ごとに UtteranceStream に分ける．
+    PyAudioStream は発話ごとに start_stream() / stop_stream() するため，認識結果の確定から
+    次の start() までの音声が失われるが，こちらは前の発話の認識中も次の発話を取り込める．
+
+        capture.start()
+        while True:
+            utterance = capture.next_utterance()  # VAD開始まで待つ
+            （utterance を別スレッドで認識し，終わったら utterance.close() する）
+
+    発話ごとのバッファは使い回し，同時に max_buffers 個までを保持する．
+    全てのバッファが使用中（認識待ちか認識中）の間に始まった発話は捨てて
+    capture_utterances_dropped_total を数える（コールバックの中では待てないため）．
+    """
+
+    def __init__(self, rate, chunk_size, logpower_thresh, vad=None,
+                 buffer_sec=30.0, tracer=None, audio_interface=None,
+                 input_device_index=None, device=None, max_buffers=4):
+        self.__owns_audio_interface = audio_interface is None
+        if audio_interface is None:
+            audio_interface = pyaudio.PyAudio()
+        self.__audio_interface = audio_interface
+        self.__device = device
+        self.__audio_stream = self.__audio_interface.open(
+            format=pyaudio.paInt16,
+            channels=1, rate=rate,
+            input=True, frames_per_buffer=chunk_size,
+            input_device_index=input_device_index,
+            start=False,
+            stream_callback=self.read_callback
+        )
+        if vad is None:
+            vad = LogPowerVad(logpower_thresh)
+        self.__vad = vad
+        self.__tracer = tracer
+        self.__buffer_size = int(buffer_sec * rate) * 2
+        self.__max_buffers = max_buffers
+        self.__free_buffers = []
+        # 作成したバッファのうち，まだ返されていないものの数
+        self.__buffers_in_use = 0
+        # 発話を捨てている間は True
+        self.__dropping = False
+        self.__cond = threading.Condition()
+        # 録音中の発話と，まだ next_utterance() で取り出されていない発話
+        self.__current = None
+        self.__pending = []
+        self.__audio_id = 0
+        self.__closed = False
+        self.__metrics = CaptureMetrics(device)
+        self.__callback_sec = self.__metrics.callback_sec
+        self.__metrics.watch_buffer(self)
+        self.__dropped = self.__metrics.add('capture_utterances_dropped_total', metrics.counter(
+            'capture_utterances_dropped_total', u'バッファが全て使用中で捨てた発話の数',
+            device=device))
+
+    @property
+    def buffer_depth(self):
+        u"""録音中の発話のバッファに溜まっていて，まだ読まれていないバイト数"""
+        current = self.__current
+        return current.buffer_depth if current is not None else 0
+
+    def read_callback(self, in_data, frame_count, time_info, status):
+        u"""PyAudioでオーディオフレームが読み込まれたら呼ばれるコールバック関数"""
+        started = monotonic()
+        self.__process(in_data)
+        if status & pyaudio.paInputOverflow:
+            self.__metrics.overflows.inc()
+        self.__callback_sec.observe(monotonic() - started)
+        return None, pyaudio.paContinue
+
+    def __process(self, in_data):
+        current = self.__current
+        if current is not None and current.vad_finished:
+            # 認識側が発話を打ち切った．次の発話開始を検知し直す
+            self.__current = current = None
+            self.__vad.reset()
+        state = self.__vad.process(in_data)
+        if state == SILENCE:
+            return
+        if state == ONSET:
+            self.__metrics.vad_onsets.inc()
+            current = self.__begin_utterance()
+            if current is None:
+                # バッファが空くまでの発話は捨てる．終了を検知できない VAD は
+                # 検知し直さないと発話中のままになるので，その間の開始は1回として数える
+                if not self.__dropping:
+                    self.__dropped.inc()
+                    self.__dropping = True
+                if not self.__vad.detects_offset:
+                    self.__vad.reset()
+                return
+            self.__dropping = False
+            current._write(self.__vad.pop_pre_roll())
+        elif current is not None:
+            if not current._write(in_data, finished=(state == OFFSET)):
+                # バッファが一杯になった（打ち切られた発話は先頭で外しているので，ほぼこの場合のみ）
+                self.__metrics.buffer_full.inc()
+                self.__current = None
+                self.__vad.reset()
+            elif state == OFFSET:
+                self.__metrics.vad_offsets.inc()
+                self.__current = None
+        elif state == OFFSET:
+            # 捨てた発話が終わった
+            self.__metrics.vad_offsets.inc()
+            self.__dropping = False
+
+    def __begin_utterance(self):
+        u"""新しい発話の UtteranceStream を作る．バッファが全て使用中なら None"""
+        with self.__cond:
+            if self.__buffers_in_use >= self.__max_buffers:
+                return None
+            self.__buffers_in_use += 1
+            if self.__free_buffers:
+                ring = self.__free_buffers.pop()
+                ring.reset()
+            else:
+                ring = RingBuffer(self.__buffer_size)
+            self.__audio_id += 1
+            utterance = UtteranceStream(self, ring, self.__audio_id, self.__tracer)
+            if self.__tracer is not None:
+                self.__tracer.mark(utterance.trace_id, 'vad_onset')
+            self.__current = utterance
+            self.__pending.append(utterance)
+            self.__cond.notifyAll()
+        return utterance
+
+    def _release_buffer(self, ring):
+        with self.__cond:
+            self.__buffers_in_use -= 1
+            if len(self.__free_buffers) < self.__max_buffers:
+                self.__free_buffers.append(ring)
+
+    @property
+    def closed(self):
+        return self.__closed
+
+    @property
+    def device(self):
+        return self.__device
+
+    @property
+    def audio_id(self):
+        u"""最後に開始した発話のAudio ID"""
+        return self.__audio_id
+
+    def start(self):
+        self.__vad.reset()
+        self.__audio_stream.start_stream()
+
+    def next_utterance(self, timeout=None):
+        u"""次の発話のVAD開始を待ち，その UtteranceStream を返す．close() された場合は None"""
+        with self.__cond:
+            while not self.__pending:
+                if self.__closed:
+                    return None
+                self.__cond.wait(timeout)
+                if timeout is not None and not self.__pending:
+                    return None
+            return self.__pending.pop(0)
+
+    def close(self):
+        self.__audio_stream.stop_stream()
+        self.__audio_stream.close()
+        if self.__owns_audio_interface:
+            self.__audio_interface.terminate()
+        with self.__cond:
+            self.__closed = True
+            current = self.__current
+            self.__cond.notifyAll()
+        if current is not None:
+            current.finish_vad()
+        self.__metrics.close()
+
+
+def resolve_input_device(audio_interface, spec):
+    u"""
+    デバイスの指定（番号か，名前の一部）を PyAudio の入力デバイス番号に変換する
+    """
+    if spec.isdigit():
+        return int(spec)
+    for index in range(audio_interface.get_device_count()):
+        info = audio_interface.get_device_info_by_index(index)
+        if info.get('maxInputChannels', 0) > 0 and spec in info['name']:
+            return index
+    raise ValueError('input device not found: %s' % spec)
+
 
 class FileAudioStream(AudioStream):
-    def __init__(self, filename_list_or_filename, realtime_mode=False):
+    def __init__(self, filename_list_or_filename, realtime_mode=False, audio_id_offset=0,
+                 speed=None):
+        u"""
+        ファイル（16bit モノラルの WAV，または 16kHz の raw）を1ファイル1発話として読む．
+        ファイル名の代わりに，PcmFile を返す open() を持つもの（ArchiveEntry など）も与えられる．
+        ファイルはメモリマップで開き，読み込んだデータはコピーせずに返す．
+        speed を与えると，read() はファイルのサンプリングレートの speed 倍の速さでデータを返す
+        （0 の場合は待たない）．省略時は realtime_mode なら等速，そうでなければ待たない．
+        audio_id_offset を与えると，Audio ID は audio_id_offset + 1 から始まる
+        （複数のストリームで Audio ID が重ならないようにするため）
+        """
         AudioStream.__init__(self)
+        self._audio_id = audio_id_offset
+        self.__audio_id_offset = audio_id_offset
         if isinstance (filename_list_or_filename, list):
             self.__filename_list = filename_list_or_filename
         else:
             self.__filename_list = [filename_list_or_filename]
         self.__closed = False
-        self.__buff = None
+        self.__pcm = None
         self.__read_point = 0
         self.__stopped = True
-        self.__realtime_mode = realtime_mode
+        if speed is None:
+            speed = 1.0 if realtime_mode else 0.0
+        self.__clock = ReplayClock(speed)
         
     @property
     def closed(self):
         return self.__closed
 
+    @property
+    def content_available(self):
+        return True
+
+    @property
+    def sample_rate(self):
+        u"""現在のファイルのサンプリングレート"""
+        if self.__pcm is None:
+            return None
+        return self.__pcm.sample_rate
+
     def start(self):
         with self.cond:
             if self.closed:
@@ -300,21 +793,21 @@ class FileAudioStream(AudioStream):
             if not self.__stopped:
                 return
             
-            filename = self.__filename_list[self._audio_id]
-            _, ext = path.path(filename).splitext()
-            if ext == '.wav':
-                handle = wave.open(filename, 'r')
-                self.__buff = handle.readframes(handle.getnframes())
-                handle.close()
+            # 前のファイルのデータはここで解放する（get_data() の返り値はそれまで有効）
+            self.__close_file()
+            source = self.__filename_list[self._audio_id - self.__audio_id_offset]
+            if hasattr(source, 'open'):
+                # UtteranceArchive のエントリなど，自分で PcmFile を開けるもの
+                self.__pcm = source.open()
             else:
-                with open(filename, 'rb') as handle:
-                    self.__buff = handle.read(-1)
+                self.__pcm = PcmFile(source)
 
             self.__read_point = 0
             self.__stopped = False
             self.vad_started = True # こうしないと認識が開始されない
             self.vad_finished = False
             self._audio_id += 1
+            self.__clock.start()
             self.cond.notifyAll()
 
     def stop(self):
@@ -323,33 +816,43 @@ class FileAudioStream(AudioStream):
                 return
             self.__stopped = True
 
-            if self._audio_id == len (self.__filename_list):
+            if self._audio_id - self.__audio_id_offset == len (self.__filename_list):
                 self.__closed = True
             
             self.cond.notifyAll()
 
     def close(self):
         self.stop()
-        self.__closed == True
+        with self.cond:
+            self.__close_file()
+        self.__closed = True
+
+    def __close_file(self):
+        if self.__pcm is not None:
+            self.__pcm.close()
+            self.__pcm = None
 
     def read(self, size):
+        data = self.read_view(size)
+        if data is None:
+            return None
+        return data.tobytes()
+
+    def read_view(self, size):
         data = None
         with self.cond:
-            remaining = len (self.__buff) - self.__read_point
-            if remaining > size:
-                data = self.__buff[self.__read_point:(self.__read_point + size)]
-                self.__read_point += size
-            elif remaining > 0:
-                data = self.__buff[self.__read_point:]
-                self.__read_point = len (self.__buff)
-            else:
-                data = None
-
-            if self.__realtime_mode and data is not None:
-                time.sleep (len(data) / 2 / 16000.0)
+            if self.__pcm is not None and self.__read_point < self.__pcm.size:
+                end = self.__read_point + size
+                data = memoryview(self.__pcm.view(self.__read_point, end))
+                self.__read_point += len(data)
+                # 読んだ範囲の終わりが録音される時刻
+                media_sec = self.__read_point / 2.0 / self.__pcm.sample_rate
 
             self.cond.notifyAll()
-                
+
+        if data is not None:
+            # ロックの外で待つ
+            self.__clock.wait_until(media_sec)
         if data is None and not self.vad_finished:
             self.finish_vad()
                 
@@ -366,8 +869,11 @@ class FileAudioStream(AudioStream):
             self.cond.notifyAll()
 
     def get_data(self):
+        u"""現在のファイルのデータ全体（buffer）．次の start() または close() まで有効"""
         with self.cond:
-            return self.__buff
+            if self.__pcm is None:
+                return None
+            return self.__pcm.view()
 
 if __name__ == '__main__':
     # audio_stream = MfccClientAudioStream()
@@ -0,0 +1,47 @@
+# encoding: utf-8
+u"""
+単調増加する時計．
+Python 2 の time には monotonic が無いので，monotonic パッケージがあればそれを使い，
+無ければ time.time で代用する．
+"""
+import time
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    try:
+        from monotonic import monotonic
+    except ImportError:
+        monotonic = time.time
+
+
+class ReplayClock(object):
+    u"""
+    録音済みの音声を speed 倍速で流すための時計．speed が 0 の場合は待たない．
+    start() からの絶対的な期限まで待つので，sleep の誤差や処理時間が積み重ならない．
+    """
+
+    def __init__(self, speed=1.0):
+        if speed < 0:
+            raise ValueError('speed must be >= 0')
+        self.speed = speed
+        self.__origin = None
+
+    def start(self):
+        u"""音声の先頭を流し始めた時刻を現在にする"""
+        self.__origin = monotonic()
+
+    def wait_until(self, media_sec):
+        u"""
+        音声の先頭から media_sec 秒の位置を流すべき時刻まで待つ．
+        予定より遅れていた場合は待たずに，遅れ（秒）を返す
+        """
+        if self.speed == 0:
+            return 0.0
+        if self.__origin is None:
+            self.start()
+        remaining = self.__origin + media_sec / self.speed - monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+            return 0.0
+        return -remaining
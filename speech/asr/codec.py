@@ -0,0 +1,305 @@
+# encoding: utf-8
+u"""
+認識エンジンに送る音声の符号化
+
+    linear16  無圧縮（16bit PCM をそのまま送る）
+    flac      FLAC（soundfile が必要）．Google Cloud Speech API がそのまま受け付ける
+    dpcm      サンプル間の差分を zlib で圧縮する可逆符号化．LocalRecognizerBackend が復号できる
+
+EncodedStream は AudioStream の read(size) ごとに size バイトの PCM を符号化して返す．
+符号化にかかった時間と，符号化前後のバイト数を CodecStats に記録する
+（codec_* のメトリクスとしても公開する）．
+"""
+
+from abc import ABCMeta, abstractmethod
+import threading
+import zlib
+
+import numpy as np
+
+from clock import monotonic
+import metrics
+
+
+class Encoder(object):
+    u"""PCM（16bit モノラル）を順に符号化する．1発話ごとに作る"""
+    __metaclass__ = ABCMeta
+
+    # Google Cloud Speech API の Encoding の名前
+    encoding = None
+
+    @abstractmethod
+    def encode(self, data):
+        u"""PCM の続きを符号化して返す（まだ出力が無い場合は空の bytes）"""
+        pass
+
+    def finish(self):
+        u"""残りを全て出力する"""
+        return b''
+
+
+class Decoder(object):
+    u"""Encoder の出力を PCM に戻す"""
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def decode(self, data):
+        pass
+
+
+class Linear16Encoder(Encoder):
+    encoding = 'LINEAR16'
+
+    def encode(self, data):
+        return data.tobytes() if isinstance(data, memoryview) else bytes(data)
+
+
+class Linear16Decoder(Decoder):
+
+    def decode(self, data):
+        return data
+
+
+class DpcmEncoder(Encoder):
+    u"""
+    前のサンプルとの差分（16bit で桁あふれさせる）を zlib で圧縮する．
+    read() ごとに Z_SYNC_FLUSH するので，各出力はそこまでで復号できる
+    """
+
+    def __init__(self, level=6):
+        self.__compressor = zlib.compressobj(level)
+        self.__last = np.int16(0)
+        # 奇数バイトで渡された場合の残り
+        self.__remainder = b''
+
+    def encode(self, data):
+        data = self.__remainder + (data.tobytes() if isinstance(data, memoryview) else data)
+        usable = len(data) - len(data) % 2
+        self.__remainder = data[usable:]
+        if usable == 0:
+            return b''
+        samples = np.frombuffer(data[:usable], dtype='<i2')
+        delta = np.empty_like(samples)
+        # スカラーどうしの演算は桁あふれを警告するので，配列のまま引く
+        np.subtract(samples[:1], self.__last, out=delta[:1])
+        delta[1:] = samples[1:] - samples[:-1]
+        self.__last = samples[-1]
+        return self.__compressor.compress(delta.tostring()) + \
+            self.__compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.__compressor.flush()
+
+
+class DpcmDecoder(Decoder):
+
+    def __init__(self):
+        self.__decompressor = zlib.decompressobj()
+        self.__last = np.int16(0)
+        self.__remainder = b''
+
+    def decode(self, data):
+        data = self.__remainder + self.__decompressor.decompress(bytes(data))
+        usable = len(data) - len(data) % 2
+        self.__remainder = data[usable:]
+        if usable == 0:
+            return b''
+        delta = np.frombuffer(data[:usable], dtype='<i2')
+        # 16bit のまま累積和をとると，符号化時の桁あふれが打ち消される
+        samples = np.cumsum(np.concatenate([[self.__last], delta]).astype('<i2'),
+                            dtype='<i2')[1:]
+        self.__last = samples[-1]
+        return samples.tostring()
+
+
+class _FlacSink(object):
+    u"""
+    soundfile が書き込む FLAC を少しずつ取り出すためのファイル風オブジェクト．
+    取り出し済みの位置への書き込み（終了時のヘッダの更新）は捨てる
+    """
+
+    def __init__(self):
+        self.__pending = bytearray()
+        self.__offset = 0
+        self.__pos = 0
+        self.__size = 0
+
+    def write(self, data):
+        data = bytes(data)
+        start = self.__pos
+        end = start + len(data)
+        if end > self.__offset:
+            if start < self.__offset:
+                data = data[(self.__offset - start):]
+                start = self.__offset
+            index = start - self.__offset
+            if index > len(self.__pending):
+                self.__pending.extend(b'\0' * (index - len(self.__pending)))
+            self.__pending[index:(index + len(data))] = data
+        self.__pos = end
+        self.__size = max(self.__size, end)
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.__pos
+        elif whence == 2:
+            offset += self.__size
+        self.__pos = offset
+        return offset
+
+    def tell(self):
+        return self.__pos
+
+    def read(self, size=-1):
+        return b''
+
+    def take(self):
+        u"""まだ取り出していない部分を返す"""
+        data = bytes(self.__pending)
+        self.__offset += len(data)
+        self.__pending = bytearray()
+        return data
+
+
+class FlacEncoder(Encoder):
+    u"""soundfile（libsndfile）による FLAC の符号化"""
+    encoding = 'FLAC'
+
+    def __init__(self, sample_rate):
+        import soundfile
+        self.__sink = _FlacSink()
+        self.__file = soundfile.SoundFile(self.__sink, 'w', samplerate=sample_rate,
+                                          channels=1, subtype='PCM_16', format='FLAC')
+
+    def encode(self, data):
+        self.__file.buffer_write(data.tobytes() if isinstance(data, memoryview) else data,
+                                 dtype='int16')
+        return self.__sink.take()
+
+    def finish(self):
+        self.__file.close()
+        return self.__sink.take()
+
+
+def create_encoder(codec, sample_rate):
+    if codec == 'linear16':
+        return Linear16Encoder()
+    if codec == 'dpcm':
+        return DpcmEncoder()
+    if codec == 'flac':
+        return FlacEncoder(sample_rate)
+    raise ValueError('unknown codec: %s' % codec)
+
+
+def create_decoder(codec):
+    if codec == 'linear16':
+        return Linear16Decoder()
+    if codec == 'dpcm':
+        return DpcmDecoder()
+    raise ValueError('codec cannot be decoded locally: %s' % codec)
+
+
+# 1チャンクの符号化の時間（秒）のバケット．処理時間の既定のものより細かくする
+ENCODE_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+                  0.005, 0.01, 0.025)
+
+
+class CodecStats(object):
+    u"""
+    符号化の統計（複数の発話・スレッドで共有する）．
+    符号化の時間は read() ごとの encode() の前後の clock.monotonic() の差（経過時間）．
+    CPU 時間ではないので，その間に他のスレッドが動いた分も含まれる．
+    codec_name を与えると，codec ラベル付きのメトリクスにも加算する
+    """
+
+    def __init__(self, codec_name=None):
+        self.__lock = threading.Lock()
+        self.codec_name = codec_name
+        self.__metrics = None
+        if codec_name is not None:
+            self.__metrics = (
+                metrics.counter('codec_chunks_total', u'符号化したチャンクの数', codec=codec_name),
+                metrics.counter('codec_bytes_in_total', u'符号化前のバイト数', codec=codec_name),
+                metrics.counter('codec_bytes_out_total', u'符号化後のバイト数', codec=codec_name),
+                metrics.histogram('codec_encode_seconds', u'1チャンクの符号化にかかった時間',
+                                  buckets=ENCODE_BUCKETS, codec=codec_name))
+        self.chunks = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.encode_sec = 0.0
+        self.max_chunk_sec = 0.0
+
+    def add(self, bytes_in, bytes_out, elapsed):
+        with self.__lock:
+            self.chunks += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.encode_sec += elapsed
+            self.max_chunk_sec = max(self.max_chunk_sec, elapsed)
+        if self.__metrics is not None:
+            chunks, bytes_in_total, bytes_out_total, encode_sec = self.__metrics
+            chunks.inc()
+            bytes_in_total.inc(bytes_in)
+            bytes_out_total.inc(bytes_out)
+            encode_sec.observe(elapsed)
+
+    def summary(self):
+        u"""チャンク数，バイト数，圧縮率，1チャンクあたりの平均・最大の符号化時間（マイクロ秒）"""
+        with self.__lock:
+            return {'chunks': self.chunks,
+                    'bytes_in': self.bytes_in,
+                    'bytes_out': self.bytes_out,
+                    'ratio': self.bytes_out / float(self.bytes_in) if self.bytes_in else None,
+                    'mean_chunk_us': 1e6 * self.encode_sec / self.chunks if self.chunks else None,
+                    'max_chunk_us': 1e6 * self.max_chunk_sec}
+
+    def format_summary(self):
+        u"""summary() を1行の文字列にする（終了時の表示用）．何も符号化していなければ None"""
+        summary = self.summary()
+        if not summary['chunks']:
+            return None
+        return ('CODEC (%s): chunks=%d in=%d out=%d ratio=%.3f '
+                'time_per_chunk=%.1fus max=%.1fus') % (
+                    self.codec_name, summary['chunks'], summary['bytes_in'],
+                    summary['bytes_out'], summary['ratio'] or 0.0,
+                    summary['mean_chunk_us'], summary['max_chunk_us'])
+
+
+class EncodedStream(object):
+    u"""
+    AudioStream から読んだ PCM を符号化して返すストリーム（認識エンジンに渡す）．
+    符号化器が出力を溜めている間は続きを読むので，音声の終わり以外で空のデータは返さない
+    """
+
+    def __init__(self, audio_stream, encoder, stats=None):
+        self.audio_stream = audio_stream
+        self.encoder = encoder
+        self.stats = stats
+        self.__finished = False
+
+    @property
+    def closed(self):
+        return self.audio_stream.closed
+
+    def read(self, size):
+        if self.__finished:
+            return None
+        while True:
+            data = self.audio_stream.read_view(size)
+            started = monotonic()
+            if data is None:
+                self.__finished = True
+                out = self.encoder.finish()
+                bytes_in = 0
+            else:
+                out = self.encoder.encode(data)
+                bytes_in = len(data)
+            if self.stats is not None:
+                self.stats.add(bytes_in, len(out), monotonic() - started)
+            if out:
+                return out
+            if self.__finished:
+                return None
+
+    read_view = read
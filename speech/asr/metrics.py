@@ -0,0 +1,302 @@
+# encoding: utf-8
+u"""
+実行中の数値（メトリクス）の記録と公開
+
+プロセス内で共有する registry にカウンター・ゲージ・ヒストグラムを登録し，
+MetricsServer で Prometheus のテキスト形式として HTTP で公開する（conf.ini の [metrics]）．
+
+    OVERFLOWS = metrics.counter('audio_input_overflows_total', u'...', device='mic1')
+    OVERFLOWS.inc()
+
+    curl http://127.0.0.1:9108/metrics
+
+同じ名前とラベルで登録すると同じものが返るので，よく使うものは作成時に取得しておき，
+記録（inc() / observe() など）はロック1回と数回の演算で済むようにする．
+ゲージには値の代わりに関数を登録でき（set_function），その場合は公開するときにだけ呼ばれる．
+"""
+
+import bisect
+import sys
+import threading
+from collections import OrderedDict
+
+from clock import monotonic
+
+# 秒で測る処理時間の既定のバケット
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+class Counter(object):
+    u"""増えるだけの値"""
+    kind = 'counter'
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.__lock:
+            self.value += amount
+
+    def samples(self):
+        return [('', (), self.value)]
+
+
+class Meter(Counter):
+    u"""直近 window_sec 秒間の1秒あたりの回数（rate()）も求められるカウンター"""
+
+    def __init__(self, window_sec=10):
+        Counter.__init__(self)
+        self.__lock = threading.Lock()
+        self.__window_sec = window_sec
+        # 秒ごとの回数と，そのスロットがどの秒のものか
+        self.__counts = [0] * window_sec
+        self.__seconds = [None] * window_sec
+
+    def inc(self, amount=1):
+        second = int(monotonic())
+        index = second % self.__window_sec
+        with self.__lock:
+            if self.__seconds[index] != second:
+                self.__seconds[index] = second
+                self.__counts[index] = 0
+            self.__counts[index] += amount
+            self.value += amount
+
+    def rate(self):
+        second = int(monotonic())
+        with self.__lock:
+            total = sum(count for count, s in zip(self.__counts, self.__seconds)
+                        if s is not None and second - s < self.__window_sec)
+        return total / float(self.__window_sec)
+
+
+class Gauge(object):
+    u"""上下する値．set_function() で関数を登録した場合は，公開するときにその値を使う"""
+    kind = 'gauge'
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__value = 0
+        self.__function = None
+
+    def set(self, value):
+        self.__value = value
+
+    def inc(self, amount=1):
+        with self.__lock:
+            self.__value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        self.__function = function
+
+    @property
+    def value(self):
+        if self.__function is not None:
+            return self.__function()
+        return self.__value
+
+    def samples(self):
+        return [('', (), self.value)]
+
+
+class Histogram(object):
+    u"""値の分布（バケットの上限ごとの個数）と合計・個数"""
+    kind = 'histogram'
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.__lock = threading.Lock()
+        self.buckets = tuple(sorted(buckets))
+        # 最後の要素は全てのバケットの上限を超えたもの
+        self.__counts = [0] * (len(self.buckets) + 1)
+        self.__sum = 0.0
+        self.__count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            self.__counts[index] += 1
+            self.__sum += value
+            self.__count += 1
+
+    def samples(self):
+        with self.__lock:
+            counts = list(self.__counts)
+            total, count = self.__sum, self.__count
+        samples = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            cumulative += n
+            samples.append(('_bucket', (('le', _format_value(bound)),), cumulative))
+        samples.append(('_sum', (), total))
+        samples.append(('_count', (), count))
+        return samples
+
+
+class _Family(object):
+
+    def __init__(self, kind, help):
+        self.kind = kind
+        self.help = help
+        self.metrics = OrderedDict()
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+
+
+class Registry(object):
+    u"""
+    メトリクスの登録先．名前ごとに種類と説明を持ち，ラベルの値ごとに別の値を持つ．
+    値が None のラベルは付けない
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__families = OrderedDict()
+
+    @staticmethod
+    def __key(labels):
+        return tuple(sorted((k, v) for k, v in labels.items() if v is not None))
+
+    def __get(self, factory, kind, name, help, labels):
+        key = self.__key(labels)
+        with self.__lock:
+            family = self.__families.get(name)
+            if family is None:
+                family = self.__families[name] = _Family(kind, help)
+            elif family.kind != kind:
+                raise ValueError('metric %s already registered as %s' % (name, family.kind))
+            metric = family.metrics.get(key)
+            if metric is None:
+                metric = family.metrics[key] = factory()
+        return metric
+
+    def counter(self, name, help=u'', **labels):
+        return self.__get(Counter, 'counter', name, help, labels)
+
+    def gauge(self, name, help=u'', **labels):
+        return self.__get(Gauge, 'gauge', name, help, labels)
+
+    def histogram(self, name, help=u'', buckets=DEFAULT_BUCKETS, **labels):
+        return self.__get(lambda: Histogram(buckets), 'histogram', name, help, labels)
+
+    def meter(self, name, help=u'', window_sec=10, **labels):
+        u"""
+        name（..._total）のカウンターと，直近 window_sec 秒間の1秒あたりの回数のゲージ
+        （..._per_second）を登録し，カウンターを返す
+        """
+        meter = self.__get(lambda: Meter(window_sec), 'counter', name, help, labels)
+        base = name[:-len('_total')] if name.endswith('_total') else name
+        self.gauge(base + '_per_second', u'%s（直近 %d 秒間の1秒あたり）' % (help, window_sec),
+                   **labels).set_function(meter.rate)
+        return meter
+
+    def remove(self, name, metric=None, **labels):
+        u"""
+        ラベルの値が labels の系列を消す（接続ごとのデバイスなど，無くなったものの系列を残さない）．
+        metric を与えた場合は，それが登録されているときのみ消す（同じラベルで作り直されたものは消さない）
+        """
+        key = self.__key(labels)
+        with self.__lock:
+            family = self.__families.get(name)
+            if family is None or key not in family.metrics:
+                return
+            if metric is not None and family.metrics[key] is not metric:
+                return
+            del family.metrics[key]
+            if not family.metrics:
+                del self.__families[name]
+
+    def render(self):
+        u"""全てのメトリクスを Prometheus のテキスト形式（utf-8 の str）で返す"""
+        with self.__lock:
+            families = [(name, family, list(family.metrics.items()))
+                        for name, family in self.__families.items()]
+        lines = []
+        for name, family, metrics in families:
+            if family.help:
+                lines.append('# HELP %s %s' % (name, _escape(family.help)))
+            lines.append('# TYPE %s %s' % (name, family.kind))
+            for labels, metric in metrics:
+                try:
+                    samples = metric.samples()
+                except Exception as e:
+                    # 関数を登録したゲージの失敗で全体の公開を止めない
+                    print >> sys.stderr, "METRICS ERROR (%s): %s" % (name, e)
+                    continue
+                for suffix, extra, value in samples:
+                    lines.append('%s%s%s %s' % (name, suffix, _format_labels(labels + extra),
+                                                _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+# プロセス内で共有する registry
+registry = Registry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
+meter = registry.meter
+remove = registry.remove
+
+
+class MetricsServer(object):
+    u"""registry を http://host:port/metrics で公開する（別スレッドで動く）"""
+
+    def __init__(self, registry=registry, host='127.0.0.1', port=9108):
+        import BaseHTTPServer
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        self.__thread = threading.Thread(target=self.server.serve_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def create_metrics_server(conf):
+    u"""conf.ini の [metrics] が有効なら MetricsServer を起動する"""
+    if not conf.has_section('metrics') or not conf.getboolean('metrics', 'enabled'):
+        return None
+    return MetricsServer(registry, conf.get('metrics', 'host'), conf.getint('metrics', 'port'))
@@ -0,0 +1,225 @@
+# encoding: utf-8
+u"""
+ネットワーク越しの音声入力（asr_server.py の接続ごとのストリームとプロトコル）
+
+クライアントは TCP で接続し，最初に1行の JSON（ハンドシェイク）を送ってから，
+16bit モノラルの PCM（リトルエンディアン）を録音した速さで送り続ける．
+
+    -> {"device": "desk-12", "sample_rate": 16000}\\n
+    <- {"type": "ready", "device": "desk-12", "sample_rate": 16000}\\n
+    -> PCM ...
+    <- {"type": "recog_start", "audio_id": 1, "device": "desk-12"}\\n
+    <- {"type": "recog_result", "recog_result": "...", "state": "busy", ...}\\n
+    ...
+
+送り終えたら送信側だけを閉じる（shutdown(SHUT_WR)）．サーバーは最後の発話の結果を返してから
+接続を閉じる．受け付けられない場合は {"type": "error", "message": ...} を返して閉じる．
+device（端末ごとに決まった名前）は必須で，接続中の他のクライアントと同じ名前は使えない．
+
+NetworkAudioStream は接続を PyAudio の入力デバイスの代わりにした PyAudioStream で，
+接続ごとに VAD と Audio ID の列を持つ．PyAudioStream と同じく，発話の認識中
+（start() していない間）に届いた音声は捨てるので，クライアントは音声を溜めずに送ること．
+
+    python -m speech.asr.network HOST:PORT FILE [--device NAME] [--speed X]
+
+は，録音済みのファイルをマイクの代わりに送るクライアント（動作確認用）で，
+受け取ったイベントを1行ずつ標準出力に表示する．
+"""
+
+import sys
+import json
+import socket
+import threading
+
+from audio_stream import PyAudioStream
+from clock import ReplayClock
+
+# ハンドシェイクの行の最大の長さ
+MAX_HANDSHAKE_BYTES = 4096
+
+
+def read_handshake(sock, max_bytes=MAX_HANDSHAKE_BYTES):
+    u"""
+    最初の1行（JSON）を読み，(内容, その後に続けて受け取った PCM) を返す．
+    行が長すぎる・JSON でない・行の前に接続が切れた場合は ValueError
+    """
+    data = b''
+    while b'\n' not in data:
+        if len(data) > max_bytes:
+            raise ValueError('handshake too long')
+        chunk = sock.recv(max_bytes)
+        if not chunk:
+            raise ValueError('connection closed before handshake')
+        data += chunk
+    line, pending = data.split(b'\n', 1)
+    hello = json.loads(line)
+    if not isinstance(hello, dict):
+        raise ValueError('handshake must be a JSON object')
+    return hello, pending
+
+
+def send_line(sock, message):
+    u"""message を JSON の1行として送る"""
+    sock.sendall(json.dumps(message) + '\n')
+
+
+class SocketInputStream(object):
+    u"""SocketAudioInterface.open() が返す，pyaudio.Stream の start / stop / close のみを持つもの"""
+
+    def __init__(self, frames_per_buffer, stream_callback):
+        self.frames_per_buffer = frames_per_buffer
+        self.stream_callback = stream_callback
+        self.active = False
+        self.closed = False
+
+    def start_stream(self):
+        self.active = True
+
+    def stop_stream(self):
+        self.active = False
+
+    def is_active(self):
+        return self.active
+
+    def close(self):
+        self.active = False
+        self.closed = True
+
+
+class SocketAudioInterface(object):
+    u"""
+    PyAudioStream に pyaudio.PyAudio の代わりに与えるもの．
+    受け取った PCM を stream_callback に渡すのは NetworkAudioStream の受信スレッド
+    """
+
+    def __init__(self):
+        self.stream = None
+
+    def open(self, format, channels, rate, input=True, frames_per_buffer=1024,
+             input_device_index=None, start=True, stream_callback=None):
+        if channels != 1:
+            raise ValueError('only mono input is supported')
+        self.stream = SocketInputStream(frames_per_buffer, stream_callback)
+        if start:
+            self.stream.start_stream()
+        return self.stream
+
+    def terminate(self):
+        pass
+
+
+class NetworkAudioStream(PyAudioStream):
+    u"""
+    接続から受け取る PCM を入力とする PyAudioStream．
+    受信スレッドが chunk_size サンプルごとに read_callback() を呼ぶ．
+    クライアントが送信を終えるか接続が切れたら close() する
+    （認識中の発話は受け取った分だけで認識を終える）．
+    """
+
+    def __init__(self, sock, rate, chunk_size, logpower_thresh, vad=None, buffer_sec=30.0,
+                 tracer=None, device=None, pending=b''):
+        u"""pending にはハンドシェイクの後に続けて受け取った PCM を与える"""
+        self.__sock = sock
+        self.__rate = rate
+        self.__chunk_size = chunk_size
+        self.__interface = SocketAudioInterface()
+        PyAudioStream.__init__(self, rate, chunk_size, logpower_thresh, vad=vad,
+                               buffer_sec=buffer_sec, tracer=tracer,
+                               audio_interface=self.__interface, device=device)
+        self.__thread = threading.Thread(target=self.__receive, args=(pending,))
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    @property
+    def sample_rate(self):
+        u"""クライアントがハンドシェイクで指定したサンプリングレート"""
+        return self.__rate
+
+    def __receive(self, pending):
+        input_stream = self.__interface.stream
+        frame_bytes = self.__chunk_size * 2
+        buf = bytearray(pending)
+        try:
+            while not input_stream.closed:
+                offset = 0
+                while len(buf) - offset >= frame_bytes:
+                    # start() していない間（PyAudio では止めている間）の音声は捨てる
+                    if input_stream.active:
+                        input_stream.stream_callback(
+                            bytes(buf[offset:offset + frame_bytes]), self.__chunk_size, None, 0)
+                    offset += frame_bytes
+                del buf[:offset]
+                data = self.__sock.recv(65536)
+                if not data:
+                    break
+                buf.extend(data)
+        except socket.error as e:
+            print >> sys.stderr, "NETWORK ERROR (%s): %s" % (self.device, e)
+        finally:
+            self.close()
+
+    def close(self):
+        PyAudioStream.close(self)
+        try:
+            # 受信スレッドの recv() を終わらせる（結果を返すため送信側は閉じない）
+            self.__sock.shutdown(socket.SHUT_RD)
+        except socket.error:
+            pass
+        with self.cond:
+            # VAD の開始を待っている SpeechInputter を起こす
+            self._notify()
+
+
+def main():
+    import argparse
+    from pcm_file import PcmFile
+
+    parser = argparse.ArgumentParser(
+        description=u'録音済みのファイルを asr_server.py に送り，結果を表示する')
+    parser.add_argument('address', help='HOST:PORT')
+    parser.add_argument('file', help=u'16bit モノラルの WAV（16kHz の raw も可）')
+    parser.add_argument('--device', default='loopback')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help=u'録音時の何倍の速さで送るか（既定は等速）')
+    parser.add_argument('--tail_sec', type=float, default=1.0,
+                        help=u'ファイルの後に送る無音の長さ（秒）．最後の発話の終了を検知させる')
+    args = parser.parse_args()
+
+    host, port = args.address.rsplit(':', 1)
+    pcm = PcmFile(args.file)
+    sock = socket.create_connection((host, int(port)))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    send_line(sock, {'device': args.device, 'sample_rate': pcm.sample_rate})
+    events = sock.makefile('rb')
+    ready = json.loads(events.readline() or 'null')
+    if not ready or ready.get('type') != 'ready':
+        print >> sys.stderr, "REJECTED:", ready
+        sys.exit(1)
+
+    def print_events():
+        for line in events:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+    printer = threading.Thread(target=print_events)
+    printer.start()
+
+    # 20ms ずつ，録音した速さで送る
+    block = pcm.sample_rate / 50 * 2
+    tail = b'\x00' * (int(args.tail_sec * pcm.sample_rate) * 2)
+    blocks = [pcm.view(start, start + block) for start in range(0, pcm.size, block)]
+    blocks += [tail[start:start + block] for start in range(0, len(tail), block)]
+    clock = ReplayClock(args.speed)
+    clock.start()
+    sent = 0
+    for data in blocks:
+        clock.wait_until(sent / 2.0 / pcm.sample_rate)
+        sock.sendall(data)
+        sent += len(data)
+    sock.shutdown(socket.SHUT_WR)
+    printer.join()
+    sock.close()
+    pcm.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# encoding: utf-8
+u"""
+音声ファイル（16bit モノラルの WAV，またはヘッダの無い raw）をメモリマップで読む．
+
+ファイル全体を読み込まずに，データ部分をコピーせずに切り出して返すので，
+長時間の録音や大量のファイルでもメモリ使用量と開始時の待ちが増えない．
+"""
+
+import mmap
+import struct
+
+
+def parse_wav_header(mm):
+    u"""
+    WAV のヘッダを解析して (サンプリングレート, データの開始位置, データのバイト数) を返す．
+    16bit モノラルの PCM 以外は ValueError
+    """
+    if len(mm) < 12 or mm[0:4] != 'RIFF' or mm[8:12] != 'WAVE':
+        raise ValueError('not a RIFF/WAVE file')
+    rate = None
+    pos = 12
+    while pos + 8 <= len(mm):
+        chunk_id = mm[pos:(pos + 4)]
+        chunk_size, = struct.unpack('<I', mm[(pos + 4):(pos + 8)])
+        body = pos + 8
+        if chunk_id == 'fmt ':
+            if chunk_size < 16:
+                raise ValueError('broken fmt chunk')
+            fmt, channels, rate, _, _, bits = struct.unpack('<HHIIHH', mm[body:(body + 16)])
+            # 1: PCM, 0xFFFE: WAVE_FORMAT_EXTENSIBLE
+            if fmt not in (1, 0xFFFE) or channels != 1 or bits != 16:
+                raise ValueError('only 16bit mono PCM is supported '
+                                 '(format=%d, channels=%d, bits=%d)' % (fmt, channels, bits))
+        elif chunk_id == 'data':
+            if rate is None:
+                raise ValueError('data chunk before fmt chunk')
+            # 録音途中のファイルなどでサイズが正しくない場合はファイルの終わりまでとする
+            size = min(chunk_size, len(mm) - body)
+            return rate, body, size - size % 2
+        # チャンクは2バイト境界に揃えられる
+        pos = body + chunk_size + (chunk_size & 1)
+    raise ValueError('data chunk not found')
+
+
+class PcmFile(object):
+    u"""
+    音声ファイルのデータ部分をメモリマップで提供する．
+    view() の返り値（buffer）は close() するまで有効．
+    """
+
+    def __init__(self, filename, raw_sample_rate=16000, offset=0, length=None):
+        u"""
+        拡張子が .wav ならヘッダを解析し，それ以外は raw_sample_rate の raw とみなす．
+        raw の場合は offset バイト目からの length バイトだけを使える（UtteranceArchive 用）
+        """
+        self.filename = filename
+        self.__handle = open(filename, 'rb')
+        self.__mmap = None
+        try:
+            self.__handle.seek(0, 2)
+            file_size = self.__handle.tell()
+            if file_size > 0:
+                self.__mmap = mmap.mmap(self.__handle.fileno(), 0, access=mmap.ACCESS_READ)
+            if filename.lower().endswith('.wav'):
+                if self.__mmap is None:
+                    raise ValueError('empty WAV file')
+                self.sample_rate, self.__offset, self.size = parse_wav_header(self.__mmap)
+            else:
+                self.sample_rate, self.__offset = raw_sample_rate, offset
+                size = max(0, file_size - offset)
+                if length is not None:
+                    size = min(size, length)
+                self.size = size - size % 2
+        except:
+            self.close()
+            raise
+
+    def view(self, start=0, end=None):
+        u"""
+        データ部分の [start, end) バイトをコピーせずに返す．
+        返り値は len()，str()，numpy.frombuffer() などで bytes と同様に扱える
+        """
+        if end is None or end > self.size:
+            end = self.size
+        if self.__mmap is None or start >= end:
+            return buffer(b'')
+        return buffer(self.__mmap, self.__offset + start, end - start)
+
+    def close(self):
+        if self.__mmap is not None:
+            self.__mmap.close()
+            self.__mmap = None
+        if self.__handle is not None:
+            self.__handle.close()
+            self.__handle = None
@@ -0,0 +1,137 @@
+# encoding: utf-8
+u"""
+1発話分の音声からフレームごとの韻律特徴（RMS と F0）を求める．
+
+F0 は YIN（de Cheveigné & Kawahara, 2002）で求める．差分関数は FFT による相互相関から
+全フレーム・全ラグをまとめて計算し，Python のループは使わない．
+無声・無音のフレームの F0 は 0 とする．
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from concurrent.futures import ThreadPoolExecutor
+
+
+def frame_signal(x, frame_len, hop):
+    u"""x を長さ frame_len，間隔 hop のフレームに分けた (フレーム数, frame_len) のビューを返す"""
+    if len(x) < frame_len:
+        return np.zeros((0, frame_len), dtype=x.dtype)
+    n_frames = 1 + (len(x) - frame_len) // hop
+    stride = x.strides[0]
+    return as_strided(x, shape=(n_frames, frame_len), strides=(hop * stride, stride))
+
+
+def frame_rms(frames):
+    u"""フレームごとの RMS"""
+    if len(frames) == 0:
+        return np.zeros(0)
+    return np.sqrt(np.mean(frames.astype(np.float64) ** 2, axis=1))
+
+
+def yin_f0(frames, rate, window, f0_min=70.0, f0_max=400.0, threshold=0.15):
+    u"""
+    フレームごとの F0（Hz）を YIN で求める．
+    frames の各行は window + rate / f0_min サンプル以上の長さが必要．
+    """
+    tau_min = max(2, int(rate / f0_max))
+    tau_max = int(rate / f0_min)
+    n_frames = len(frames)
+    if n_frames == 0:
+        return np.zeros(0)
+    x = frames[:, :(window + tau_max)].astype(np.float64)
+    length = x.shape[1]
+
+    # 差分関数 d(tau) = e(0) + e(tau) - 2 r(tau)
+    #   r(tau) = sum_{j<window} x[j] x[j+tau]，e(tau) = sum_{j<window} x[j+tau]^2
+    n_fft = 1 << int(np.ceil(np.log2(length + window)))
+    spec = np.fft.rfft(x, n_fft, axis=1)
+    spec_head = np.fft.rfft(x[:, :window], n_fft, axis=1)
+    r = np.fft.irfft(np.conj(spec_head) * spec, n_fft, axis=1)[:, :(tau_max + 1)]
+    cum = np.concatenate([np.zeros((n_frames, 1)), np.cumsum(x ** 2, axis=1)], axis=1)
+    taus = np.arange(tau_max + 1)
+    energy = cum[:, taus + window] - cum[:, taus]
+    d = energy[:, :1] + energy - 2.0 * r
+    d[:, 0] = 0.0
+    d = np.maximum(d, 0.0)
+
+    # 累積平均で正規化した差分関数
+    cmnd = np.ones_like(d)
+    cum_d = np.cumsum(d[:, 1:], axis=1)
+    cmnd[:, 1:] = d[:, 1:] * taus[1:] / np.maximum(cum_d, 1e-12)
+
+    # 閾値を下回る谷のうち最初のものの底（次の値の方が大きくなる最初の点）
+    search = cmnd[:, tau_min:tau_max]
+    rising = search <= cmnd[:, (tau_min + 1):(tau_max + 1)]
+    candidates = (search < threshold) & rising
+    voiced = candidates.any(axis=1)
+    tau = np.argmax(candidates, axis=1) + tau_min
+
+    # 放物線補間で谷の位置を細かく求める
+    rows = np.arange(n_frames)
+    left = cmnd[rows, tau - 1]
+    center = cmnd[rows, tau]
+    right = cmnd[rows, np.minimum(tau + 1, tau_max)]
+    denom = left - 2.0 * center + right
+    curved = np.abs(denom) > 1e-12
+    shift = np.where(curved, 0.5 * (left - right) / np.where(curved, denom, 1.0), 0.0)
+    period = tau + np.clip(shift, -1.0, 1.0)
+    return np.where(voiced, rate / period, 0.0)
+
+
+class ProsodyExtractor(object):
+    u"""
+    1発話分の音声からフレームごとの RMS と F0 を求める．
+    submit() は workers 個のスレッドのプールで計算し，concurrent.futures.Future を返すので，
+    認識スレッドは計算を待たずに次の発話に移れる．
+    """
+
+    def __init__(self, frame_ms=25.0, frame_shift_ms=10.0, f0_min=70.0, f0_max=400.0,
+                 yin_threshold=0.15, silence_rms=100.0, workers=2):
+        self.frame_ms = frame_ms
+        self.frame_shift_ms = frame_shift_ms
+        self.f0_min = f0_min
+        self.f0_max = f0_max
+        self.yin_threshold = yin_threshold
+        # これより RMS が小さいフレームは無音として F0 を 0 にする
+        self.silence_rms = silence_rms
+        self.__executor = ThreadPoolExecutor(workers)
+
+    def extract(self, samples, rate):
+        u"""
+        サンプリングレート rate の samples（int16 の bytes か numpy 配列）から
+        (f0_list, rms_list) を求める．フレーム i は i * frame_shift_ms ミリ秒目から始まる
+        """
+        if not isinstance(samples, np.ndarray):
+            samples = np.frombuffer(samples, dtype='<i2')
+        x = np.ascontiguousarray(samples, dtype=np.float32)
+        window = int(rate * self.frame_ms / 1000.0)
+        hop = int(rate * self.frame_shift_ms / 1000.0)
+        # F0 はラグの分だけ長い区間が必要なので，末尾を 0 で埋める
+        tau_max = int(rate / self.f0_min)
+        n_frames = 0 if len(x) < window else 1 + (len(x) - window) // hop
+        padded = np.concatenate([x, np.zeros(tau_max + 1, dtype=np.float32)])
+        frames = frame_signal(padded, window + tau_max + 1, hop)[:n_frames]
+        rms = frame_rms(frames[:, :window])
+        f0 = yin_f0(frames, rate, window, self.f0_min, self.f0_max, self.yin_threshold)
+        f0[rms < self.silence_rms] = 0.0
+        return f0.tolist(), rms.tolist()
+
+    def submit(self, samples, rate):
+        u"""extract() をプールで実行する．samples は呼び出し後に書き換えたり解放したりしないこと"""
+        return self.__executor.submit(self.extract, samples, rate)
+
+    def shutdown(self, wait=True):
+        self.__executor.shutdown(wait)
+
+
+def create_prosody_extractor(conf):
+    u"""conf.ini の [prosody] が有効なら ProsodyExtractor を作成する"""
+    if not conf.has_section('prosody') or not conf.getboolean('prosody', 'enabled'):
+        return None
+    return ProsodyExtractor(frame_ms=conf.getfloat('prosody', 'frame_ms'),
+                            frame_shift_ms=conf.getfloat('prosody', 'frame_shift_ms'),
+                            f0_min=conf.getfloat('prosody', 'f0_min'),
+                            f0_max=conf.getfloat('prosody', 'f0_max'),
+                            yin_threshold=conf.getfloat('prosody', 'yin_threshold'),
+                            silence_rms=conf.getfloat('prosody', 'silence_rms'),
+                            workers=conf.getint('prosody', 'workers'))
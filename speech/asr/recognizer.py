@@ -0,0 +1,362 @@
+# encoding: utf-8
+from abc import ABCMeta, abstractmethod
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+
+import codec
+import metrics
+
+
+class Alternative(object):
+    u"""認識候補"""
+
+    def __init__(self, transcript, confidence=None):
+        self.transcript = transcript
+        self.confidence = confidence
+
+
+class RecognitionResult(object):
+    u"""
+    ストリーミング認識の結果．
+    google.cloud.speech の結果と同じく alternatives[0].transcript と is_final を持つ．
+    """
+
+    def __init__(self, transcript, is_final, stability=0.0):
+        self.alternatives = [Alternative(transcript)]
+        self.is_final = is_final
+        self.stability = stability
+
+
+class RecognizerBackend(object):
+    u"""
+    音声認識エンジン．
+    streaming_recognize() は audio_stream.read() が None を返すまで音声を読み込み，
+    途中結果・最終結果を順に返すイテレータを返す．
+    送る音声の符号化（codec モジュール）の統計は codec_stats に記録される．
+    """
+    __metaclass__ = ABCMeta
+
+    codec_stats = None
+
+    @abstractmethod
+    def streaming_recognize(self, audio_stream, sample_rate,
+                            language_code='ja-JP', max_alternatives=1,
+                            interim_results=True, single_utterance=False):
+        pass
+
+    def warm_up(self):
+        u"""
+        最初の認識の前に接続や認証を済ませておく（startup.Prewarmer から繰り返し呼ばれる）．
+        何もしなくてよいエンジンはそのままでよい
+        """
+        pass
+
+
+class GoogleRecognizerBackend(RecognizerBackend):
+    u"""
+    Google Cloud Speech API による認識．codec は linear16 か flac．
+    google.cloud の import とクライアントの作成は最初に使うときまで遅らせる
+    """
+
+    def __init__(self, client=None, codec_name='linear16'):
+        if codec_name not in ('linear16', 'flac'):
+            raise ValueError('codec not supported by Google Cloud Speech API: %s' % codec_name)
+        self.__speech = None
+        self.__client = client
+        self.__client_lock = threading.Lock()
+        self.__codec_name = codec_name
+        self.codec_stats = codec.CodecStats(codec_name)
+
+    @property
+    def client(self):
+        with self.__client_lock:
+            if self.__speech is None:
+                from google.cloud import speech
+                self.__speech = speech
+            if self.__client is None:
+                self.__client = self.__speech.Client()
+            return self.__client
+
+    def warm_up(self):
+        u"""
+        google.cloud の import，クライアントの作成（認証情報の読み込み）と
+        API オブジェクト（speech_api）の作成を済ませておく．
+        接続そのものは最初の認識で行われる
+        """
+        # speech_api は最初に参照したときに作られる
+        self.client.speech_api
+
+    def streaming_recognize(self, audio_stream, sample_rate,
+                            language_code='ja-JP', max_alternatives=1,
+                            interim_results=True, single_utterance=False):
+        client = self.client
+        encoder = codec.create_encoder(self.__codec_name, sample_rate)
+        sample = client.sample(stream=codec.EncodedStream(audio_stream, encoder,
+                                                          self.codec_stats),
+                               encoding=getattr(self.__speech.Encoding, encoder.encoding),
+                               sample_rate_hertz=sample_rate)
+        return sample.streaming_recognize(
+            interim_results=interim_results,
+            single_utterance=single_utterance,
+            language_code=language_code,
+            max_alternatives=max_alternatives
+        )
+
+
+class LocalRecognizerBackend(RecognizerBackend):
+    u"""
+    クラウドを使わない決定的な代替認識エンジン（負荷試験・ベンチマーク用）．
+
+    音声の中身は見ずに，与えられた書き起こし文を呼び出しごとに順番に返す．
+    音声を interim_interval_sec 秒分読むごとに書き起こし文を1文字ずつ伸ばした途中結果を返し，
+    音声の終わり（single_utterance の場合は全文字を出し終えた時点）で最終結果を返す．
+    各結果を返す前に result_latency_sec 秒，最終結果の前にはさらに final_latency_sec 秒待つ．
+    codec_name（linear16 か dpcm）を与えると，音声を符号化して受け取り，復号して数える．
+    """
+
+    def __init__(self, transcripts, chunk_size=4096, interim_interval_sec=0.3,
+                 result_latency_sec=0.0, final_latency_sec=0.0, codec_name='linear16'):
+        if not transcripts:
+            raise ValueError('at least one transcript is required')
+        self.__transcripts = list(transcripts)
+        self.__chunk_size = chunk_size
+        self.__interim_interval_sec = interim_interval_sec
+        self.__result_latency_sec = result_latency_sec
+        self.__final_latency_sec = final_latency_sec
+        self.__counter = itertools.count()
+        self.__lock = threading.Lock()
+        # 復号できない符号化はここで弾く
+        codec.create_decoder(codec_name)
+        self.__codec_name = codec_name
+        self.codec_stats = codec.CodecStats(codec_name)
+
+    def __next_transcript(self):
+        with self.__lock:
+            index = next(self.__counter)
+        return self.__transcripts[index % len(self.__transcripts)]
+
+    def __result(self, transcript, is_final):
+        if self.__result_latency_sec > 0:
+            time.sleep(self.__result_latency_sec)
+        return RecognitionResult(transcript, is_final, stability=1.0 if is_final else 0.5)
+
+    def streaming_recognize(self, audio_stream, sample_rate,
+                            language_code='ja-JP', max_alternatives=1,
+                            interim_results=True, single_utterance=False):
+        transcript = self.__next_transcript()
+        # 途中結果を1つ返すまでに読む音声のバイト数
+        interval_bytes = max(1, int(self.__interim_interval_sec * sample_rate) * 2)
+        received = 0
+        emitted = 0
+        if self.__codec_name != 'linear16':
+            encoder = codec.create_encoder(self.__codec_name, sample_rate)
+            audio_stream = codec.EncodedStream(audio_stream, encoder, self.codec_stats)
+        decoder = codec.create_decoder(self.__codec_name)
+        while True:
+            data = audio_stream.read_view(self.__chunk_size)
+            if data is None:
+                break
+            received += len(decoder.decode(data))
+            if received < interval_bytes * (emitted + 1):
+                continue
+            emitted += 1
+            if emitted < len(transcript):
+                if interim_results:
+                    yield self.__result(transcript[:emitted], False)
+            elif single_utterance:
+                # 全文字を出し終えたら発話終了とみなす
+                break
+        if self.__final_latency_sec > 0:
+            time.sleep(self.__final_latency_sec)
+        yield self.__result(transcript, True)
+
+
+class CachingRecognizerBackend(RecognizerBackend):
+    u"""
+    認識結果をディスクにキャッシュする認識エンジンのラッパー．
+
+    音声全体が認識開始時に分かるストリーム（content_available が True のもの，
+    FileAudioStream など）について，音声の内容と認識のパラメータのハッシュをキーにして
+    途中結果・最終結果の列を directory に保存する．同じ音声が来たら backend を使わずに
+    保存した列をそのまま返す．マイク入力のストリームはキャッシュせず backend に渡す．
+    合計サイズが max_bytes を超えたら，最後に使われたのが古いものから消す．
+    索引と回数は1つのインスタンスが持つので，同じ directory を使うスレッドは
+    インスタンスを共有すること（recognition_cache_events_total{event=...} としても公開する）．
+    """
+
+    def __init__(self, backend, directory, max_bytes=256 * 1024 * 1024, namespace=None):
+        u"""namespace は同じ音声でも結果が異なる設定（認識エンジンの種類など）を区別するための文字列"""
+        self.backend = backend
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.__max_bytes = max_bytes
+        self.__namespace = namespace if namespace is not None else type(backend).__name__
+        self.__lock = threading.Lock()
+        self.__sizes = {}
+        for name in os.listdir(directory):
+            if name.endswith('.json'):
+                self.__sizes[name] = os.path.getsize(os.path.join(directory, name))
+        self.__stats = {'hits': 0, 'misses': 0, 'bypassed': 0, 'stored': 0, 'evicted': 0}
+        self.__counters = dict(
+            (name, metrics.counter('recognition_cache_events_total',
+                                   u'認識結果のキャッシュのヒット・ミス・保存・削除などの回数',
+                                   event=name))
+            for name in self.__stats)
+
+    @property
+    def codec_stats(self):
+        return self.backend.codec_stats
+
+    def warm_up(self):
+        self.backend.warm_up()
+
+    def stats(self):
+        u"""
+        ヒット・ミス・キャッシュ対象外・保存・削除の回数，ヒット率（キャッシュ対象のうち），
+        キャッシュの件数・バイト数
+        """
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats['entries'] = len(self.__sizes)
+            stats['bytes'] = sum(self.__sizes.values())
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / float(lookups) if lookups else None
+        return stats
+
+    def format_stats(self):
+        u"""stats() を1行の文字列にする（終了時の表示用）"""
+        stats = self.stats()
+        hit_rate = '-' if stats['hit_rate'] is None else '%.1f%%' % (100 * stats['hit_rate'])
+        return ('CACHE: hit_rate=%s hits=%d misses=%d bypassed=%d stored=%d evicted=%d '
+                'entries=%d bytes=%d') % (
+                    hit_rate, stats['hits'], stats['misses'], stats['bypassed'],
+                    stats['stored'], stats['evicted'], stats['entries'], stats['bytes'])
+
+    def __count(self, name):
+        with self.__lock:
+            self.__stats[name] += 1
+        self.__counters[name].inc()
+
+    def cache_key(self, audio_data, params):
+        u"""音声の内容と認識のパラメータから決まるキー"""
+        digest = hashlib.sha1()
+        digest.update(json.dumps([self.__namespace, params], sort_keys=True))
+        digest.update(audio_data)
+        return digest.hexdigest()
+
+    def __load(self, name):
+        filename = os.path.join(self.directory, name)
+        try:
+            with open(filename, 'rb') as f:
+                results = json.load(f)
+        except (IOError, ValueError):
+            return None
+        # 最後に使った時刻を更新する（古いものから消すため）
+        os.utime(filename, None)
+        return [RecognitionResult(r['transcript'], r['is_final'], r['stability'])
+                for r in results]
+
+    def __store(self, name, results):
+        data = json.dumps([{'transcript': r.alternatives[0].transcript,
+                            'is_final': r.is_final,
+                            'stability': getattr(r, 'stability', 0.0)} for r in results])
+        filename = os.path.join(self.directory, name)
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(data)
+        os.rename(filename + '.tmp', filename)
+        with self.__lock:
+            self.__sizes[name] = len(data)
+        self.__count('stored')
+        self.__evict()
+
+    def __evict(self):
+        with self.__lock:
+            total = sum(self.__sizes.values())
+            if total <= self.__max_bytes:
+                return
+            names = list(self.__sizes)
+        def last_used(name):
+            try:
+                return os.path.getmtime(os.path.join(self.directory, name))
+            except OSError:
+                return 0
+        for name in sorted(names, key=last_used):
+            if total <= self.__max_bytes:
+                break
+            with self.__lock:
+                size = self.__sizes.pop(name, 0)
+            self.__count('evicted')
+            total -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def streaming_recognize(self, audio_stream, sample_rate,
+                            language_code='ja-JP', max_alternatives=1,
+                            interim_results=True, single_utterance=False):
+        audio_data = audio_stream.get_data() if audio_stream.content_available else None
+        if not audio_data:
+            self.__count('bypassed')
+            for result in self.backend.streaming_recognize(
+                    audio_stream, sample_rate, language_code=language_code,
+                    max_alternatives=max_alternatives, interim_results=interim_results,
+                    single_utterance=single_utterance):
+                yield result
+            return
+        params = {'language_code': language_code, 'sample_rate_hertz': sample_rate,
+                  'max_alternatives': max_alternatives, 'interim_results': interim_results,
+                  'single_utterance': single_utterance}
+        name = self.cache_key(audio_data, params) + '.json'
+        cached = self.__load(name) if name in self.__sizes else None
+        if cached is not None:
+            self.__count('hits')
+            for result in cached:
+                yield result
+            return
+        self.__count('misses')
+        results = []
+        for result in self.backend.streaming_recognize(
+                audio_stream, sample_rate, language_code=language_code,
+                max_alternatives=max_alternatives, interim_results=interim_results,
+                single_utterance=single_utterance):
+            results.append(result)
+            yield result
+        # 最後まで認識できた場合のみ保存する
+        self.__store(name, results)
+
+
+def create_backend(conf):
+    u"""conf.ini の [recognition] backend に従って認識エンジンを作成する"""
+    codec_name = 'linear16'
+    if conf.has_option('recognition', 'codec'):
+        codec_name = conf.get('recognition', 'codec')
+    backend = _create_backend(conf, codec_name)
+    # 再生した音声の認識結果をキャッシュする
+    if conf.has_section('cache') and conf.getboolean('cache', 'enabled'):
+        backend = CachingRecognizerBackend(
+            backend, conf.get('cache', 'directory'),
+            max_bytes=int(conf.getfloat('cache', 'max_mb') * 1024 * 1024),
+            namespace='%s/%s' % (type(backend).__name__, codec_name))
+    return backend
+
+
+def _create_backend(conf, codec_name):
+    if not conf.has_option('recognition', 'backend') or \
+       conf.get('recognition', 'backend') == 'google':
+        return GoogleRecognizerBackend(codec_name=codec_name)
+    if conf.get('recognition', 'backend') == 'local':
+        transcripts = conf.get('local_backend', 'transcripts').decode('utf-8').split(u'|')
+        return LocalRecognizerBackend(
+            transcripts,
+            chunk_size=conf.getint('local_backend', 'chunk_size'),
+            interim_interval_sec=conf.getfloat('local_backend', 'interim_interval_sec'),
+            result_latency_sec=conf.getfloat('local_backend', 'result_latency_sec'),
+            final_latency_sec=conf.getfloat('local_backend', 'final_latency_sec'),
+            codec_name=codec_name)
+    raise ValueError('unknown recognition backend: %s' % conf.get('recognition', 'backend'))
@@ -1,29 +1,48 @@
 # encoding: utf-8
+import os
 import sys
+import json
+import time
+import threading
 from abc import ABCMeta, abstractmethod
+from collections import deque
+
+import numpy as np
+
+from clock import monotonic
+from tracing import trace_key
+import metrics
+
+# 標準出力に書く ResultWatcher が共有するロック（複数行の出力が他の発話と混ざらないように）
+_stdout_lock = threading.Lock()
 
 class ResultWatcher(object):
+    u"""
+    認識の開始・途中結果・終了などの通知を受け取る．
+    device は発話を録音したデバイスの名前（単一のデバイスの場合は None）で，
+    Audio ID はデバイスごとに振られるので，(device, audio_id) で発話を区別する
+    """
     __metaclass__ = ABCMeta
 
     def __init__(self):
         pass
 
     @abstractmethod
-    def notify_start(self, audio_id):
+    def notify_start(self, audio_id, device=None):
         pass
 
     @abstractmethod
-    def notify_abort(self, audio_id):
+    def notify_abort(self, audio_id, device=None):
         pass
         
     @abstractmethod
-    def notify_interim_result(self, audio_id, result):
+    def notify_interim_result(self, audio_id, result, device=None):
         pass
 
     @abstractmethod
     def notify_finish(self, audio_id, recognition_result,
                       phone_list, endtime_list,
-                      f0_list, rms_list):
+                      f0_list, rms_list, device=None):
         pass
 
 class StdoutResultWatcher(ResultWatcher):
@@ -31,128 +50,504 @@ class StdoutResultWatcher(ResultWatcher):
     def __init__(self):
         ResultWatcher.__init__(self)
 
-    def notify_start(self, audio_id):
-        print "SPEECH RECOGNITION START (AUDIO ID=%d)" % audio_id
-        sys.stdout.flush()
+    def notify_start(self, audio_id, device=None):
+        with _stdout_lock:
+            print "SPEECH RECOGNITION START (AUDIO ID=%s)" % trace_key(device, audio_id)
+            sys.stdout.flush()
 
-    def notify_abort(self, audio_id):
-        print "SPEECH RECOGNITION ABORT (AUDIO ID=%d)" % audio_id
-        sys.stdout.flush()
+    def notify_abort(self, audio_id, device=None):
+        with _stdout_lock:
+            print "SPEECH RECOGNITION ABORT (AUDIO ID=%s)" % trace_key(device, audio_id)
+            sys.stdout.flush()
 
-    def notify_interim_result(self, audio_id, result):
-        if type(result) == unicode:
-            result = result.encode('utf-8')
-        print "\r",
-        print result,
-        sys.stdout.flush()
+    def notify_interim_result(self, audio_id, result, device=None):
+        with _stdout_lock:
+            if type(result) == unicode:
+                result = result.encode('utf-8')
+            print "\r",
+            if device is not None:
+                print "[%s]" % device,
+            print result,
+            sys.stdout.flush()
 
     def notify_finish(self, audio_id, recognition_result,
-                      phone_list, endtime_list, f0_list, rms_list):
-        if type(recognition_result) == unicode:
-            recognition_result = recognition_result.encode('utf-8')
-        print ''
-        print "SPEECH RECOGNITION END (AUDIO ID=%d)" % audio_id
-        print recognition_result        
-        if len(phone_list) > 0 and len(phone_list) == len(endtime_list):
-            for phone, endtime in zip(phone_list, endtime_list):
-                print '%s(%d)' % (phone, endtime),
+                      phone_list, endtime_list, f0_list, rms_list, device=None):
+        with _stdout_lock:
+            if type(recognition_result) == unicode:
+                recognition_result = recognition_result.encode('utf-8')
             print ''
-        if len(f0_list) > 0 or len(rms_list) > 0:
-            print 'SIZE OF F0 LIST=%d, SIZE OF RMS LIST=%d' % (len(f0_list), len(rms_list))
-        sys.stdout.flush()
+            print "SPEECH RECOGNITION END (AUDIO ID=%s)" % trace_key(device, audio_id)
+            print recognition_result
+            if len(phone_list) > 0 and len(phone_list) == len(endtime_list):
+                for phone, endtime in zip(phone_list, endtime_list):
+                    print '%s(%d)' % (phone, endtime),
+                print ''
+            if len(f0_list) > 0 or len(rms_list) > 0:
+                print 'SIZE OF F0 LIST=%d, SIZE OF RMS LIST=%d' % (len(f0_list), len(rms_list))
+            sys.stdout.flush()
 
 class StdoutResultWatcherForDisplay(ResultWatcher):
 
     def __init__(self):
         ResultWatcher.__init__(self)
 
-    def notify_start(self, audio_id):
-        print "SPEECH RECOGNITION START (AUDIO ID=%d)" % audio_id
-        sys.stdout.flush()
-
-    def notify_abort(self, audio_id):
-        print "SPEECH RECOGNITION ABORT (AUDIO ID=%d)" % audio_id
-        sys.stdout.flush()
-
-    def notify_interim_result(self, audio_id, result):
-        if type(result) == unicode:
-            result = result.encode('utf-8')
-        print "INTERIM RESULT RECEIVED (AUDIO ID=%d)" % audio_id
-        print "<BEGIN RECOGNITION RESULT>"
-        print result
-        print ""
-        print ""
-        print ""
-        print ""
-        print "<END RECOGNITION RESULT>"
-        sys.stdout.flush()
+    def notify_start(self, audio_id, device=None):
+        with _stdout_lock:
+            print "SPEECH RECOGNITION START (AUDIO ID=%s)" % trace_key(device, audio_id)
+            sys.stdout.flush()
+
+    def notify_abort(self, audio_id, device=None):
+        with _stdout_lock:
+            print "SPEECH RECOGNITION ABORT (AUDIO ID=%s)" % trace_key(device, audio_id)
+            sys.stdout.flush()
+
+    def notify_interim_result(self, audio_id, result, device=None):
+        with _stdout_lock:
+            if type(result) == unicode:
+                result = result.encode('utf-8')
+            print "INTERIM RESULT RECEIVED (AUDIO ID=%s)" % trace_key(device, audio_id)
+            print "<BEGIN RECOGNITION RESULT>"
+            print result
+            print ""
+            print ""
+            print ""
+            print ""
+            print "<END RECOGNITION RESULT>"
+            sys.stdout.flush()
 
     def notify_finish(self, audio_id, recognition_result,
-                      phone_list, endtime_list, f0_list, rms_list):
-        if type(recognition_result) == unicode:
-            recognition_result = recognition_result.encode('utf-8')
+                      phone_list, endtime_list, f0_list, rms_list, device=None):
+        with _stdout_lock:
+            if type(recognition_result) == unicode:
+                recognition_result = recognition_result.encode('utf-8')
 
-        print "FINAL RESULT RECEIVED (AUDIO ID=%d)" % audio_id
-        print "<BEGIN RECOGNITION RESULT>"
-        print recognition_result
-        print ' '.join(phone_list)
-        print ' '.join(["%d" % x for x in endtime_list])
-        print ' '.join(["%g" % x for x in f0_list])
-        print ' '.join(["%g" % x for x in rms_list])
-        print "<END RECOGNITION RESULT>"
-        sys.stdout.flush()
+            print "FINAL RESULT RECEIVED (AUDIO ID=%s)" % trace_key(device, audio_id)
+            print "<BEGIN RECOGNITION RESULT>"
+            print recognition_result
+            print ' '.join(phone_list)
+            print ' '.join(["%d" % x for x in endtime_list])
+            print ' '.join(["%g" % x for x in f0_list])
+            print ' '.join(["%g" % x for x in rms_list])
+            print "<END RECOGNITION RESULT>"
+            sys.stdout.flush()
 
 class StdoutResultWatcherForAnalysis(ResultWatcher):
-    u"""オフライン分析のために，標準出力にシンプルな出力を行うResultWatcher"""
-    def __init__(self):
+    u"""
+    オフライン分析のために，標準出力にシンプルな出力を行うResultWatcher．
+    out にファイルを与えると標準出力の代わりにそこへ出力する．
+    1発話分の出力はまとめて書き込むので，複数スレッドから呼ばれても混ざらない．
+    """
+    def __init__(self, out=None):
         ResultWatcher.__init__(self)
+        self.__out = out if out is not None else sys.stdout
+        self.__lock = threading.Lock()
 
-    def notify_start(self, audio_id):
+    def notify_start(self, audio_id, device=None):
         pass
 
-    def notify_abort(self, audio_id):
+    def notify_abort(self, audio_id, device=None):
         pass
         
-    def notify_interim_result(self, audio_id, result):
+    def notify_interim_result(self, audio_id, result, device=None):
         pass
 
     def notify_finish(self, audio_id, recognition_result,
                       phone_list, endtime_list,
-                      f0_list, rms_list):
-        print audio_id
-        print recognition_result
-        print ' '.join(phone_list)
-        print ' '.join(["%d" % x for x in endtime_list])
-        print ' '.join(["%g" % x for x in f0_list])
-        print ' '.join(["%g" % x for x in rms_list])
+                      f0_list, rms_list, device=None):
+        if type(recognition_result) == unicode:
+            recognition_result = recognition_result.encode('utf-8')
+        lines = ["%s" % trace_key(device, audio_id),
+                 recognition_result,
+                 ' '.join(phone_list),
+                 ' '.join(["%d" % x for x in endtime_list]),
+                 ' '.join(["%g" % x for x in f0_list]),
+                 ' '.join(["%g" % x for x in rms_list])]
+        with self.__lock:
+            self.__out.write('\n'.join(lines) + '\n')
+            self.__out.flush()
         
 
+class LogResultWatcher(ResultWatcher):
+    u"""
+    全ての通知を JSONL ファイルに記録する ResultWatcher．
+    1行が1つの通知で，event（start / interim / finish / abort），audio_id，time（UNIX時刻），
+    transcript を持つ．複数のデバイスを使う場合は device（デバイス名）も持つ．finish は phones，endtimes，f0，rms も持つ．
+
+    書き込みはメモリ上にまとめ，flush_bytes 溜まるか flush_interval_sec 経つごとに
+    専用のスレッドで行う．ファイルは prefix-YYYYmmdd-HHMMSS.jsonl という名前で作り，
+    max_bytes を超えるか max_age_sec 経ったら次のファイルに切り替える．
+
+    binary_arrays が True の場合は，数値の配列を同じ名前の .bin ファイルに
+    endtimes（int32），f0（float32），rms（float32）の順のリトルエンディアンで書き，
+    JSONL には {"offset": .bin 内の位置, "count": 要素数} だけを書く．
+    load_result_log() で配列を復元して読める．
+    """
+
+    def __init__(self, prefix, max_bytes=64 * 1024 * 1024, max_age_sec=3600.0,
+                 flush_bytes=64 * 1024, flush_interval_sec=1.0, binary_arrays=False):
+        ResultWatcher.__init__(self)
+        self.__prefix = prefix
+        self.__max_bytes = max_bytes
+        self.__max_age_sec = max_age_sec
+        self.__flush_bytes = flush_bytes
+        self.__flush_interval_sec = flush_interval_sec
+        self.__binary_arrays = binary_arrays
+        directory = os.path.dirname(prefix)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.__cond = threading.Condition()
+        # 書き込み待ちの (JSONL の行, .bin に書くデータ) のリスト
+        self.__buffer = []
+        self.__buffer_bytes = 0
+        self.__closed = False
+        self.__file = None
+        self.__bin_file = None
+        self.__opened_time = None
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    @property
+    def filename(self):
+        u"""現在書き込んでいる JSONL ファイルの名前（まだ無い場合は None）"""
+        return None if self.__file is None else self.__file.name
+
+    def __append(self, record, arrays=None, device=None):
+        record['time'] = time.time()
+        if device is not None:
+            record['device'] = device
+        if arrays is None:
+            item = encode_record(record)
+            size = len(item)
+        else:
+            # .bin 内の位置が決まるまで行にはしない
+            item = record
+            size = len(arrays)
+        with self.__cond:
+            if self.__closed:
+                return
+            self.__buffer.append((item, arrays))
+            self.__buffer_bytes += size
+            if self.__buffer_bytes >= self.__flush_bytes:
+                self.__cond.notify()
+
+    def notify_start(self, audio_id, device=None):
+        self.__append({'event': 'start', 'audio_id': audio_id}, device=device)
+
+    def notify_abort(self, audio_id, device=None):
+        self.__append({'event': 'abort', 'audio_id': audio_id}, device=device)
+
+    def notify_interim_result(self, audio_id, result, device=None):
+        self.__append({'event': 'interim', 'audio_id': audio_id, 'transcript': result},
+                      device=device)
+
+    def notify_finish(self, audio_id, recognition_result,
+                      phone_list, endtime_list, f0_list, rms_list, device=None):
+        record = {'event': 'finish', 'audio_id': audio_id, 'transcript': recognition_result,
+                  'phones': list(phone_list)}
+        if not self.__binary_arrays:
+            record['endtimes'] = [int(x) for x in endtime_list]
+            record['f0'] = [float(x) for x in f0_list]
+            record['rms'] = [float(x) for x in rms_list]
+            self.__append(record, device=device)
+            return
+        arrays = (np.asarray(endtime_list, dtype='<i4').tostring() +
+                  np.asarray(f0_list, dtype='<f4').tostring() +
+                  np.asarray(rms_list, dtype='<f4').tostring())
+        record['arrays'] = {'count': [len(endtime_list), len(f0_list), len(rms_list)]}
+        self.__append(record, arrays, device=device)
+
+    def __open(self):
+        base = '%s-%s' % (self.__prefix, time.strftime('%Y%m%d-%H%M%S'))
+        name = base
+        n = 1
+        while os.path.exists(name + '.jsonl'):
+            # 1秒以内に切り替えた場合
+            name = '%s-%d' % (base, n)
+            n += 1
+        self.__file = open(name + '.jsonl', 'ab')
+        self.__file_bytes = 0
+        if self.__binary_arrays:
+            self.__bin_file = open(name + '.bin', 'ab')
+        self.__opened_time = monotonic()
+
+    def __close_files(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+        if self.__bin_file is not None:
+            self.__bin_file.close()
+            self.__bin_file = None
+
+    def __needs_rotation(self):
+        return self.__file is None or self.__file_bytes >= self.__max_bytes or \
+            monotonic() - self.__opened_time >= self.__max_age_sec
+
+    def __write(self, buffer):
+        lines = []
+        for item, arrays in buffer:
+            if self.__needs_rotation():
+                # 記録の途中ではファイルを切り替えない
+                if lines:
+                    self.__file.write(''.join(lines))
+                    lines = []
+                self.__close_files()
+                self.__open()
+            if arrays is not None:
+                item['arrays']['offset'] = self.__bin_file.tell()
+                self.__bin_file.write(arrays)
+                item = encode_record(item)
+            lines.append(item)
+            self.__file_bytes += len(item)
+        self.__file.write(''.join(lines))
+        self.__file.flush()
+        if self.__bin_file is not None:
+            self.__bin_file.flush()
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                if not self.__closed and self.__buffer_bytes < self.__flush_bytes:
+                    self.__cond.wait(self.__flush_interval_sec)
+                buffer, self.__buffer = self.__buffer, []
+                self.__buffer_bytes = 0
+                closed = self.__closed
+            if buffer:
+                try:
+                    self.__write(buffer)
+                except (IOError, OSError) as e:
+                    print >> sys.stderr, "RESULT LOG ERROR:", e
+            if closed:
+                self.__close_files()
+                return
+
+    def close(self, timeout=None):
+        u"""残りを書き込んでファイルを閉じる"""
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notify()
+        self.__thread.join(timeout)
+
+
+def encode_record(record):
+    u"""記録を JSONL の1行（utf-8，改行付き）にする"""
+    line = json.dumps(record, ensure_ascii=False)
+    if type(line) == unicode:
+        line = line.encode('utf-8')
+    return line + '\n'
+
+
+def load_result_log(filename):
+    u"""
+    LogResultWatcher の JSONL ファイルを読み，記録を順に返す．
+    配列が .bin に書かれている場合は endtimes，f0，rms を numpy の配列として復元する
+    """
+    base, _ = os.path.splitext(filename)
+    bin_file = None
+    try:
+        with open(filename, 'rb') as f:
+            for line in f:
+                record = json.loads(line.decode('utf-8'))
+                arrays = record.pop('arrays', None)
+                if arrays is not None:
+                    if bin_file is None:
+                        bin_file = open(base + '.bin', 'rb')
+                    n_endtimes, n_f0, n_rms = arrays['count']
+                    bin_file.seek(arrays['offset'])
+                    data = bin_file.read(4 * (n_endtimes + n_f0 + n_rms))
+                    values = [np.frombuffer(data, dtype='<i4', count=n_endtimes),
+                              np.frombuffer(data, dtype='<f4', count=n_f0,
+                                            offset=4 * n_endtimes),
+                              np.frombuffer(data, dtype='<f4', count=n_rms,
+                                            offset=4 * (n_endtimes + n_f0))]
+                    record['endtimes'], record['f0'], record['rms'] = values
+                yield record
+    finally:
+        if bin_file is not None:
+            bin_file.close()
+
+
+class AsyncResultWatcher(ResultWatcher):
+    u"""
+    ResultWatcher を専用のスレッドで呼び出すラッパー．
+    認識スレッドは通知をキューに入れるだけなので，出力先が遅くても認識は止まらない．
+
+    途中結果は，同じ発話（デバイスと Audio ID）の未配送の途中結果があればそれを新しいもので置き換える．
+    キューに max_pending 個以上溜まっている場合，新しい途中結果は捨てる．
+    開始・中断・終了の通知は捨てない．
+    配送数・置き換え・捨てた数・遅れ・キューの長さは stats() で得られ，
+    メトリクス（result_watcher_*{watcher=クラス名}）としても公開する．
+    """
+
+    def __init__(self, watcher, max_pending=100):
+        ResultWatcher.__init__(self)
+        self.watcher = watcher
+        self.__max_pending = max_pending
+        self.__cond = threading.Condition()
+        # (メソッド名, 引数, キューに入れた時刻) のリスト．途中結果は置き換えられるようにリストで持つ
+        self.__queue = deque()
+        # (デバイス名, Audio ID) → 未配送の途中結果
+        self.__pending_interim = {}
+        self.__closed = False
+        self.__stats = {'delivered': 0, 'coalesced': 0, 'dropped': 0,
+                        'lag_sec': 0.0, 'max_lag_sec': 0.0}
+        name = type(watcher).__name__
+        self.__delivered = metrics.counter(
+            'result_watcher_delivered_total', u'ResultWatcher に配送した通知の数', watcher=name)
+        self.__coalesced = metrics.counter(
+            'result_watcher_coalesced_total', u'新しいものに置き換えた途中結果の数', watcher=name)
+        self.__dropped = metrics.counter(
+            'result_watcher_dropped_total', u'キューが一杯で捨てた途中結果の数', watcher=name)
+        self.__lag_sec = metrics.histogram(
+            'result_watcher_lag_seconds', u'通知をキューに入れてから配送するまでの時間',
+            watcher=name)
+        metrics.gauge('result_watcher_pending', u'配送を待っている通知の数',
+                      watcher=name).set_function(lambda: len(self.__queue))
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stats(self):
+        u"""配送数，置き換えた途中結果の数，捨てた途中結果の数，遅れ（秒），キューの長さ"""
+        with self.__cond:
+            stats = dict(self.__stats)
+            stats['pending'] = len(self.__queue)
+        return stats
+
+    def __put(self, method, args):
+        with self.__cond:
+            if self.__closed:
+                return
+            self.__queue.append([method, args, monotonic()])
+            self.__cond.notify()
+
+    def notify_start(self, audio_id, device=None):
+        self.__put('notify_start', (audio_id, device))
+
+    def notify_abort(self, audio_id, device=None):
+        self.__put('notify_abort', (audio_id, device))
+
+    def notify_interim_result(self, audio_id, result, device=None):
+        with self.__cond:
+            if self.__closed:
+                return
+            key = (device, audio_id)
+            item = self.__pending_interim.get(key)
+            if item is not None:
+                # 配送前の途中結果を置き換える（キュー内の位置と時刻はそのまま）
+                item[1] = (audio_id, result, device)
+                self.__stats['coalesced'] += 1
+                self.__coalesced.inc()
+                return
+            if len(self.__queue) >= self.__max_pending:
+                self.__stats['dropped'] += 1
+                self.__dropped.inc()
+                return
+            item = ['notify_interim_result', (audio_id, result, device), monotonic()]
+            self.__pending_interim[key] = item
+            self.__queue.append(item)
+            self.__cond.notify()
+
+    def notify_finish(self, audio_id, recognition_result,
+                      phone_list, endtime_list, f0_list, rms_list, device=None):
+        self.__put('notify_finish', (audio_id, recognition_result,
+                                     phone_list, endtime_list, f0_list, rms_list, device))
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                while not self.__queue and not self.__closed:
+                    self.__cond.wait()
+                if not self.__queue:
+                    return
+                method, args, queued_time = item = self.__queue.popleft()
+                if method == 'notify_interim_result':
+                    key = (args[2], args[0])
+                    if self.__pending_interim.get(key) is item:
+                        del self.__pending_interim[key]
+            lag = monotonic() - queued_time
+            try:
+                getattr(self.watcher, method)(*args)
+            except Exception as e:
+                print >> sys.stderr, "RESULT WATCHER ERROR:", e
+            self.__delivered.inc()
+            self.__lag_sec.observe(lag)
+            with self.__cond:
+                self.__stats['delivered'] += 1
+                self.__stats['lag_sec'] = lag
+                self.__stats['max_lag_sec'] = max(self.__stats['max_lag_sec'], lag)
+                self.__cond.notifyAll()
+
+    def flush(self, timeout=None):
+        u"""キューが空になるまで待つ．timeout 以内に空になった場合は True を返す"""
+        end_time = None if timeout is None else monotonic() + timeout
+        with self.__cond:
+            while self.__queue:
+                remaining = None if end_time is None else end_time - monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.__cond.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        u"""残りの通知を配送してからスレッドを終了する"""
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notifyAll()
+        self.__thread.join(timeout)
+
+
 class CombinedResultWatcher(ResultWatcher):
+    u"""
+    複数の ResultWatcher に通知を配る．
+    async_mode が True の場合は，各 ResultWatcher を AsyncResultWatcher で包み，
+    それぞれ専用のスレッドで呼び出す．
+    """
 
-    def __init__(self):
+    def __init__(self, async_mode=False, max_pending=100):
         ResultWatcher.__init__(self)
 
         self._watchers = []
+        self.__async_mode = async_mode
+        self.__max_pending = max_pending
 
     def add_watcher(self, watcher):
         if not isinstance(watcher, ResultWatcher):
             raise RuntimeError('given object is not a ResultWatcher')
+        if self.__async_mode:
+            watcher = AsyncResultWatcher(watcher, self.__max_pending)
         self._watchers.append(watcher)
 
-    def notify_start(self, audio_id):
+    def stats(self):
+        u"""async_mode の場合に，ResultWatcher のクラス名ごとの AsyncResultWatcher.stats()"""
+        return dict((type(w.watcher).__name__, w.stats())
+                    for w in self._watchers if isinstance(w, AsyncResultWatcher))
+
+    def close(self, timeout=None):
+        u"""async_mode の場合は，残りの通知を配送してから各 ResultWatcher の stats() を表示する"""
+        for watcher in self._watchers:
+            if isinstance(watcher, AsyncResultWatcher):
+                watcher.close(timeout)
+        for name, stats in sorted(self.stats().items()):
+            print >> sys.stderr, "RESULT WATCHER (%s): delivered=%d coalesced=%d dropped=%d " \
+                "max_lag=%.0fms pending=%d" % (name, stats['delivered'], stats['coalesced'],
+                                              stats['dropped'], 1000 * stats['max_lag_sec'],
+                                              stats['pending'])
+
+    def notify_start(self, audio_id, device=None):
         for watcher in self._watchers:
-            watcher.notify_start(audio_id)
+            watcher.notify_start(audio_id, device)
         
-    def notify_abort(self, audio_id):
+    def notify_abort(self, audio_id, device=None):
         for watcher in self._watchers:
-            watcher.notify_abort(audio_id)
+            watcher.notify_abort(audio_id, device)
 
-    def notify_interim_result(self, audio_id, result):
+    def notify_interim_result(self, audio_id, result, device=None):
         for watcher in self._watchers:
-            watcher.notify_interim_result(audio_id, result)
+            watcher.notify_interim_result(audio_id, result, device)
 
     def notify_finish(self, audio_id, recognition_result,
-                      phone_list, endtime_list, f0_list, rms_list):
+                      phone_list, endtime_list, f0_list, rms_list, device=None):
         for watcher in self._watchers:
             watcher.notify_finish(audio_id, recognition_result,
-                      phone_list, endtime_list, f0_list, rms_list)
+                                  phone_list, endtime_list, f0_list, rms_list, device)
@@ -0,0 +1,106 @@
+# encoding: utf-8
+
+
+class RingBuffer(object):
+    u"""
+    容量固定の single-producer / single-consumer リングバッファ．
+
+    領域は生成時に確保され，以降は確保・解放を行わない．
+    read() はコピーせずに memoryview を返す（末尾をまたぐ場合のみ作業領域にコピーする）．
+    返された memoryview は次に read() か release() が呼ばれるまで有効で，
+    それまでは書き込み側に上書きされない．
+    ロックは持たないので，呼び出し側で排他すること．
+    """
+
+    def __init__(self, capacity):
+        self.__capacity = capacity
+        self.__buff = bytearray(capacity)
+        self.__view = memoryview(self.__buff)
+        self.__scratch = bytearray()
+        self.reset()
+
+    def reset(self):
+        u"""内容を空にする．確保済みの領域はそのまま使い回す"""
+        self.__write_count = 0
+        self.__read_count = 0
+        self.__pending = 0
+        self.__overrun_bytes = 0
+
+    @property
+    def capacity(self):
+        return self.__capacity
+
+    @property
+    def write_count(self):
+        u"""reset() 以降に書き込まれた総バイト数"""
+        return self.__write_count
+
+    @property
+    def read_count(self):
+        u"""reset() 以降に読み出された総バイト数"""
+        return self.__read_count + self.__pending
+
+    @property
+    def overrun_bytes(self):
+        u"""空きが足りずに捨てたバイト数"""
+        return self.__overrun_bytes
+
+    def readable(self):
+        u"""読み出し可能なバイト数"""
+        return self.__write_count - self.__read_count - self.__pending
+
+    def writable(self):
+        u"""書き込み可能なバイト数"""
+        return self.__capacity - (self.__write_count - self.__read_count)
+
+    def write(self, data):
+        u"""
+        data を書き込む．空きが足りない場合は何も書き込まずに False を返す．
+        """
+        size = len(data)
+        if size > self.writable():
+            self.__overrun_bytes += size
+            return False
+        src = memoryview(data)
+        pos = self.__write_count % self.__capacity
+        first = min(size, self.__capacity - pos)
+        self.__view[pos:(pos + first)] = src[:first]
+        if first < size:
+            self.__view[0:(size - first)] = src[first:]
+        self.__write_count += size
+        return True
+
+    def release(self):
+        u"""直前の read() で返した領域を書き込み側に返す"""
+        self.__read_count += self.__pending
+        self.__pending = 0
+
+    def read(self, size):
+        u"""
+        size バイトを memoryview で返す．足りない場合は None を返す．
+        """
+        self.release()
+        if self.readable() < size:
+            return None
+        pos = self.__read_count % self.__capacity
+        self.__pending = size
+        if pos + size <= self.__capacity:
+            return self.__view[pos:(pos + size)]
+        # 末尾をまたぐ場合のみ作業領域にコピーする
+        if len(self.__scratch) < size:
+            self.__scratch = bytearray(size)
+        first = self.__capacity - pos
+        scratch = memoryview(self.__scratch)
+        scratch[:first] = self.__view[pos:]
+        scratch[first:size] = self.__view[:(size - first)]
+        return scratch[:size]
+
+    def get_data(self):
+        u"""
+        保持している最新のデータ（最大 capacity バイト）を書き込み順に bytes で返す
+        """
+        size = min(self.__write_count, self.__capacity)
+        end = self.__write_count % self.__capacity
+        if self.__write_count <= self.__capacity or end == 0:
+            return self.__view[(end - size) % self.__capacity:][:size].tobytes()
+        return self.__view[end:].tobytes() + self.__view[:end].tobytes()
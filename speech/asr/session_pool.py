@@ -0,0 +1,96 @@
+# encoding: utf-8
+u"""
+クライアント間で公平に割り当てる認識セッションのプール
+
+threading.BoundedSemaphore は空きができたときにどの待ちを起こすかが決まっておらず，
+release() したスレッドがすぐに acquire() し直すと，待っていた他のクライアントより先に
+取れてしまう．FairSessionPool は待ちをクライアントごとの列に並べ，空きができたら
+クライアントを順番に（ラウンドロビンで）回って割り当てるので，発話の多いクライアントが
+他のクライアントのセッションを奪うことはない．
+
+    pool = FairSessionPool(max_sessions=8)
+    sessions = pool.client('desk-12')    # SpeechInputter の session_pool に与える
+    sessions.acquire()
+    ...
+    sessions.release()
+"""
+
+import threading
+from collections import OrderedDict, deque
+
+import metrics
+
+
+class ClientSessions(object):
+    u"""FairSessionPool.client() が返す，1クライアント分の acquire() / release()"""
+
+    def __init__(self, pool, name):
+        self.pool = pool
+        self.name = name
+
+    def acquire(self):
+        self.pool._acquire(self.name)
+
+    def release(self):
+        self.pool._release()
+
+
+class FairSessionPool(object):
+    u"""同時に実行する認識セッションを max_sessions 個までに制限し，クライアント間で順番に割り当てる"""
+
+    def __init__(self, max_sessions):
+        if max_sessions < 1:
+            raise ValueError('max_sessions must be >= 1')
+        self.max_sessions = max_sessions
+        self.__cond = threading.Condition()
+        self.__free = max_sessions
+        # 待っているクライアントと，その待ち（acquire() ごとの印）の列．先頭のクライアントが次に取る
+        self.__waiting = OrderedDict()
+        self.__waiters = 0
+        metrics.gauge('recognition_sessions_active', u'実行中の認識セッションの数'
+                      ).set_function(lambda: self.active)
+        metrics.gauge('recognition_sessions_waiting', u'認識セッションの空きを待っている発話の数'
+                      ).set_function(lambda: self.waiting)
+
+    def client(self, name):
+        return ClientSessions(self, name)
+
+    @property
+    def active(self):
+        return self.max_sessions - self.__free
+
+    @property
+    def waiting(self):
+        return self.__waiters
+
+    def __next(self):
+        u"""次にセッションを取る待ち（self.__cond を保持して呼ぶ）"""
+        for tickets in self.__waiting.itervalues():
+            return tickets[0]
+        return None
+
+    def _acquire(self, name):
+        ticket = object()
+        with self.__cond:
+            self.__waiting.setdefault(name, deque()).append(ticket)
+            self.__waiters += 1
+            while self.__free == 0 or self.__next() is not ticket:
+                self.__cond.wait()
+            tickets = self.__waiting.pop(name)
+            tickets.popleft()
+            if tickets:
+                # まだ待っていれば列の最後に回す
+                self.__waiting[name] = tickets
+            self.__waiters -= 1
+            self.__free -= 1
+            if self.__free > 0 and self.__waiters > 0:
+                # 続けて取れる待ちがある
+                self.__cond.notifyAll()
+
+    def _release(self):
+        with self.__cond:
+            if self.__free >= self.max_sessions:
+                raise ValueError('session released too many times')
+            self.__free += 1
+            if self.__waiters > 0:
+                self.__cond.notifyAll()
@@ -0,0 +1,58 @@
+# encoding: utf-8
+
+
+def common_prefix(a, b):
+    u"""a と b の共通接頭辞"""
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return a[:i]
+
+
+class StabilityTracker(object):
+    u"""
+    途中結果の仮説がどれだけ安定しているかを追跡する．
+
+    直近 min_stable_results 個の途中結果に共通する接頭辞を「安定した部分」とみなし，
+    それがこれまでに確定した部分より伸びたら update() がそれを返す．
+    stability_thresh を与えた場合は，結果の stability（Google の途中結果が持つ 0〜1 の値）が
+    それ以上の仮説は1つでも安定しているとみなす．
+    """
+
+    def __init__(self, min_stable_results=2, stability_thresh=None):
+        self.__min_stable_results = max(1, min_stable_results)
+        self.__stability_thresh = stability_thresh
+        self.reset()
+
+    def reset(self):
+        u"""発話ごとに呼ぶ"""
+        self.__history = []
+        self.__committed = u''
+
+    @property
+    def committed(self):
+        u"""これまでに確定した部分"""
+        return self.__committed
+
+    def update(self, hypothesis, stability=None):
+        u"""
+        途中結果を追加する．安定した部分が伸びた場合はそれを返し，そうでなければ None を返す
+        """
+        self.__history.append(hypothesis)
+        if len(self.__history) > self.__min_stable_results:
+            del self.__history[0]
+
+        if self.__stability_thresh is not None and stability is not None and \
+           stability >= self.__stability_thresh:
+            stable = hypothesis
+        elif len(self.__history) < self.__min_stable_results:
+            return None
+        else:
+            stable = reduce(common_prefix, self.__history)
+
+        if len(stable) <= len(self.__committed) or not stable.startswith(self.__committed):
+            # 伸びていない，または確定済みの部分と食い違う場合は確定しない
+            return None
+        self.__committed = stable
+        return stable
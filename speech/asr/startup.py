@@ -0,0 +1,99 @@
+# encoding: utf-8
+u"""
+起動時間の計測と，認識エンジン・HTTP 接続の事前準備
+
+    startup = StartupTimer()
+    ...（import など）
+    startup.mark('imports')
+    ...
+    prewarmer = Prewarmer(startup, [('recognizer', backend), ('http', dispatcher)])
+    prewarmer.start()
+
+Prewarmer は起動直後に各対象の warm_up() をバックグラウンドで呼び
+（認識エンジンのクライアントと API オブジェクトの作成，HTTP の HEAD リクエストによる接続），
+以降も interval_sec ごとに呼んで接続を保つ．
+全ての対象の準備が終わったら，各段階の時間を標準エラー出力に表示する．
+"""
+
+import sys
+import threading
+
+from clock import monotonic
+
+
+class StartupTimer(object):
+    u"""起動の各段階にかかった時間を記録する"""
+
+    def __init__(self):
+        self.__origin = monotonic()
+        self.__last = self.__origin
+        self.__lock = threading.Lock()
+        # (段階の名前, 起動からの開始時刻, 所要時間) のリスト
+        self.__phases = []
+
+    def mark(self, name):
+        u"""直前の mark() からここまでを1つの段階として記録する（メインスレッド用）"""
+        now = monotonic()
+        with self.__lock:
+            self.__phases.append((name, self.__last - self.__origin, now - self.__last))
+            self.__last = now
+
+    def record(self, name, started, finished):
+        u"""バックグラウンドで行った段階を記録する（時刻は clock.monotonic の値）"""
+        with self.__lock:
+            self.__phases.append((name, started - self.__origin, finished - started))
+
+    def phases(self):
+        with self.__lock:
+            return list(self.__phases)
+
+    def report(self, out=None):
+        u"""各段階の開始時刻と所要時間（ミリ秒）を表示する"""
+        out = out if out is not None else sys.stderr
+        items = ['%s=%.0fms(+%.0fms)' % (name, 1000 * duration, 1000 * start)
+                 for name, start, duration in self.phases()]
+        print >> out, "STARTUP:", ' '.join(items)
+
+
+class Prewarmer(threading.Thread):
+    u"""
+    targets（(名前, warm_up() を持つオブジェクト) のリスト）を起動直後に準備し，
+    以降も interval_sec ごとに warm_up() を呼んで接続を保つ
+    """
+
+    def __init__(self, startup, targets, interval_sec=30.0):
+        super(Prewarmer, self).__init__()
+        self.daemon = True
+        self.startup = startup
+        self.targets = targets
+        self.interval_sec = interval_sec
+        self.__stopped = threading.Event()
+        self.ready = threading.Event()
+
+    def __warm_up(self, name, target, first):
+        started = monotonic()
+        try:
+            target.warm_up()
+        except Exception as e:
+            print >> sys.stderr, "WARM UP ERROR (%s): %s" % (name, e)
+            return
+        if first and self.startup is not None:
+            self.startup.record(name, started, monotonic())
+
+    def run(self):
+        # 初回は全ての対象を並行して準備する
+        threads = [threading.Thread(target=self.__warm_up, args=(name, target, True))
+                   for name, target in self.targets]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.ready.set()
+        if self.startup is not None:
+            self.startup.report()
+        while not self.__stopped.wait(self.interval_sec):
+            for name, target in self.targets:
+                self.__warm_up(name, target, False)
+
+    def stop(self):
+        self.__stopped.set()
@@ -0,0 +1,176 @@
+# encoding: utf-8
+u"""
+発話ごとのレイテンシ計測
+
+発話（Audio ID）ごとに，以下の各段階の時刻を単調時計で記録する．
+
+    vad_onset      read_callback で発話開始を検知した
+    first_read     認識エンジンが最初に read() した
+    first_interim  最初の途中結果が届いた
+    commit         安定した途中結果を確定として通知した（early_commit が有効な場合）
+    final          最終結果が届いた
+    finish_vad     VADが終了した
+    stop           audio_stream.stop() した
+    queue_put      SpeechInputter がキューに結果を入れた
+    send_done      send() の HTTP 呼び出しが返った
+
+記録は JSONL で書き出し，段階ごとの p50/p95/p99 を集計できる．
+
+    python -m speech.asr.tracing trace.jsonl
+"""
+from collections import OrderedDict
+import json
+import sys
+import threading
+import time
+
+from clock import monotonic
+
+STAGES = ('vad_onset', 'first_read', 'first_interim', 'commit', 'final',
+          'finish_vad', 'stop', 'queue_put', 'send_done')
+
+PERCENTILES = (50, 95, 99)
+
+
+def trace_key(device, audio_id):
+    u"""
+    発話を区別するためのID．複数のデバイスを使う場合はデバイスごとに名前空間を分ける
+    """
+    if device is None:
+        return audio_id
+    return '%s:%d' % (device, audio_id)
+
+
+class UtteranceTrace(object):
+    u"""1発話分の記録．各段階は最初に記録された時刻のみを保持する"""
+
+    def __init__(self, trace_id):
+        self.trace_id = trace_id
+        self.wall_time = time.time()
+        self.marks = {}
+
+    def mark(self, stage, t=None):
+        if stage not in self.marks:
+            self.marks[stage] = monotonic() if t is None else t
+
+    def to_dict(self):
+        return {'audio_id': self.trace_id,
+                'wall_time': self.wall_time,
+                'marks': self.marks}
+
+
+class Tracer(object):
+    u"""
+    発話ごとの記録を管理する．
+    finish() された記録（または max_pending を超えて古くなった記録）は
+    output（ファイル名）に JSONL として追記され，直近 max_history 件は summary() で集計できる．
+    """
+
+    def __init__(self, output=None, max_pending=1000, max_history=10000):
+        self.__lock = threading.Lock()
+        self.__pending = OrderedDict()
+        self.__history = []
+        self.__max_pending = max_pending
+        self.__max_history = max_history
+        self.__out = open(output, 'a') if output else None
+
+    def mark(self, trace_id, stage):
+        u"""trace_id の発話について stage の時刻を記録する"""
+        t = monotonic()
+        with self.__lock:
+            trace = self.__pending.get(trace_id)
+            if trace is None:
+                trace = UtteranceTrace(trace_id)
+                self.__pending[trace_id] = trace
+                if len(self.__pending) > self.__max_pending:
+                    self.__complete(self.__pending.popitem(last=False)[1])
+            trace.mark(stage, t)
+
+    def finish(self, trace_id):
+        u"""trace_id の発話の記録を終える"""
+        with self.__lock:
+            trace = self.__pending.pop(trace_id, None)
+            if trace is not None:
+                self.__complete(trace)
+
+    def __complete(self, trace):
+        self.__history.append(trace)
+        if len(self.__history) > self.__max_history:
+            del self.__history[:len(self.__history) - self.__max_history]
+        if self.__out is not None:
+            self.__out.write(json.dumps(trace.to_dict()) + '\n')
+            self.__out.flush()
+
+    def summary(self):
+        u"""直近の記録を集計する（summarize() を参照）"""
+        with self.__lock:
+            traces = [trace.to_dict() for trace in self.__history]
+        return summarize(traces)
+
+    def close(self):
+        with self.__lock:
+            for trace in self.__pending.values():
+                self.__complete(trace)
+            self.__pending.clear()
+            if self.__out is not None:
+                self.__out.close()
+                self.__out = None
+
+
+def load_traces(filename):
+    u"""JSONL ファイルから記録を読み込む"""
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(sorted_values, p):
+    u"""ソート済みのリストの p パーセンタイル（nearest-rank）"""
+    index = max(0, int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def summarize(traces):
+    u"""
+    段階ごとに，発話開始からの経過時間（since_onset）と，直前に記録された段階からの
+    経過時間（from_prev）の p50/p95/p99 をミリ秒で集計する
+    """
+    counts = dict((stage, 0) for stage in STAGES)
+    since_onset = dict((stage, []) for stage in STAGES)
+    from_prev = dict((stage, []) for stage in STAGES)
+    for trace in traces:
+        marks = trace['marks']
+        prev = None
+        for stage in STAGES:
+            if stage not in marks:
+                continue
+            counts[stage] += 1
+            if 'vad_onset' in marks:
+                since_onset[stage].append(1000.0 * (marks[stage] - marks['vad_onset']))
+            if prev is not None:
+                from_prev[stage].append(1000.0 * (marks[stage] - marks[prev]))
+            prev = stage
+
+    result = OrderedDict()
+    for stage in STAGES:
+        stats = OrderedDict([('count', counts[stage])])
+        for name, values in (('since_onset', since_onset[stage]),
+                             ('from_prev', from_prev[stage])):
+            values.sort()
+            for p in PERCENTILES:
+                stats['%s_p%d' % (name, p)] = percentile(values, p) if values else None
+        result[stage] = stats
+    return result
+
+
+def print_summary(summary, out=sys.stdout):
+    columns = ['since_onset_p%d' % p for p in PERCENTILES] + \
+              ['from_prev_p%d' % p for p in PERCENTILES]
+    out.write('%-14s %6s ' % ('stage', 'count') +
+              ' '.join('%16s' % c for c in columns) + '\n')
+    for stage, stats in summary.items():
+        values = ['%16s' % ('-' if stats[c] is None else '%.1f' % stats[c]) for c in columns]
+        out.write('%-14s %6d ' % (stage, stats['count']) + ' '.join(values) + '\n')
+
+
+if __name__ == '__main__':
+    print_summary(summarize(load_traces(sys.argv[1])))
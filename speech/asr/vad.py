@@ -0,0 +1,233 @@
+# encoding: utf-8
+from abc import ABCMeta, abstractmethod
+from collections import deque
+
+import numpy as np
+
+# Vad.process() が返す状態
+SILENCE = 0
+ONSET   = 1
+SPEECH  = 2
+OFFSET  = 3
+
+
+def frame_log_power(frame):
+    u"""
+    16bit PCM フレームの log10(RMS) を計算する．
+    np.frombuffer でバッファをコピーせずに参照する．
+    """
+    values = np.frombuffer(frame, dtype=np.int16).astype(np.float32)
+    if len(values) == 0:
+        return -np.inf
+    power = np.dot(values, values) / len(values)
+    return 0.5 * np.log10(power + 1e-10)
+
+
+class Vad(object):
+    u"""
+    PyAudioStream.read_callback から呼ばれる VAD エンジン．
+    process() にフレームを1つずつ渡し，返ってきた状態に従ってバッファリングを行う．
+
+    SILENCE: 発話外．フレームは捨てる．
+    ONSET:   発話開始．pop_pre_roll() の内容（このフレームを含む）をバッファに入れる．
+    SPEECH:  発話中．フレームをバッファに入れる．
+    OFFSET:  発話終了．フレームをバッファに入れてVADを終了する．
+    """
+    __metaclass__ = ABCMeta
+
+    @property
+    def detects_offset(self):
+        u"""発話終了を自ら検知するかどうか"""
+        return False
+
+    @abstractmethod
+    def reset(self):
+        u"""発話単位の状態を初期化する（雑音レベル等の学習結果は保持する）"""
+        pass
+
+    @abstractmethod
+    def process(self, frame):
+        u"""フレームを処理して状態を返す"""
+        pass
+
+    @abstractmethod
+    def pop_pre_roll(self):
+        u"""発話開始直前のデータ（開始フレームを含む）を取り出す"""
+        pass
+
+
+class LogPowerVad(Vad):
+    u"""固定閾値で発話開始のみを検知する VAD（従来の動作）"""
+
+    def __init__(self, logpower_thresh):
+        self.__logpower_thresh = logpower_thresh
+        self.__started = False
+        self.__last_frame = b''
+
+    def reset(self):
+        self.__started = False
+        self.__last_frame = b''
+
+    def process(self, frame):
+        if self.__started:
+            return SPEECH
+        if frame_log_power(frame) < self.__logpower_thresh:
+            return SILENCE
+        self.__started = True
+        self.__last_frame = frame
+        return ONSET
+
+    def pop_pre_roll(self):
+        frame = self.__last_frame
+        self.__last_frame = b''
+        return frame
+
+
+class AdaptiveVad(Vad):
+    u"""
+    雑音レベルを追従する適応閾値の VAD．
+
+    最初の seed_frames フレームは閾値に関係なく雑音とみなし，その最小値を雑音レベルの初期値とする
+    （その間は SILENCE を返す）．以降，発話外では log パワーの移動平均（下降は速く，上昇は遅く）で
+    雑音レベルを推定する．また発話中も含めて直近 floor_window_frames フレームの log パワーの
+    最小値を追い（minimum statistics），雑音レベルがそれより低ければそこまで引き上げる．
+    これにより，周囲の雑音が大きくなって閾値を超え続けても，窓の長さの後には発話終了になる．
+    （逆に，窓より長く途切れずに続く一定の音は雑音とみなされる）．
+    雑音レベル + margin（ただし min_logpower 以上）を閾値とする．
+    閾値超えが onset_frames 連続したら発話開始，閾値未満が hangover_frames 連続したら
+    発話終了とする．発話開始時には直前 pre_roll_frames 分のフレームも返すため，
+    閾値を超える前の語頭が欠けない．
+    """
+
+    # 最小値を追う窓を分割するブロックの数
+    FLOOR_BLOCKS = 8
+
+    def __init__(self, margin=0.5, min_logpower=2.0,
+                 onset_frames=3, hangover_frames=50, pre_roll_frames=30,
+                 floor_up_rate=0.005, floor_down_rate=0.1, initial_floor=None,
+                 seed_frames=20, floor_window_frames=300):
+        self.__margin = margin
+        self.__min_logpower = min_logpower
+        self.__onset_frames = max(1, onset_frames)
+        self.__hangover_frames = max(1, hangover_frames)
+        self.__floor_up_rate = floor_up_rate
+        self.__floor_down_rate = floor_down_rate
+        self.__floor = initial_floor
+        # 雑音レベルの初期値を決めるまでに残っているフレーム数と，それまでの最小値
+        self.__seed_remaining = 0 if initial_floor is not None else max(1, seed_frames)
+        self.__seed_min = None
+        # 直近の窓の最小値は，ブロックごとの最小値で求める
+        self.__block_frames = max(1, floor_window_frames // self.FLOOR_BLOCKS)
+        self.__block_minima = deque(maxlen=self.FLOOR_BLOCKS)
+        self.__block_min = None
+        self.__block_count = 0
+        self.__pre_roll = deque(maxlen=max(self.__onset_frames, pre_roll_frames))
+        self.reset()
+
+    @property
+    def detects_offset(self):
+        return True
+
+    @property
+    def noise_floor(self):
+        u"""現在の雑音レベルの推定値（log10 RMS）"""
+        return self.__floor
+
+    @property
+    def threshold(self):
+        u"""現在の閾値（log10 RMS）"""
+        if self.__floor is None:
+            return self.__min_logpower
+        return max(self.__floor + self.__margin, self.__min_logpower)
+
+    def reset(self):
+        self.__in_speech = False
+        self.__above_count = 0
+        self.__below_count = 0
+        self.__pre_roll.clear()
+
+    def __update_floor(self, logpower):
+        u"""発話外のフレームで雑音レベルを更新する"""
+        if logpower < self.__floor:
+            self.__floor += self.__floor_down_rate * (logpower - self.__floor)
+        else:
+            self.__floor += self.__floor_up_rate * (logpower - self.__floor)
+
+    def __track_minimum(self, logpower):
+        u"""全てのフレームで直近の窓の最小値を更新し，雑音レベルがそれより低ければ引き上げる"""
+        if self.__block_min is None or logpower < self.__block_min:
+            self.__block_min = logpower
+        self.__block_count += 1
+        if self.__block_count < self.__block_frames:
+            return
+        self.__block_minima.append(self.__block_min)
+        self.__block_min = None
+        self.__block_count = 0
+        if len(self.__block_minima) == self.__block_minima.maxlen:
+            window_min = min(self.__block_minima)
+            if window_min > self.__floor:
+                self.__floor = window_min
+
+    def process(self, frame):
+        logpower = frame_log_power(frame)
+        if self.__seed_remaining > 0:
+            # 雑音レベルの初期値を決めている間は発話を検知しない
+            self.__pre_roll.append(frame)
+            if self.__seed_min is None or logpower < self.__seed_min:
+                self.__seed_min = logpower
+            self.__seed_remaining -= 1
+            if self.__seed_remaining == 0:
+                self.__floor = self.__seed_min
+            return SILENCE
+        self.__track_minimum(logpower)
+        voiced = logpower >= self.threshold
+
+        if self.__in_speech:
+            if voiced:
+                self.__below_count = 0
+                return SPEECH
+            self.__below_count += 1
+            if self.__below_count >= self.__hangover_frames:
+                self.__in_speech = False
+                self.__below_count = 0
+                return OFFSET
+            return SPEECH
+
+        self.__pre_roll.append(frame)
+        if not voiced:
+            self.__above_count = 0
+            self.__update_floor(logpower)
+            return SILENCE
+        self.__above_count += 1
+        if self.__above_count < self.__onset_frames:
+            return SILENCE
+        self.__in_speech = True
+        self.__above_count = 0
+        return ONSET
+
+    def pop_pre_roll(self):
+        data = b''.join(self.__pre_roll)
+        self.__pre_roll.clear()
+        return data
+
+
+def create_vad(conf, sample_rate, chunk_size):
+    u"""conf.ini の設定に従ってVADエンジンを作成する"""
+    if not conf.has_option('pyaudio', 'vad') or conf.get('pyaudio', 'vad') != 'adaptive':
+        return LogPowerVad(conf.getfloat('pyaudio', 'logpower_thresh'))
+    # 1フレームあたりのミリ秒
+    frame_ms = 1000.0 * chunk_size / sample_rate
+    return AdaptiveVad(
+        margin=conf.getfloat('vad', 'margin'),
+        min_logpower=conf.getfloat('vad', 'min_logpower'),
+        onset_frames=int(round(conf.getfloat('vad', 'onset_ms') / frame_ms)),
+        hangover_frames=int(round(conf.getfloat('vad', 'hangover_ms') / frame_ms)),
+        pre_roll_frames=int(round(conf.getfloat('vad', 'pre_roll_ms') / frame_ms)),
+        seed_frames=int(round(_get_vad_ms(conf, 'seed_ms', 200) / frame_ms)),
+        floor_window_frames=int(round(_get_vad_ms(conf, 'floor_window_ms', 3000) / frame_ms)))
+
+
+def _get_vad_ms(conf, option, default):
+    if conf.has_option('vad', option):
+        return conf.getfloat('vad', option)
+    return default
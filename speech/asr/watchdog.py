@@ -0,0 +1,273 @@
+# encoding: utf-8
+u"""
+認識中のストールの監視
+
+認識中の全てのストリームを1つのタイマーホイール（clock.monotonic による）で監視し，
+以下の予算を超えたら finish_vad() を呼んで発話を打ち切る．
+
+    no_first_result  認識を開始してから最初の結果が届くまで
+    no_progress      結果が届いてから次の結果が届くまで
+    max_length       認識を開始してから終わるまで
+
+打ち切ってから abort_sec 秒以内に認識が終わらない場合（認識スレッドが結果を待ったまま
+止まっている場合など）は，ストリームを stop() して on_abort を呼ぶ（abort）．
+予算を超えるたびに理由ごとの回数を数える（stats()）．
+
+    watch = watchdog.watch(audio_stream, on_abort)
+    for result in results:
+        watch.ping()
+        ...
+    watch.close()
+
+ping() と close() は時刻を記録するだけで，ホイールは操作しない．期限が来たときに
+実際の最終時刻を見て，まだ予算内なら次の期限で登録し直す．
+"""
+
+import sys
+import threading
+import time
+
+from clock import monotonic
+import metrics
+
+REASONS = ('no_first_result', 'no_progress', 'max_length')
+
+
+class TimerWheel(object):
+    u"""
+    tick_sec 刻みのタイマーホイール．slots 周より先の期限のタイマーは，
+    そのスロットに残したまま周回を待つ．コールバックは advance() を呼んだスレッドで呼ばれる
+    """
+
+    def __init__(self, tick_sec=0.05, slots=256):
+        self.tick_sec = tick_sec
+        self.__slots = [[] for _ in range(slots)]
+        self.__lock = threading.Lock()
+        self.__tick = int(monotonic() / tick_sec)
+
+    def schedule(self, deadline, callback):
+        u"""deadline（clock.monotonic の時刻）以降の最初の tick で callback() を呼ぶ"""
+        with self.__lock:
+            tick = max(int(-(-deadline // self.tick_sec)), self.__tick + 1)
+            timer = [tick, callback]
+            self.__slots[tick % len(self.__slots)].append(timer)
+        return timer
+
+    def cancel(self, timer):
+        u"""schedule() の戻り値のタイマーを取り消す（スロットからは期限の tick に取り除く）"""
+        timer[1] = None
+
+    def advance(self, now):
+        u"""now までの tick を進め，期限が来たタイマーのコールバックを呼ぶ"""
+        due = []
+        with self.__lock:
+            last = int(now / self.tick_sec)
+            # 1周以上遅れた場合も，各スロットは1度ずつ見れば足りる
+            first = max(self.__tick + 1, last - len(self.__slots) + 1)
+            for tick in range(first, last + 1):
+                slot = self.__slots[tick % len(self.__slots)]
+                if not slot:
+                    continue
+                remaining = []
+                for timer in slot:
+                    if timer[1] is None:
+                        continue
+                    if timer[0] <= last:
+                        due.append(timer[1])
+                    else:
+                        remaining.append(timer)
+                self.__slots[tick % len(self.__slots)] = remaining
+            self.__tick = max(self.__tick, last)
+        for callback in due:
+            callback()
+
+
+class StreamWatch(object):
+    u"""StallWatchdog.watch() が返す，認識中の1ストリームの監視"""
+
+    def __init__(self, watchdog, audio_stream, on_abort):
+        self.watchdog = watchdog
+        self.audio_stream = audio_stream
+        self.on_abort = on_abort
+        self.started = monotonic()
+        self.last_result = None
+        # 打ち切った時刻と理由
+        self.finished_at = None
+        self.reason = None
+        self.aborted = False
+        self.closed = False
+        self.active = True
+        self.timer = None
+
+    def ping(self):
+        u"""結果が届いたことを記録する"""
+        self.last_result = monotonic()
+
+    def close(self):
+        u"""認識が終わった．以降は監視しない"""
+        self.closed = True
+        self.watchdog._cancel(self)
+
+
+class StallWatchdog(object):
+    u"""
+    認識中のストリームのストールを監視する（複数のストリーム・スレッドで共有する）．
+    max_length_sec に None を与えた場合は長さを制限しない．
+    監視中のストリームが無い間は，ホイールを進めるスレッドは眠っている
+    """
+
+    def __init__(self, first_result_sec=2.0, progress_sec=1.0, max_length_sec=30.0,
+                 abort_sec=3.0, tick_sec=0.05):
+        self.first_result_sec = first_result_sec
+        self.progress_sec = progress_sec
+        self.max_length_sec = max_length_sec
+        self.abort_sec = abort_sec
+        self.__wheel = TimerWheel(tick_sec)
+        self.__lock = threading.Lock()
+        self.__cond = threading.Condition(self.__lock)
+        self.__counts = dict((reason, 0) for reason in REASONS + ('abort',))
+        self.__metrics = dict((reason, metrics.counter(
+            'watchdog_triggers_total', u'ストールの監視で発話を打ち切った回数', reason=reason))
+            for reason in REASONS)
+        self.__metrics['abort'] = metrics.counter(
+            'recognition_aborts_total', u'打ち切っても終わらず認識を中止した回数')
+        self.__watching = 0
+        self.__stopped = False
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def watch(self, audio_stream, on_abort=None):
+        u"""
+        audio_stream の監視を始める．on_abort(watch) は abort したときに
+        ホイールのスレッドから呼ばれるので，すぐに返すこと
+        """
+        watch = StreamWatch(self, audio_stream, on_abort)
+        with self.__cond:
+            self.__watching += 1
+            self.__cond.notifyAll()
+        self.__schedule(watch, self.__next_deadline(watch))
+        return watch
+
+    def stats(self):
+        u"""理由ごとの打ち切りの回数と abort の回数"""
+        with self.__lock:
+            return dict(self.__counts)
+
+    def close(self):
+        with self.__cond:
+            self.__stopped = True
+            self.__cond.notifyAll()
+        self.__thread.join()
+
+    def __next_deadline(self, watch):
+        if watch.finished_at is not None:
+            return watch.finished_at + self.abort_sec
+        if watch.last_result is None:
+            deadline = watch.started + self.first_result_sec
+        else:
+            deadline = watch.last_result + self.progress_sec
+        if self.max_length_sec is not None:
+            deadline = min(deadline, watch.started + self.max_length_sec)
+        return deadline
+
+    def __schedule(self, watch, deadline):
+        with self.__lock:
+            if watch.closed:
+                return
+            watch.timer = self.__wheel.schedule(deadline, lambda: self.__fire(watch))
+
+    def _cancel(self, watch):
+        with self.__lock:
+            if watch.timer is not None:
+                self.__wheel.cancel(watch.timer)
+                watch.timer = None
+            self.__release(watch)
+
+    def __release(self, watch):
+        u"""self.__lock を保持した状態で呼ぶ"""
+        if watch.active:
+            watch.active = False
+            self.__watching -= 1
+
+    def __count(self, reason):
+        with self.__lock:
+            self.__counts[reason] += 1
+        self.__metrics[reason].inc()
+
+    def __fire(self, watch):
+        u"""
+        期限が来たタイマーの処理．1つのストリームの失敗でホイールのスレッド（全てのストリームの
+        監視）を止めないよう，例外は表示してそのストリームの監視をやめる
+        """
+        try:
+            self.__check(watch)
+        except Exception as e:
+            print >> sys.stderr, "WATCHDOG ERROR:", e
+            with self.__lock:
+                self.__release(watch)
+
+    def __check(self, watch):
+        if watch.closed:
+            return
+        now = monotonic()
+        if watch.finished_at is not None:
+            if now < watch.finished_at + self.abort_sec:
+                self.__schedule(watch, watch.finished_at + self.abort_sec)
+                return
+            self.__abort(watch)
+            return
+        reason = None
+        if watch.last_result is None:
+            if now >= watch.started + self.first_result_sec:
+                reason = 'no_first_result'
+        elif now >= watch.last_result + self.progress_sec:
+            reason = 'no_progress'
+        if reason is None and self.max_length_sec is not None and \
+           now >= watch.started + self.max_length_sec:
+            reason = 'max_length'
+        if reason is None:
+            self.__schedule(watch, self.__next_deadline(watch))
+            return
+        self.__count(reason)
+        watch.reason = reason
+        watch.finished_at = now
+        if not watch.audio_stream.vad_finished:
+            watch.audio_stream.finish_vad()
+        self.__schedule(watch, self.__next_deadline(watch))
+
+    def __abort(self, watch):
+        self.__count('abort')
+        watch.aborted = True
+        watch.closed = True
+        with self.__lock:
+            self.__release(watch)
+        # 読み込みを終わらせ，認識エンジンへの音声の送信を止める
+        watch.audio_stream.stop()
+        if watch.on_abort is not None:
+            try:
+                watch.on_abort(watch)
+            except Exception as e:
+                print >> sys.stderr, "WATCHDOG ERROR:", e
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                while self.__watching == 0 and not self.__stopped:
+                    self.__cond.wait()
+                if self.__stopped:
+                    return
+            time.sleep(self.__wheel.tick_sec)
+            self.__wheel.advance(monotonic())
+
+
+def create_watchdog(conf):
+    u"""conf.ini の [watchdog] が有効なら StallWatchdog を作成する"""
+    if not conf.has_section('watchdog') or not conf.getboolean('watchdog', 'enabled'):
+        return None
+    max_length_sec = conf.getfloat('watchdog', 'max_length_sec')
+    return StallWatchdog(first_result_sec=conf.getfloat('watchdog', 'first_result_sec'),
+                         progress_sec=conf.getfloat('watchdog', 'progress_sec'),
+                         max_length_sec=max_length_sec if max_length_sec > 0 else None,
+                         abort_sec=conf.getfloat('watchdog', 'abort_sec'),
+                         tick_sec=conf.getfloat('watchdog', 'tick_ms') / 1000.0)
@@ -3,11 +3,190 @@
 import sys, os, signal
 import argparse, ConfigParser
 
-from google.cloud import speech
 import asr.audio_stream as ast
 import asr.result_watcher as rw
+import asr.vad as vad
+import asr.recognizer as recognizer
+import asr.tracing as tracing
+import asr.stability as stability
+import asr.prosody as prosody
+import asr.archive as archive
+import asr.watchdog as watchdog
+import asr.metrics as metrics
+import intent
 import threading
 import queue
+from collections import deque
+import numpy as np
+
+
+INTERIM_RESULTS = metrics.meter('recognition_results_total', u'認識エンジンから届いた結果の数',
+                                kind='interim')
+FINAL_RESULTS = metrics.meter('recognition_results_total', u'認識エンジンから届いた結果の数',
+                              kind='final')
+
+
+def create_result_watcher(conf):
+    u"""conf.ini の [output] に従って ResultWatcher を作成する"""
+    # async_watchers が有効なら，出力は ResultWatcher ごとのスレッドで行う
+    async_mode = conf.has_option('output', 'async_watchers') and \
+                 conf.getboolean('output', 'async_watchers')
+    max_pending = 100
+    if conf.has_option('output', 'max_pending'):
+        max_pending = conf.getint('output', 'max_pending')
+    result_watcher = rw.CombinedResultWatcher(async_mode, max_pending)
+    # 標準出力のタイプを確認
+    if conf.get('output', 'stdout_output_type') == 'display':
+        result_watcher.add_watcher(rw.StdoutResultWatcherForDisplay())
+    elif conf.get('output', 'stdout_output_type') == 'analysis':
+        result_watcher.add_watcher(rw.StdoutResultWatcherForAnalysis())
+    else:
+        result_watcher.add_watcher(rw.StdoutResultWatcher())
+    # 全ての通知をファイルに記録する
+    if conf.has_option('output', 'result_log') and conf.get('output', 'result_log'):
+        result_watcher.add_watcher(rw.LogResultWatcher(
+            conf.get('output', 'result_log'),
+            max_bytes=int(conf.getfloat('output', 'result_log_max_mb') * 1024 * 1024),
+            max_age_sec=conf.getfloat('output', 'result_log_rotate_sec'),
+            binary_arrays=conf.getboolean('output', 'result_log_binary')))
+    return result_watcher
+
+
+def create_tracer(conf):
+    u"""conf.ini の [trace] が有効ならレイテンシ計測器を作成する"""
+    if conf.has_section('trace') and conf.getboolean('trace', 'enabled'):
+        return tracing.Tracer(conf.get('trace', 'output'))
+    return None
+
+
+def create_intent_matcher(conf):
+    u"""conf.ini の [intent] があればキーワード表を読んで IntentMatcher を作成する"""
+    if conf.has_section('intent'):
+        return intent.load_intent_matcher(conf.get('intent', 'keyword_file'))
+    return None
+
+
+def dispatch_result(result, dispatcher, tracer=None):
+    u"""
+    認識結果のイベントから送る状態を決めて dispatcher（send.StateDispatcher）に渡す
+    （asr.py と asr_async.py で共有する）．
+    キーワード表で最も優先される状態を送る（recog_interim は [intent] match_interim のとき）．
+    途中結果や確定した途中結果で送った状態は，最終結果で同じなら送り直されない．
+    tracer を与えた場合は送信が終わった時刻を記録し，最終結果で1発話分の計測を終える．
+    """
+    if result['type'] in ('recog_start', 'recog_partial'):
+        return
+    state = None
+    if result['type'] in ('recog_interim', 'recog_commit', 'recog_result'):
+        match = intent.best_match(result['intents'])
+        if match is not None:
+            state = match.state
+    final = result['type'] in ('recog_result', 'recog_end')
+    trace_id = tracing.trace_key(result['device'], result['audio_id'])
+
+    if state is None:
+        if tracer is not None and final:
+            # 送信しない場合はここで計測を終える
+            tracer.finish(trace_id)
+        return
+    on_done = None
+    if tracer is not None:
+        def on_done(state, ok):
+            tracer.mark(trace_id, 'send_done')
+            if final:
+                tracer.finish(trace_id)
+    dispatcher.submit(state, on_done)
+
+
+def create_pyaudio_stream(conf, tracer=None, audio_interface=None, device=None):
+    u"""
+    conf.ini の [pyaudio] に従ってマイク入力の PyAudioStream を作成する．
+    device（デバイス番号か名前の一部）を省略した場合はデフォルトの入力デバイスを使う．
+    """
+    sample_rate = conf.getint('pyaudio', 'sample_rate')
+    chunk_size = conf.getint('pyaudio', 'chunk_size')
+    input_device_index = None
+    if device is not None:
+        if audio_interface is None:
+            raise ValueError('audio_interface is required to select a device')
+        input_device_index = ast.resolve_input_device(audio_interface, device)
+    return ast.PyAudioStream(sample_rate,
+                             chunk_size=chunk_size,
+                             logpower_thresh=conf.getfloat('pyaudio', 'logpower_thresh'),
+                             vad=vad.create_vad(conf, sample_rate, chunk_size),
+                             buffer_sec=conf.getfloat('pyaudio', 'buffer_sec'),
+                             tracer=tracer,
+                             audio_interface=audio_interface,
+                             input_device_index=input_device_index,
+                             device=device)
+
+
+def create_continuous_stream(conf, tracer=None, audio_interface=None, device=None):
+    u"""conf.ini の [pyaudio] に従って録音し続ける ContinuousPyAudioStream を作成する"""
+    sample_rate = conf.getint('pyaudio', 'sample_rate')
+    chunk_size = conf.getint('pyaudio', 'chunk_size')
+    input_device_index = None
+    if device is not None:
+        if audio_interface is None:
+            raise ValueError('audio_interface is required to select a device')
+        input_device_index = ast.resolve_input_device(audio_interface, device)
+    return ast.ContinuousPyAudioStream(sample_rate,
+                                       chunk_size=chunk_size,
+                                       logpower_thresh=conf.getfloat('pyaudio', 'logpower_thresh'),
+                                       vad=vad.create_vad(conf, sample_rate, chunk_size),
+                                       buffer_sec=conf.getfloat('pyaudio', 'buffer_sec'),
+                                       tracer=tracer,
+                                       audio_interface=audio_interface,
+                                       input_device_index=input_device_index,
+                                       device=device,
+                                       max_buffers=conf.getint('pyaudio', 'max_sessions') + 1)
+
+
+class OrderedDelivery(object):
+    u"""
+    1つのストリームの ResultWatcher への通知を，起きた順に届ける．
+    reserve() で順番だけ取っておき，中身（F0 の計算を待つ終了の通知など）は後から
+    別のスレッドで fill() できる．先に来た通知が埋まるまで，後の通知は待たせずに溜めておき，
+    順番が来たものを最後に埋めたスレッドが届ける
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__slots = deque()
+        self.__delivering = False
+
+    def reserve(self):
+        slot = []
+        with self.__lock:
+            self.__slots.append(slot)
+        return slot
+
+    def call(self, function, *args):
+        self.fill(self.reserve(), function, *args)
+
+    def fill(self, slot, function, *args):
+        with self.__lock:
+            slot.append((function, args))
+            if self.__delivering:
+                # 届けているスレッドが続けて届ける
+                return
+            self.__delivering = True
+        while True:
+            with self.__lock:
+                if not self.__slots or not self.__slots[0]:
+                    self.__delivering = False
+                    return
+                function, args = self.__slots.popleft()[0]
+            try:
+                function(*args)
+            except Exception as e:
+                # 1つの ResultWatcher の失敗で後の通知を止めない
+                print >> sys.stderr, "RESULT WATCHER ERROR:", e
+
+
+def continuous_mode_enabled(conf):
+    u"""conf.ini の [pyaudio] continuous が有効かどうか"""
+    return conf.has_option('pyaudio', 'continuous') and conf.getboolean('pyaudio', 'continuous')
 
 
 class SpeechInputter(threading.Thread):
@@ -18,49 +197,118 @@ class SpeechInputter(threading.Thread):
     元スレッドでq.get()しておけば音声認識結果が返ってきたときに何らかの処理を行わせることができる
     '''
     
-    def __init__(self, conf):
+    def __init__(self, conf, audio_stream=None, result_watcher=None, backend=None,
+                 tracer=None, session_pool=None, prosody_extractor=None, utterance_archive=None,
+                 stall_watchdog=None, intent_matcher=None):
+        u"""
+        audio_stream, result_watcher, backend, tracer, prosody_extractor, utterance_archive,
+        stall_watchdog, intent_matcher を与えた場合は，
+        それぞれ conf.ini から作成する代わりに与えられたものを使う
+        （バッチ認識や複数デバイスでの共有に利用する）．
+        session_pool（threading.BoundedSemaphore）を与えた場合は，同時に実行する認識セッションの
+        数をそれで制限する．
+        """
         super(SpeechInputter, self).__init__()
         self.q = None
         
         self.sample_rate = conf.getint("pyaudio", "sample_rate")
-        self.result_watcher = rw.CombinedResultWatcher()
-        # 標準出力のタイプを確認
-        if conf.get('output', 'stdout_output_type') == 'display':
-            self.result_watcher.add_watcher(rw.StdoutResultWatcherForDisplay())
-        elif conf.get('output', 'stdout_output_type') == 'analysis':
-            self.result_watcher.add_watcher(rw.StdoutResultWatcherForAnalysis())
-        else:
-            self.result_watcher.add_watcher(rw.StdoutResultWatcher())
+        if result_watcher is None:
+            result_watcher = create_result_watcher(conf)
+        self.result_watcher = result_watcher
+        self.session_pool = session_pool
             
-        self.client = speech.Client()
-        chunk_size = conf.getint('pyaudio', 'chunk_size')
-        logpower_thresh = conf.getfloat('pyaudio', 'logpower_thresh')
-        timeout_in_sec = conf.getfloat('pyaudio', 'timeout_in_sec')
-        self.audio_stream = ast.PyAudioStream(self.sample_rate,
-                                         chunk_size=chunk_size,
-                                         logpower_thresh=logpower_thresh,
-                                         timeout_in_sec=timeout_in_sec)
+        # 認識エンジン（conf.ini の [recognition] backend で選択する）
+        self.backend = backend if backend is not None else recognizer.create_backend(conf)
+        # 発話ごとのレイテンシ計測
+        if tracer is None:
+            tracer = create_tracer(conf)
+        self.tracer = tracer
+        # 発話全体の音声から F0 と RMS を求める（[prosody] が無効なら None）
+        if prosody_extractor is None:
+            prosody_extractor = prosody.create_prosody_extractor(conf)
+        self.prosody_extractor = prosody_extractor
+        # 発話の音声の保存先（[archive] が無効なら None）
+        if utterance_archive is None:
+            utterance_archive = archive.create_archive(conf)
+        self.utterance_archive = utterance_archive
+        # 認識結果からの意図抽出（途中結果にも適用するかどうか）
+        if intent_matcher is None:
+            intent_matcher = create_intent_matcher(conf)
+        self.intent_matcher = intent_matcher
+        self.match_interim = intent_matcher is not None and conf.has_section('intent') and \
+                             conf.getboolean('intent', 'match_interim')
+        # 安定した途中結果を最終結果より先に recog_commit として通知するかどうか
+        self.early_commit = conf.has_option('recognition', 'early_commit') and \
+                            conf.getboolean('recognition', 'early_commit')
+        if self.early_commit:
+            self.commit_stable_results = conf.getint('recognition', 'commit_stable_results')
+            self.commit_stability = conf.getfloat('recognition', 'commit_stability')
+        if audio_stream is None:
+            audio_stream = create_pyaudio_stream(conf, tracer=self.tracer)
+        self.audio_stream = audio_stream
+        # 認識中のストールの監視（[watchdog] が無効なら None）．録音済みのファイルは監視しない
+        if stall_watchdog is None and not getattr(audio_stream, 'content_available', False):
+            stall_watchdog = watchdog.create_watchdog(conf)
+        self.stall_watchdog = stall_watchdog
+        # ResultWatcher への通知は，終了の通知が F0 の計算を待つ間も発話の順に届ける
+        self.delivery = OrderedDelivery()
 
     def set_q(self, q):
         self.q = q
+        if hasattr(q, 'qsize'):
+            metrics.gauge('speech_queue_depth', u'まだ受け取られていない認識結果のイベントの数'
+                          ).set_function(q.qsize)
     
-    def listen_print_loop(self, client, audio_stream, result_watcher=None):
-        # 一発話全体の音声データ（音素アライメントとピッチ計算に利用）
-        audio_data = b''
-        # 最終声認識結果
-        recognition_result = ''
-
+    def listen_print_loop(self, backend, audio_stream, result_watcher=None):
         audio_stream.start()
 
         with audio_stream.cond:
-            while not audio_stream.vad_started:
+            while not audio_stream.vad_started and not audio_stream.closed:
                 audio_stream.cond.wait()
-        
-        self.q.put({'type': 'recog_start'})
-        sample = client.sample(stream=audio_stream,
-                               encoding=speech.Encoding.LINEAR16,
-                               sample_rate_hertz=self.sample_rate)
-        results = sample.streaming_recognize(
+        if not audio_stream.vad_started:
+            # 発話が始まる前にストリームが閉じられた（ネットワークのクライアントが切断した場合など）
+            return
+
+        if self.session_pool is not None:
+            # 認識セッションに空きができるまで待つ（その間も音声はバッファに溜まる）
+            # 待っていた間は監視しない（監視は recognize() で認識を始めてから）
+            self.session_pool.acquire()
+        try:
+            self.recognize(backend, audio_stream, result_watcher)
+        finally:
+            if self.session_pool is not None:
+                self.session_pool.release()
+
+    def recognize(self, backend, audio_stream, result_watcher=None):
+        u"""VADが開始した発話を認識し，結果をキューに入れる"""
+        self.put(audio_stream, {'type': 'recog_start'})
+        watch = self.watch(audio_stream, result_watcher)
+        try:
+            self.__recognize(backend, audio_stream, result_watcher, watch)
+        finally:
+            if watch is not None:
+                watch.close()
+
+    def watch(self, audio_stream, result_watcher):
+        u"""
+        audio_stream のストールの監視を始める．監視しない場合は None．
+        認識が中止（abort）されたら ResultWatcher に notify_abort し，recog_end を通知する
+        """
+        if self.stall_watchdog is None or audio_stream.content_available:
+            return None
+        audio_id = audio_stream.audio_id
+
+        def on_abort(watch):
+            self.mark(audio_stream, 'abort')
+            if result_watcher is not None:
+                self.delivery.call(result_watcher.notify_abort, audio_id, audio_stream.device)
+            self.put(audio_stream, {'type': 'recog_end', 'aborted': watch.reason})
+        return self.stall_watchdog.watch(audio_stream, on_abort)
+
+    def __recognize(self, backend, audio_stream, result_watcher, watch):
+        results = backend.streaming_recognize(
+            audio_stream,
+            self.stream_sample_rate(audio_stream),
             interim_results=True,
             single_utterance=audio_stream.single_utterance_required,
             language_code='ja-JP',
@@ -68,37 +316,133 @@ class SpeechInputter(threading.Thread):
         )
         # 認識開始を通知
         if result_watcher is not None:
-            result_watcher.notify_start(audio_stream.audio_id)
+            self.delivery.call(result_watcher.notify_start, audio_stream.audio_id,
+                               audio_stream.device)
             
+        # 最終声認識結果
         recognition_result = ''
+        # 直前の途中結果から抽出された状態
+        interim_states = None
+        if self.early_commit:
+            stability_tracker = stability.StabilityTracker(self.commit_stable_results,
+                                                           self.commit_stability)
         for result in results:
+            if watch is not None:
+                if watch.aborted:
+                    # 中止済み（notify_abort と recog_end は通知済み）
+                    return
+                watch.ping()
             audio_stream.ping()
+            (FINAL_RESULTS if result.is_final else INTERIM_RESULTS).inc()
+            self.mark(audio_stream, 'first_interim')
+            interim_result = recognition_result + result.alternatives[0].transcript
             
             if result_watcher is not None:
-                result_watcher.notify_interim_result(audio_stream.audio_id,
-                                                     recognition_result +
-                                                     result.alternatives[0].transcript)
+                self.delivery.call(result_watcher.notify_interim_result, audio_stream.audio_id,
+                                   interim_result, audio_stream.device)
+            if self.match_interim and self.q and not result.is_final:
+                intents = self.intent_matcher.match(interim_result)
+                states = [m.state for m in intents]
+                if intents and states != interim_states:
+                    # 抽出される状態が変わった時だけ通知する
+                    self.put(audio_stream, {'type': 'recog_interim', 'recog_interim': interim_result,
+                                            'intents': intents})
+                interim_states = states
+            if self.early_commit and self.q and not result.is_final:
+                self.put(audio_stream, {'type': 'recog_partial', 'recog_partial': interim_result})
+                stable = stability_tracker.update(interim_result,
+                                                  getattr(result, 'stability', None))
+                if stable is not None:
+                    # 最終結果を待たずに，安定した部分を確定として通知する
+                    self.mark(audio_stream, 'commit')
+                    self.put(audio_stream, {'type': 'recog_commit', 'recog_commit': stable,
+                                            'intents': self.match_intents(stable)})
             if result.is_final:
+                self.mark(audio_stream, 'final')
                 if len(recognition_result) > 0:
                     recognition_result += u'、'
                 recognition_result += result.alternatives[0].transcript
                 if audio_stream.single_utterance_required:
                     audio_stream.finish_vad()
+        if watch is not None:
+            watch.close()
+            if watch.aborted:
+                return
         audio_stream.stop()
+        # 一発話全体の音声データ（音素アライメントとピッチ計算に利用）
         audio_data = audio_stream.get_data()
+        if self.utterance_archive is not None and audio_data:
+            # 認識結果と共に音声を保存する（書き込みは別スレッド）
+            self.utterance_archive.put(audio_stream.audio_id, audio_data, recognition_result,
+                                       device=audio_stream.device,
+                                       sample_rate=self.stream_sample_rate(audio_stream))
                 
         if result_watcher is not None:
-            result_watcher.notify_finish(audio_stream.audio_id, recognition_result, [], [], [], [])
-        if recognition_result and self.q:
-            self.q.put({'type': 'recog_result', 'recog_result': recognition_result})
+            self.notify_finish(result_watcher, audio_stream, recognition_result, audio_data)
+        if not self.q:
+            return
+        self.mark(audio_stream, 'queue_put')
+        if recognition_result:
+            self.put(audio_stream, {'type': 'recog_result', 'recog_result': recognition_result,
+                                    'intents': self.match_intents(recognition_result)})
         else:
-            self.q.put({'type': 'recog_end'})
-        
+            self.put(audio_stream, {'type': 'recog_end'})
+
+    def notify_finish(self, result_watcher, audio_stream, recognition_result, audio_data):
+        u"""
+        F0 と RMS を求めて終了を通知する．計算はプールで行い，この発話の認識スレッドは待たない．
+        通知の順番はここで取るので，次の発話の開始の通知がこれを追い越すことはない
+        """
+        audio_id = audio_stream.audio_id
+        device = audio_stream.device
+        if self.prosody_extractor is None or not audio_data:
+            self.delivery.call(result_watcher.notify_finish, audio_id, recognition_result,
+                               [], [], [], [], device)
+            return
+        slot = self.delivery.reserve()
+        # audio_data は次の発話で書き換えられることがあるので，ここで float の配列にしておく
+        samples = np.frombuffer(audio_data, dtype='<i2').astype(np.float32)
+        rate = self.stream_sample_rate(audio_stream)
+
+        def on_done(future):
+            try:
+                f0_list, rms_list = future.result()
+            except Exception as e:
+                print >> sys.stderr, "PROSODY ERROR:", e
+                f0_list, rms_list = [], []
+            self.delivery.fill(slot, result_watcher.notify_finish, audio_id, recognition_result,
+                               [], [], f0_list, rms_list, device)
+        self.prosody_extractor.submit(samples, rate).add_done_callback(on_done)
+
+    def stream_sample_rate(self, audio_stream):
+        u"""
+        ファイルやネットワークのストリームはそれ自身のサンプリングレート，それ以外は conf.ini のもの
+        """
+        return getattr(audio_stream, 'sample_rate', None) or self.sample_rate
+
+    def put(self, audio_stream, event):
+        u"""Audio ID とデバイス名を付けてイベントをキューに入れる"""
+        if self.q:
+            event['audio_id'] = audio_stream.audio_id
+            event['device'] = audio_stream.device
+            self.q.put(event)
+
+    def match_intents(self, text):
+        u"""text から意図を抽出する．キーワード表が無い場合は空のリストを返す"""
+        if self.intent_matcher is None:
+            return []
+        return self.intent_matcher.match(text)
+
+    def mark(self, audio_stream, stage):
+        u"""レイテンシ計測が有効な場合は，現在の発話について stage の時刻を記録する"""
+        if self.tracer is not None:
+            self.tracer.mark(audio_stream.trace_id, stage)
+
         
     def run(self):
         while not self.audio_stream.closed:
             try:
-                self.listen_print_loop(self.client, self.audio_stream, self.result_watcher)
+                self.listen_print_loop(self.backend, self.audio_stream, self.result_watcher)
             except RuntimeError as e:
                 print "NON FATAL ERROR:", e.message
 
@@ -110,6 +454,128 @@ class SpeechInputter(threading.Thread):
     def is_empty(self):
         return self.q.empty()
 
+class MultiSpeechInputter(object):
+    u"""
+    1プロセスで複数のマイクから音声入力を受け付ける．
+    conf.ini の [pyaudio] devices に列挙したデバイスごとに，ストリーム・VAD・Audio ID を持つ
+    SpeechInputter を作り，認識エンジン・ResultWatcher・レイテンシ計測器・キューを共有する．
+    同時に実行する認識セッションは [pyaudio] max_sessions 個までに制限する．
+    キューに入る結果には device としてデバイスの指定が付く．
+    """
+
+    def __init__(self, conf, devices, audio_interface=None):
+        import pyaudio
+        if audio_interface is None:
+            audio_interface = pyaudio.PyAudio()
+        self.q = None
+        self.audio_interface = audio_interface
+        self.result_watcher = create_result_watcher(conf)
+        self.backend = recognizer.create_backend(conf)
+        self.tracer = create_tracer(conf)
+        self.prosody_extractor = prosody.create_prosody_extractor(conf)
+        self.utterance_archive = archive.create_archive(conf)
+        self.stall_watchdog = watchdog.create_watchdog(conf)
+        self.intent_matcher = create_intent_matcher(conf)
+        self.session_pool = threading.BoundedSemaphore(conf.getint('pyaudio', 'max_sessions'))
+        self.inputters = []
+        if continuous_mode_enabled(conf):
+            create_stream, inputter_class = create_continuous_stream, ContinuousSpeechInputter
+        else:
+            create_stream, inputter_class = create_pyaudio_stream, SpeechInputter
+        for device in devices:
+            audio_stream = create_stream(conf, tracer=self.tracer,
+                                         audio_interface=audio_interface,
+                                         device=device)
+            inputter = inputter_class(conf, audio_stream=audio_stream,
+                                      result_watcher=self.result_watcher,
+                                      backend=self.backend, tracer=self.tracer,
+                                      session_pool=self.session_pool,
+                                      prosody_extractor=self.prosody_extractor,
+                                      utterance_archive=self.utterance_archive,
+                                      stall_watchdog=self.stall_watchdog,
+                                      intent_matcher=self.intent_matcher)
+            inputter.daemon = True
+            self.inputters.append(inputter)
+
+    def set_q(self, q):
+        self.q = q
+        for inputter in self.inputters:
+            inputter.set_q(q)
+
+    def start(self):
+        for inputter in self.inputters:
+            inputter.start()
+
+    def get(self):
+        # block
+        return self.q.get()
+
+    def is_empty(self):
+        return self.q.empty()
+
+
+class ContinuousSpeechInputter(SpeechInputter):
+    u"""
+    入力デバイスを止めずに録音し続ける音声入力器（conf.ini の [pyaudio] continuous）．
+    VADが発話を切り出すたびに認識を別スレッドで開始するので，前の発話の認識が
+    終わる前に次の発話の認識を始められる．同時に実行する認識セッションは
+    session_pool（省略時は [pyaudio] max_sessions 個）で制限する．
+    """
+
+    def __init__(self, conf, audio_stream=None, result_watcher=None, backend=None,
+                 tracer=None, session_pool=None, prosody_extractor=None,
+                 utterance_archive=None, stall_watchdog=None, intent_matcher=None):
+        u"""audio_stream には ContinuousPyAudioStream を与える（省略時は conf.ini から作成する）"""
+        if tracer is None:
+            tracer = create_tracer(conf)
+        if audio_stream is None:
+            audio_stream = create_continuous_stream(conf, tracer=tracer)
+        if session_pool is None:
+            session_pool = threading.BoundedSemaphore(conf.getint('pyaudio', 'max_sessions'))
+        super(ContinuousSpeechInputter, self).__init__(
+            conf, audio_stream=audio_stream, result_watcher=result_watcher, backend=backend,
+            tracer=tracer, session_pool=session_pool, prosody_extractor=prosody_extractor,
+            utterance_archive=utterance_archive, stall_watchdog=stall_watchdog,
+            intent_matcher=intent_matcher)
+
+    def recognize_utterance(self, utterance):
+        u"""1発話分を認識し，終わったらバッファを返す"""
+        try:
+            self.recognize(self.backend, utterance, self.result_watcher)
+        except RuntimeError as e:
+            print "NON FATAL ERROR:", e.message
+        finally:
+            utterance.close()
+            self.session_pool.release()
+
+    def run(self):
+        self.audio_stream.start()
+        while not self.audio_stream.closed:
+            utterance = self.audio_stream.next_utterance()
+            if utterance is None:
+                break
+            # 認識セッションに空きができるまで待つ（その間も音声は発話ごとのバッファに溜まる）
+            self.session_pool.acquire()
+            worker = threading.Thread(target=self.recognize_utterance, args=(utterance,))
+            worker.daemon = True
+            worker.start()
+
+
+def create_speech_inputter(conf):
+    u"""
+    conf.ini の [pyaudio] devices が空ならデフォルトの入力デバイスの SpeechInputter を，
+    そうでなければ列挙したデバイスの MultiSpeechInputter を作成する
+    """
+    devices = []
+    if conf.has_option('pyaudio', 'devices'):
+        devices = [d.strip() for d in conf.get('pyaudio', 'devices').split(',') if d.strip()]
+    if not devices:
+        if continuous_mode_enabled(conf):
+            return ContinuousSpeechInputter(conf)
+        return SpeechInputter(conf)
+    return MultiSpeechInputter(conf, devices)
+
+
 class TestInputter(threading.Thread):
     
     def __init__(self, conf):
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+u"""
+認識結果からの意図（状態）の抽出
+
+キーワード表（intents.ini）の全キーワードを1つの Aho-Corasick オートマトンにまとめ，
+認識結果の長さに比例する時間で，全ての一致を位置と優先度付きで返す．
+キーワードの数が増えても照合のコストは変わらない．
+
+intents.ini の書式:
+
+    [free]
+    priority = 2
+    keywords = 暇, ひま, 空いて
+
+セクション名が状態名になる．優先度は大きいほど強い．
+"""
+
+import ConfigParser
+from collections import deque
+
+
+class KeywordAutomaton(object):
+    u"""複数キーワードを同時に探す Aho-Corasick オートマトン"""
+
+    def __init__(self):
+        # ノードごとの遷移，失敗時の遷移先，そのノードで終わるキーワードの値
+        self.__goto = [{}]
+        self.__fail = [0]
+        self.__output = [[]]
+        self.__compiled = False
+
+    def add(self, keyword, value):
+        u"""keyword が見つかったときに value を返すようにする"""
+        if not keyword:
+            raise ValueError('empty keyword')
+        node = 0
+        for ch in keyword:
+            next_node = self.__goto[node].get(ch)
+            if next_node is None:
+                next_node = len(self.__goto)
+                self.__goto[node][ch] = next_node
+                self.__goto.append({})
+                self.__fail.append(0)
+                self.__output.append([])
+            node = next_node
+        self.__output[node].append((len(keyword), value))
+        self.__compiled = False
+
+    def compile(self):
+        u"""失敗時の遷移を幅優先で計算する"""
+        # ルート直下のノードの失敗時の遷移先はルート
+        queue = deque(self.__goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self.__goto[node].items():
+                queue.append(child)
+                fail = self.__fail[node]
+                while fail and ch not in self.__goto[fail]:
+                    fail = self.__fail[fail]
+                self.__fail[child] = self.__goto[fail].get(ch, 0)
+                self.__output[child] = self.__output[child] + self.__output[self.__fail[child]]
+        self.__compiled = True
+
+    def finditer(self, text):
+        u"""text 中の一致を (開始位置, 終了位置, value) として出現順に返す"""
+        if not self.__compiled:
+            self.compile()
+        goto, fail, output = self.__goto, self.__fail, self.__output
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for length, value in output[node]:
+                yield i + 1 - length, i + 1, value
+
+
+class IntentMatch(object):
+    u"""キーワードの一致"""
+
+    def __init__(self, state, keyword, start, end, priority):
+        self.state = state
+        self.keyword = keyword
+        self.start = start
+        self.end = end
+        self.priority = priority
+
+    def __repr__(self):
+        return 'IntentMatch(%r, %r, %d, %d, %d)' % (
+            self.state, self.keyword, self.start, self.end, self.priority)
+
+
+class IntentMatcher(object):
+    u"""状態ごとのキーワード表から作る意図抽出器"""
+
+    def __init__(self, table):
+        u"""table は (状態名, 優先度, キーワードのリスト) のリスト"""
+        self.__automaton = KeywordAutomaton()
+        for state, priority, keywords in table:
+            for keyword in keywords:
+                self.__automaton.add(keyword, (state, keyword, priority))
+        self.__automaton.compile()
+
+    def match(self, text):
+        u"""text 中の全ての一致を出現順に返す"""
+        return [IntentMatch(state, keyword, start, end, priority)
+                for start, end, (state, keyword, priority) in self.__automaton.finditer(text)]
+
+    def best(self, text):
+        u"""text 中で最も優先される一致を返す（best_match() を参照）"""
+        return best_match(self.match(text))
+
+
+def best_match(matches):
+    u"""優先度が最も高い一致（同じ優先度なら先に現れたもの）を返す．無ければ None"""
+    if not matches:
+        return None
+    return min(matches, key=lambda m: (-m.priority, m.start))
+
+
+def load_intent_matcher(filename):
+    u"""intents.ini から IntentMatcher を作る"""
+    parser = ConfigParser.SafeConfigParser()
+    if not parser.read(filename):
+        raise IOError('cannot read intent file: %s' % filename)
+    table = []
+    for state in parser.sections():
+        keywords = [k.strip() for k in parser.get(state, 'keywords').decode('utf-8').split(u',')]
+        table.append((state, parser.getint(state, 'priority'), [k for k in keywords if k]))
+    return IntentMatcher(table)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+u"""
+多数のクライアントから音声を受け付けて認識するサーバー（asr_server.py で使う）
+
+クライアントの接続ごとに asr.network.NetworkAudioStream（VAD と Audio ID の列を持つ）と
+SpeechInputter を作り，認識エンジン・ResultWatcher・レイテンシ計測器・ストールの監視などは
+全ての接続で共有する．同時に実行する認識セッションは [server] max_sessions 個までに制限し，
+空きを待つ発話にはクライアントの順番で（asr.session_pool.FairSessionPool）割り当てる．
+認識結果のイベントは JSON の行として，その接続のクライアントに返す（プロトコルは asr.network）．
+
+    server = IngestServer(conf)
+    server.serve_forever()
+"""
+
+import sys
+import json
+import socket
+import threading
+import SocketServer
+
+import asr.network as network
+import asr.session_pool as session_pool
+import asr.vad as vad
+import asr.recognizer as recognizer
+import asr.prosody as prosody
+import asr.archive as archive
+import asr.watchdog as watchdog
+import asr.metrics as metrics
+import intent
+from inputter import SpeechInputter, create_result_watcher, create_tracer, create_intent_matcher
+
+# クライアントが指定できるサンプリングレート
+SAMPLE_RATES = (8000, 16000, 22050, 24000, 32000, 44100, 48000)
+
+
+def encode_event(event):
+    u"""SpeechInputter のイベントを JSON にできる形にする．意図は state（最も優先される状態）も付ける"""
+    event = dict(event)
+    if 'intents' in event:
+        best = intent.best_match(event['intents'])
+        event['state'] = best.state if best is not None else None
+        event['intents'] = [{'state': m.state, 'keyword': m.keyword, 'priority': m.priority}
+                            for m in event['intents']]
+    return event
+
+
+class EventWriter(object):
+    u"""SpeechInputter のキューの代わりに，イベントを接続に書く．クライアントが切断した後は捨てる"""
+
+    def __init__(self, sock):
+        self.__sock = sock
+        self.__lock = threading.Lock()
+        self.failed = False
+
+    def put(self, event):
+        line = json.dumps(encode_event(event)) + '\n'
+        with self.__lock:
+            if self.failed:
+                return
+            try:
+                self.__sock.sendall(line)
+            except socket.error:
+                self.failed = True
+
+
+class _ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 64
+
+
+class IngestServer(object):
+    u"""
+    conf.ini の [server] の host:port で接続を受け付ける．接続ごとにスレッドを2つ
+    （受信と SpeechInputter）使う．max_clients を超える接続は断る．
+    デバイス名はメトリクスのラベルやセッションの割り当てに使うので，ハンドシェイクで必ず指定させ，
+    接続中のクライアントと同じ名前の接続は断る（接続ごとに変わるアドレスやポートは使わない）
+    """
+
+    def __init__(self, conf, host=None, port=None):
+        self.conf = conf
+        self.chunk_size = conf.getint('pyaudio', 'chunk_size')
+        self.max_clients = conf.getint('server', 'max_clients')
+        self.result_watcher = create_result_watcher(conf)
+        self.backend = recognizer.create_backend(conf)
+        self.tracer = create_tracer(conf)
+        self.prosody_extractor = prosody.create_prosody_extractor(conf)
+        self.utterance_archive = archive.create_archive(conf)
+        self.stall_watchdog = watchdog.create_watchdog(conf)
+        self.intent_matcher = create_intent_matcher(conf)
+        self.session_pool = session_pool.FairSessionPool(conf.getint('server', 'max_sessions'))
+        self.__lock = threading.Lock()
+        self.__clients = {}
+        self.__connections = metrics.counter('ingest_connections_total', u'受け付けた接続の数')
+        metrics.gauge('ingest_clients', u'接続中のクライアントの数'
+                      ).set_function(lambda: len(self.__clients))
+
+        server = self
+
+        class Handler(SocketServer.BaseRequestHandler):
+            def handle(self):
+                server.handle(self.request, self.client_address)
+
+        if host is None:
+            host = conf.get('server', 'host')
+        if port is None:
+            port = conf.getint('server', 'port')
+        self.server = _ThreadingTCPServer((host, port), Handler)
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    @property
+    def clients(self):
+        u"""接続中のクライアントのデバイス名"""
+        with self.__lock:
+            return sorted(audio_stream.device for audio_stream in self.__clients.values())
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def start(self):
+        u"""別スレッドで接続の受け付けを始める"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        with self.__lock:
+            audio_streams = list(self.__clients.values())
+        for audio_stream in audio_streams:
+            audio_stream.close()
+
+    def __reject(self, sock, reason, message):
+        metrics.counter('ingest_rejected_total', u'断った接続の数', reason=reason).inc()
+        try:
+            network.send_line(sock, {'type': 'error', 'message': message})
+        except socket.error:
+            pass
+
+    def handle(self, sock, address):
+        u"""1つの接続を処理する．クライアントが送信を終えるか切断するまで返らない"""
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            hello, pending = network.read_handshake(sock)
+            sample_rate = int(hello.get('sample_rate', self.conf.getint('pyaudio', 'sample_rate')))
+            device = hello.get('device')
+        except (ValueError, TypeError, socket.error) as e:
+            self.__reject(sock, 'handshake', 'bad handshake: %s' % e)
+            return
+        if not device or not isinstance(device, basestring):
+            self.__reject(sock, 'device', 'device name is required')
+            return
+        if sample_rate not in SAMPLE_RATES:
+            self.__reject(sock, 'sample_rate', 'unsupported sample rate: %d' % sample_rate)
+            return
+
+        with self.__lock:
+            full = len(self.__clients) >= self.max_clients
+            duplicate = device in self.__clients
+            if not full and not duplicate:
+                audio_stream = network.NetworkAudioStream(
+                    sock, sample_rate, chunk_size=self.chunk_size,
+                    logpower_thresh=self.conf.getfloat('pyaudio', 'logpower_thresh'),
+                    vad=vad.create_vad(self.conf, sample_rate, self.chunk_size),
+                    buffer_sec=self.conf.getfloat('pyaudio', 'buffer_sec'),
+                    tracer=self.tracer, device=device, pending=pending)
+                self.__clients[device] = audio_stream
+        if full:
+            self.__reject(sock, 'max_clients', 'too many clients')
+            return
+        if duplicate:
+            self.__reject(sock, 'duplicate_device', 'device already connected: %s' % device)
+            return
+        self.__connections.inc()
+        try:
+            inputter = SpeechInputter(self.conf, audio_stream=audio_stream,
+                                      result_watcher=self.result_watcher,
+                                      backend=self.backend, tracer=self.tracer,
+                                      session_pool=self.session_pool.client(device),
+                                      prosody_extractor=self.prosody_extractor,
+                                      utterance_archive=self.utterance_archive,
+                                      stall_watchdog=self.stall_watchdog,
+                                      intent_matcher=self.intent_matcher)
+            writer = EventWriter(sock)
+            inputter.set_q(writer)
+            writer.put({'type': 'ready', 'device': device, 'sample_rate': sample_rate})
+            # 接続が閉じられるまで発話を待って認識する
+            inputter.run()
+        except Exception as e:
+            print >> sys.stderr, "SERVER ERROR (%s): %s" % (device, e)
+        finally:
+            audio_stream.close()
+            with self.__lock:
+                del self.__clients[device]
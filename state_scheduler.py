@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+u"""
+状態の時限更新（cui.py --minute / --hour）
+
+cui.py busy --minute 30 は busy を今すぐ送り，30分後に free に戻す遷移をジャーナル
+（1行1記録の JSON ファイル）に書く．StateScheduler は期限の近い順に遷移をヒープに持ち，
+期限が来たら StateDispatcher（HTTP 接続を共有する）で1度だけ送る．
+
+    add     遷移（id, state, deadline）を追加する．deadline は UNIX 時刻
+    cancel  これより前に書かれた，まだ送っていない遷移を取り消す
+            （cui.py で新しい状態を指定したら以前の時限更新は無効になる）
+    done    遷移（ids）を送り終えた
+
+ジャーナルの追記と書き直しはロックファイル（flock）で排他する．StateScheduler は
+ジャーナルが変わったら読み直すので，再起動しても送っていない遷移は失われず，
+停止中に期限を過ぎた遷移は起動直後に送る．期限が来たときに，そこから batch_window_sec 以内に
+期限が来る遷移もまとめて，最も遅いものの状態を1回だけ送る．
+done は送信に成功してから書くので，送信と done の書き込みの間でプロセスが止まった場合のみ
+同じ状態を再起動後にもう1度送る（状態の送信は何度送っても結果が同じ）．
+
+    python state_scheduler.py    asr.py を動かしていない場合に単独で実行する
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import fcntl
+import heapq
+import threading
+import ConfigParser
+
+STATES = ('free', 'busy')
+
+
+def opposite_state(state):
+    u"""時限更新の期限が来たときに戻す状態"""
+    return STATES[1 - STATES.index(state)]
+
+
+class StateJournal(object):
+    u"""遷移のジャーナル．複数のプロセス（cui.py と StateScheduler）から使う"""
+
+    def __init__(self, path, compact_records=256):
+        self.path = path
+        self.__compact_records = compact_records
+
+    def __lock(self):
+        lock = open(self.path + '.lock', 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def __append(self, records):
+        lock = self.__lock()
+        try:
+            with open(self.path, 'a') as f:
+                f.write(''.join(json.dumps(r) + '\n' for r in records))
+                f.flush()
+                os.fsync(f.fileno())
+        finally:
+            lock.close()
+
+    def add(self, state, deadline, cancel_pending=True):
+        u"""deadline（UNIX 時刻）に state を送る遷移を追加し，その id を返す"""
+        now = time.time()
+        record = {'op': 'add', 'id': uuid.uuid4().hex, 'state': state,
+                  'deadline': deadline, 'issued': now}
+        records = [record]
+        if cancel_pending:
+            records.insert(0, {'op': 'cancel', 'issued': now})
+        self.__append(records)
+        return record['id']
+
+    def cancel(self):
+        u"""まだ送っていない遷移を全て取り消す"""
+        self.__append([{'op': 'cancel', 'issued': time.time()}])
+
+    def done(self, ids):
+        self.__append([{'op': 'done', 'ids': list(ids)}])
+
+    def signature(self):
+        u"""ファイルが変わったかどうかを調べるための値"""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def pending(self):
+        u"""まだ送っていない遷移（add の記録）のリスト．記録が多ければ書き直して小さくする"""
+        lock = self.__lock()
+        try:
+            records = []
+            if os.path.exists(self.path):
+                with open(self.path) as f:
+                    for line in f:
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            # 書き込み途中で切れた記録は無視する
+                            continue
+            pending = {}
+            for record in records:
+                if record['op'] == 'add':
+                    pending[record['id']] = record
+                elif record['op'] == 'cancel':
+                    for id, added in pending.items():
+                        if added['issued'] <= record['issued']:
+                            del pending[id]
+                elif record['op'] == 'done':
+                    for id in record['ids']:
+                        pending.pop(id, None)
+            pending = sorted(pending.values(), key=lambda r: (r['deadline'], r['issued']))
+            if len(records) > max(self.__compact_records, len(pending)):
+                with open(self.path + '.tmp', 'w') as f:
+                    f.write(''.join(json.dumps(r) + '\n' for r in pending))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(self.path + '.tmp', self.path)
+            return pending
+        finally:
+            lock.close()
+
+
+class StateScheduler(object):
+    u"""
+    ジャーナルの遷移を期限に送るスケジューラ（別スレッドで動く）．
+    期限の近い遷移までと poll_sec 秒の短い方だけ眠り，起きたらジャーナルが変わっていないか
+    （ファイルの stat のみ）を調べる．送信に失敗した遷移は retry_sec 秒後に送り直す．
+    期限の状態は直前に送った状態と同じでも必ず送る（他のプロセスが状態を変えたかもしれないため）．
+    送信待ちの間に新しい状態に置き換えられた場合は，送らずに済んだものとして superseded に数える
+    """
+
+    def __init__(self, dispatcher, journal, batch_window_sec=1.0, poll_sec=1.0,
+                 retry_sec=30.0):
+        self.dispatcher = dispatcher
+        self.journal = journal
+        self.batch_window_sec = batch_window_sec
+        self.poll_sec = poll_sec
+        self.retry_sec = retry_sec
+        self.__cond = threading.Condition()
+        self.__signature = None
+        # (期限, 書かれた時刻, id) のヒープと，id ごとの遷移
+        self.__heap = []
+        self.__pending = {}
+        self.__in_flight = False
+        # 送信に失敗したら，この時刻まで送り直さない
+        self.__retry_at = 0.0
+        self.__closed = False
+        self.stats = {'sent': 0, 'batched': 0, 'superseded': 0, 'failures': 0}
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+
+    def start(self):
+        self.__thread.start()
+
+    def close(self, timeout=None):
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notifyAll()
+        self.__thread.join(timeout)
+
+    def __reload(self):
+        u"""ジャーナルが変わっていたら遷移を読み直す（self.__cond を保持して呼ぶ）"""
+        signature = self.journal.signature()
+        if signature == self.__signature:
+            return
+        pending = self.journal.pending()
+        # 書き直した場合はファイルが変わるので，読み直した後の値を覚える
+        self.__signature = self.journal.signature()
+        self.__pending = dict((r['id'], r) for r in pending)
+        self.__heap = [(r['deadline'], r['issued'], r['id']) for r in pending]
+        heapq.heapify(self.__heap)
+
+    def __due(self, now):
+        u"""
+        最も近い期限が来ていれば，期限が now + batch_window_sec までの遷移をヒープから取り出す
+        """
+        due = []
+        ids = set()
+        if not self.__heap or self.__heap[0][0] > now:
+            return due
+        while self.__heap and self.__heap[0][0] <= now + self.batch_window_sec:
+            deadline, issued, id = heapq.heappop(self.__heap)
+            if id in self.__pending and id not in ids:
+                ids.add(id)
+                due.append(self.__pending[id])
+        return due
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                if self.__closed:
+                    return
+                try:
+                    self.__reload()
+                except (IOError, OSError, ValueError) as e:
+                    print >> sys.stderr, "SCHEDULE ERROR:", e
+                now = time.time()
+                ready = not self.__in_flight and now >= self.__retry_at
+                if ready:
+                    due = self.__due(now)
+                    if due:
+                        self.__fire(due)
+                        ready = False
+                wait = self.poll_sec
+                if ready and self.__heap:
+                    wait = min(wait, self.__heap[0][0] - now)
+                elif not self.__in_flight and now < self.__retry_at:
+                    wait = min(wait, self.__retry_at - now)
+                self.__cond.wait(max(0.0, wait))
+
+    def __fire(self, due):
+        u"""期限が来た遷移をまとめて，最も遅いものの状態を送る（self.__cond を保持して呼ぶ）"""
+        state = due[-1]['state']
+        ids = [r['id'] for r in due]
+        self.__in_flight = True
+        if len(due) > 1:
+            self.stats['batched'] += len(due) - 1
+
+        def on_done(sent_state, ok):
+            # sent_state が state と異なるのは，送信待ちの間に新しい状態に置き換えられた場合．
+            # 期限より新しい状態が送られたので，この遷移も送り直さない．
+            # 送り直さないよう，送信中であることを解く前に done を書く
+            superseded = sent_state != state
+            if ok:
+                try:
+                    self.journal.done(ids)
+                except (IOError, OSError) as e:
+                    print >> sys.stderr, "SCHEDULE ERROR:", e
+            with self.__cond:
+                self.__in_flight = False
+                if ok:
+                    self.stats['superseded' if superseded else 'sent'] += 1
+                    for id in ids:
+                        self.__pending.pop(id, None)
+                else:
+                    self.stats['failures'] += 1
+                    self.__retry_at = time.time() + self.retry_sec
+                    for r in due:
+                        heapq.heappush(self.__heap, (r['deadline'], r['issued'], r['id']))
+                self.__cond.notifyAll()
+        self.dispatcher.submit(state, on_done, force=True)
+
+
+def create_journal(conf):
+    u"""[schedule] journal のジャーナル．相対パスはこのファイルのディレクトリを基準にする"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        conf.get('schedule', 'journal'))
+    return StateJournal(path)
+
+
+def create_scheduler(conf, dispatcher):
+    u"""conf.ini の [schedule] が有効なら，dispatcher で送る StateScheduler を作成する"""
+    if not conf.has_section('schedule') or not conf.getboolean('schedule', 'enabled'):
+        return None
+    return _create_scheduler(conf, dispatcher)
+
+
+def _create_scheduler(conf, dispatcher):
+    return StateScheduler(dispatcher, create_journal(conf),
+                          batch_window_sec=conf.getfloat('schedule', 'batch_window_sec'),
+                          poll_sec=conf.getfloat('schedule', 'poll_sec'),
+                          retry_sec=conf.getfloat('schedule', 'retry_sec'))
+
+
+def main():
+    from send import StateDispatcher
+
+    conf = ConfigParser.SafeConfigParser()
+    conf.read('./speech/conf.ini')
+    dispatcher = StateDispatcher()
+    # [schedule] enabled は asr.py で動かすかどうかなので，ここでは見ない
+    scheduler = _create_scheduler(conf, dispatcher)
+    scheduler.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        scheduler.close()
+        dispatcher.close()
+
+
+if __name__ == '__main__':
+    main()